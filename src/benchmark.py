@@ -0,0 +1,781 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from functools import partial
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from scipy import special
+
+import region_weights
+import spei_engine
+import static_inputs
+from calculate_cdhw import CDHW_METRICS, CDHW_SPELL_METRICS, sweep_year
+from grid_store import open_grid_store, store_region_means
+from input_catalog import build_catalog, days_in_year, variable_problems
+from metric_engine import (SPELL_KINDS, catalog_years, growing_season_mean, growing_season_sum, open_variable,
+                           run_metrics, run_years)
+from regrid import apply_weights, cell_bounds, global_grid, regrid_weights
+from region_weights import load_region_fractions
+from static_inputs import load_static_inputs
+from synthetic_data import generate_inputs
+from year_cube import Query, build_year_cube, open_year_cube, query_cube
+
+# Bump whenever the layout of the report changes.
+REPORT_VERSION = 2
+
+# Same definitions as calculate_country_mean_temp.py and calculate_country_precipitation.py,
+# which need a config.py to import
+MEAN_TEMP_METRICS = [growing_season_mean('mean_temp', 'temp', offset=-273.15)]
+PRECIP_METRICS = [growing_season_sum('precipitation_total', 'precip')]
+ALL_METRICS = CDHW_METRICS + MEAN_TEMP_METRICS + PRECIP_METRICS
+SPELL_METRICS = CDHW_METRICS + CDHW_SPELL_METRICS
+# Every metric, computed by the reference loop for each growing-season precision
+REFERENCE_METRICS = ALL_METRICS + CDHW_SPELL_METRICS
+
+SWEEP_TMAX_C = [25.0 + 0.5 * i for i in range(31)]
+SWEEP_SPEI = [-1.0, -1.5, -2.0]
+
+# Results that differ from the reference loop by more than this fail the check
+RTOL = 1e-6
+ATOL = 1e-9
+DEFAULT_MEMORY_BUDGET_MB = 64
+
+
+def git_revision():
+    """Commit and dirty flag of the source tree, or None outside a git checkout."""
+    src_dir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=src_dir, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=src_dir,
+                                capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return {'commit': commit, 'dirty': bool(status.strip())}
+
+
+def machine_info():
+    return {
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpus': os.cpu_count(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'xarray': xr.__version__,
+    }
+
+
+def measure(func, repeat=3):
+    """Times `func` `repeat` times, then runs it once more under tracemalloc for its peak memory.
+
+    Output of the runs is suppressed. The peak covers Python and NumPy
+    allocations of this process only, not worker processes or buffers of the
+    NetCDF library. Returns the timings and the result of the last run.
+    """
+    seconds = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = func()
+            seconds.append(time.perf_counter() - start)
+        tracemalloc.start()
+        try:
+            result = func()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    return {'seconds': min(seconds), 'seconds_all': seconds, 'peak_mb': peak / 2**20}, result
+
+
+def reference_metrics(year_sources, spei_file, static, metrics, region_fractions=None, growing_season='month'):
+    """Country means of the metrics with a plain day-by-day loop, for checking the engine.
+
+    Every day is read on its own, tested against the growing season of its
+    calendar month (with `growing_season` 'day', of its day of year against
+    the planting and harvest days) and the SPEI of its month, and
+    accumulated per cell; the annual fields are then averaged region by
+    region. With `region_fractions` (a sparse (regions, cells) overlap matrix
+    with rows in the order of the regions of `static`), regions are weighted
+    by it instead of the country mask. Spells are followed day by day
+    through all years and credited to the year they start in. Slow but
+    straightforward.
+    """
+    spei = xr.open_dataset(spei_file)['spei']
+    lat, lon = static.lat.values, static.lon.values
+    by_day = growing_season == 'day'
+    season_start = static['gs_start_day' if by_day else 'gs_start_month'].values
+    season_end = static['gs_end_day' if by_day else 'gs_end_month'].values
+    area = static['area_weights'].values.astype('float64')
+    country_mask = static['country_mask'].values
+    names = dict(zip(static['region'].values.tolist(), static['region_name'].values.tolist()))
+
+    spei_months = {}
+
+    def drought_index(day):
+        key = (day.year, day.month)
+        if key not in spei_months:
+            match = np.flatnonzero((spei.time.dt.year.values == day.year) & (spei.time.dt.month.values == day.month))
+            if len(match):
+                month = spei.isel(time=match[0]).interp(lat=lat, lon=lon, method='nearest').values
+            else:
+                month = np.full((len(lat), len(lon)), np.nan)
+            spei_months[key] = month
+        return spei_months[key]
+
+    year_fields = {}
+    spell_runs = {}
+    onsets = {m.name for m in metrics if m.kind == 'onset'}
+    longest = {m.name for m in metrics if m.kind == 'longest'}
+
+    def close_spells():
+        for name, (run, start) in spell_runs.items():
+            if name in longest:
+                for y in np.unique(start[run > 0]):
+                    ended = (run > 0) & (start == y)
+                    year_fields[y][name][ended] = np.maximum(year_fields[y][name][ended], run[ended])
+            run[:] = 0
+
+    def follow_spell(m, hot, year, day_of_year):
+        run, start = spell_runs.setdefault(m.name, (np.zeros(hot.shape, dtype='int64'),
+                                                    np.zeros(hot.shape, dtype='int64')))
+        field = year_fields[year][m.name]
+        begins = hot & (run == 0)
+        if m.kind == 'events':
+            field += begins
+        elif m.kind == 'onset':
+            field[begins & np.isnan(field)] = day_of_year
+        else:
+            ended = ~hot & (run > 0)
+            for y in np.unique(start[ended]):
+                done = ended & (start == y)
+                year_fields[y][m.name][done] = np.maximum(year_fields[y][m.name][done], run[done])
+        start[begins] = year
+        run[:] = np.where(hot, run + 1, 0)
+
+    previous_year = None
+    for year, files in year_sources.items():
+        fields = year_fields[year] = {}
+        if previous_year is not None and year != previous_year + 1:
+            close_spells()
+        previous_year = year
+        for variable, path in files.items():
+            var_metrics = [m for m in metrics if m.variable == variable]
+            if not var_metrics:
+                continue
+            da = open_variable(path)
+            da = da.isel(time=np.flatnonzero(da.time.dt.year.values == year)).transpose('time', 'lat', 'lon')
+            totals = {m.name: np.zeros((len(lat), len(lon))) for m in var_metrics}
+            for m in var_metrics:
+                if m.kind in SPELL_KINDS:
+                    fields[m.name] = np.full((len(lat), len(lon)), np.nan if m.kind == 'onset' else 0.0)
+            n_days = {m.name: np.zeros((len(lat), len(lon))) for m in var_metrics}
+            for t in range(da.sizes['time']):
+                day = pd.Timestamp(da.time.values[t])
+                values = da.isel(time=t).values
+                position = day.dayofyear if by_day else day.month
+                # A season that starts after it ends runs across the new year
+                with np.errstate(invalid='ignore'):
+                    in_season = np.where(season_start <= season_end,
+                                         (position >= season_start) & (position <= season_end),
+                                         (position >= season_start) | (position <= season_end))
+                for m in var_metrics:
+                    if m.kind == 'count' or m.kind in SPELL_KINDS:
+                        hot = in_season & (values > m.threshold)
+                        if m.spei_below is not None:
+                            hot &= drought_index(day) < m.spei_below
+                        if m.kind == 'count':
+                            totals[m.name] += hot
+                        else:
+                            follow_spell(m, hot, year, day.dayofyear)
+                    else:
+                        day_values = values.astype('float64') + m.offset
+                        valid = in_season & ~np.isnan(day_values)
+                        totals[m.name] += np.where(valid, day_values, 0.0)
+                        n_days[m.name] += valid
+            for m in var_metrics:
+                if m.kind in SPELL_KINDS:
+                    continue
+                if m.kind == 'mean':
+                    with np.errstate(invalid='ignore', divide='ignore'):
+                        fields[m.name] = np.where(n_days[m.name] > 0, totals[m.name] / n_days[m.name], np.nan)
+                else:
+                    fields[m.name] = totals[m.name]
+    close_spells()
+
+    rows = []
+    for year, fields in year_fields.items():
+        if region_fractions is None:
+            regions = np.unique(country_mask[~np.isnan(country_mask)]).astype('int64')
+        else:
+            regions = static['region'].values
+        for i, code in enumerate(regions):
+            if region_fractions is None:
+                weights = np.where(country_mask == code, area, 0.0)
+            else:
+                weights = region_fractions[i].toarray().reshape(area.shape) * area
+            total_weight = weights.sum()
+            row = {'year': year, 'country': names[code]}
+            for name, field in fields.items():
+                if name in onsets:
+                    # Onsets are averaged over the cells with a spell
+                    spell_weight = np.where(np.isnan(field), 0.0, weights).sum()
+                    row[name] = np.nansum(field * weights) / spell_weight if spell_weight > 0 else np.nan
+                    continue
+                row[name] = np.nansum(field * weights) / total_weight if total_weight > 0 else np.nan
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def compare_results(df, reference, columns):
+    """Checks engine results against `reference_metrics`; NaN matches NaN.
+
+    Returns the check status, the largest absolute difference per column and
+    the number of (year, region) rows found in only one of the tables.
+    """
+    merged = df.merge(reference, on=['year', 'country'], how='outer', suffixes=('', '_reference'),
+                      indicator=True)
+    unmatched = int((merged['_merge'] != 'both').sum())
+    merged = merged[merged['_merge'] == 'both']
+    max_abs_diff = {}
+    ok = unmatched == 0
+    for column in columns:
+        actual = merged[column].to_numpy(dtype='float64')
+        expected = merged[f'{column}_reference'].to_numpy(dtype='float64')
+        close = np.isclose(actual, expected, rtol=RTOL, atol=ATOL, equal_nan=True)
+        ok &= bool(close.all())
+        diff = np.abs(actual - expected)
+        max_abs_diff[column] = float(np.nanmax(diff)) if np.isfinite(diff).any() else 0.0
+    return {'status': 'ok' if ok else 'mismatch', 'max_abs_diff': max_abs_diff, 'unmatched_rows': unmatched}
+
+
+def sweep_as_cdhw(df):
+    """The rows of a threshold sweep that correspond to CDHW29_days and CDHW30_days."""
+    df = df[df['spei_threshold'] == -1.0]
+    table = df.set_index(['year', 'country', 'tmax_threshold_c'])['CDHW_days'].unstack()
+    return pd.DataFrame({'CDHW29_days': table[29.0], 'CDHW30_days': table[30.0]}).reset_index()
+
+
+def check_result(failures):
+    """Status of a component check from its list of failures."""
+    return {'status': 'ok' if not failures else 'mismatch', 'failures': failures}
+
+
+def check_regrid(lat, lon):
+    """Regridding weights from the daily grid to a grid twice as coarse.
+
+    Bilinear weights sum to 1 and reproduce fields linear in latitude or
+    longitude; conservative weights sum to 1 and keep the area integral of
+    any field. Missing sources are left out: a constant field with gaps
+    stays constant, and a target is missing only without any valid source.
+    """
+    failures = []
+    resolution = abs(float(lat[1] - lat[0]))
+    dst_lat, dst_lon = global_grid(2 * resolution)
+    src_lat2, src_lon2 = np.meshgrid(lat, lon, indexing='ij')
+    dst_lat2, dst_lon2 = np.meshgrid(dst_lat, dst_lon, indexing='ij')
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        bilinear = regrid_weights(lat, lon, dst_lat, dst_lon, 'bilinear')
+        conservative = regrid_weights(lat, lon, dst_lat, dst_lon, 'conservative')
+    for method, weights in (('bilinear', bilinear), ('conservative', conservative)):
+        row_sums = np.asarray(weights.sum(axis=1)).ravel()
+        if not np.allclose(row_sums, 1.0, rtol=0, atol=1e-9):
+            failures.append(f"{method} weights of a target cell sum to {row_sums.min()} .. {row_sums.max()}")
+
+    for name, src, dst in (('latitude', src_lat2, dst_lat2), ('longitude', src_lon2, dst_lon2)):
+        # Longitudes beyond the outermost source centres interpolate across the date line
+        inside = (dst_lon2 > lon.min()) & (dst_lon2 < lon.max())
+        result = (bilinear @ (3.0 + 0.1 * src).ravel()).reshape(dst.shape)
+        if not np.allclose(result[inside], 3.0 + 0.1 * dst[inside], rtol=0, atol=1e-9):
+            failures.append(f"bilinear weights do not reproduce a field linear in {name}")
+
+    def cell_areas(grid_lat, grid_lon):
+        sin_lat = np.sin(np.deg2rad(cell_bounds(grid_lat, -90.0, 90.0)))
+        return np.outer(sin_lat[:, 1] - sin_lat[:, 0], np.diff(cell_bounds(grid_lon), axis=1)[:, 0]).ravel()
+
+    field = np.random.default_rng(0).random(len(lat) * len(lon))
+    src_total = (cell_areas(lat, lon) * field).sum()
+    dst_total = (cell_areas(dst_lat, dst_lon) * (conservative @ field)).sum()
+    if not np.isclose(dst_total, src_total, rtol=1e-9, atol=0):
+        failures.append(f"conservative regridding changes the area integral from {src_total} to {dst_total}")
+
+    values = np.full((2, len(lat), len(lon)), 5.0, dtype='float32')
+    values[np.random.default_rng(1).random(values.shape) < 0.5] = np.nan
+    result = apply_weights(conservative, values)
+    covered = (conservative @ ~np.isnan(values.reshape(2, -1)).T).T > 0
+    if not np.array_equal(~np.isnan(result), covered):
+        failures.append("regridded cells are missing although some of their sources have data, or the reverse")
+    if not np.allclose(result[covered], 5.0):
+        failures.append("missing sources are not left out of the regridded mean")
+    return check_result(failures)
+
+
+def write_daily_climate(directory, years, lat, lon, seed=0):
+    """Small daily precipitation (mm per day) and mean temperature (K) files, one per year, for SPEI checks.
+
+    The first cell never thaws (a heat index of 0); the others have a
+    seasonal cycle. Returns the precipitation and temperature file lists.
+    """
+    rng = np.random.default_rng(seed)
+    precip_files, temp_files = [], []
+    for year in years:
+        time = pd.date_range(f"{year}-01-01", f"{year}-12-31", freq='D')
+        season = np.cos(2 * np.pi * (time.dayofyear.values - 200) / 365.25)[:, None, None]
+        temp = 283.15 + 12 * season + 3 * rng.standard_normal((len(time), len(lat), len(lon)))
+        temp[:, 0, 0] = 250.0
+        precip = rng.gamma(0.5, 6.0, temp.shape)
+        for name, values, units, files in (('precip', precip, 'mm d-1', precip_files),
+                                           ('temp', temp, 'K', temp_files)):
+            files.append(os.path.join(directory, f"{name}_{year}.nc"))
+            da = xr.DataArray(values.astype('float32'), coords={'time': time, 'lat': lat, 'lon': lon},
+                              dims=('time', 'lat', 'lon'), attrs={'units': units})
+            da.to_dataset(name=name).to_netcdf(files[-1])
+    return precip_files, temp_files
+
+
+def check_spei(workdir):
+    """Accumulation, Thornthwaite PET, the log-logistic fit and gridded SPEI over a missing year.
+
+    The fitted SPEI of log-logistic water balances must follow the normal
+    quantiles of their probabilities. Gridded SPEI of 14 years with the 6th
+    missing must leave that year and the windows over it missing, stay
+    finite in a cell that never thaws and elsewhere be missing only in the
+    calendar months of a cell without a valid fit.
+    """
+    failures = []
+    rng = np.random.default_rng(2)
+    values = rng.standard_normal((40, 5))
+    values[rng.random(values.shape) < 0.1] = np.nan
+    for scale in (1, 3, 6):
+        expected = np.full(values.shape, np.nan)
+        for t in range(scale - 1, len(values)):
+            expected[t] = values[t - scale + 1:t + 1].sum(axis=0)
+        if not np.allclose(spei_engine.accumulate(values, scale), expected, equal_nan=True):
+            failures.append(f"accumulate at scale {scale} differs from the sum over each window")
+
+    month_keys = np.arange(1960 * 12, 2020 * 12)
+    temp = np.full((len(month_keys), 2), 20.0)
+    temp[:, 0] = -5.0
+    temp[3, 1] = np.nan
+    pet = spei_engine.thornthwaite_pet(temp, np.array([70.0, 10.0]), month_keys, np.full(len(month_keys), 30))
+    if not (np.all(pet[:, 0] == 0) and np.isnan(pet[3, 1]) and np.all(np.delete(pet[:, 1], 3) > 0)):
+        failures.append("Thornthwaite PET is not 0 in a cell that never thaws, positive in a warm cell and "
+                        "missing where the temperature is missing")
+
+    probability = rng.uniform(0.01, 0.99, (len(month_keys), 50))
+    balance = -20.0 + 40.0 * (probability / (1 - probability)) ** (1 / 4.0)
+    spei = spei_engine.spei_from_balance(balance, month_keys, [1], (1960, 2019))[1]
+    correlation = np.corrcoef(spei.ravel(), special.ndtri(probability).ravel())[0, 1]
+    # The fits are of 60 years, so the SPEI only follows the true quantiles up to the sampling noise
+    if not correlation > 0.98 or abs(np.nanmean(spei)) > 0.1 or abs(np.nanstd(spei) - 1) > 0.1:
+        failures.append(f"SPEI of log-logistic balances is not standard normal (correlation with the true "
+                        f"quantiles {correlation:.4f}, mean {np.nanmean(spei):.3f}, sd {np.nanstd(spei):.3f})")
+
+    with tempfile.TemporaryDirectory(dir=workdir) as tmp_dir:
+        years = [year for year in range(2000, 2014) if year != 2005]
+        precip_files, temp_files = write_daily_climate(tmp_dir, years, np.array([50.0, 10.0, -30.0]),
+                                                       np.array([0.0, 90.0]))
+        with contextlib.redirect_stdout(io.StringIO()):
+            paths = spei_engine.gridded_spei(precip_files, temp_files, os.path.join(tmp_dir, "cache"), [1, 3])
+        for scale, path in paths.items():
+            with xr.open_dataset(path) as ds:
+                grid = ds['spei'].load()
+            time = pd.DatetimeIndex(grid.time.values)
+            values = grid.values
+            if len(time) != 168 or not (np.diff(time.year * 12 + time.month) == 1).all():
+                failures.append(f"SPEI-{scale} does not have one step per month from 2000 to 2013")
+                continue
+            gap = (time.year == 2005) | ((time.year == 2006) & (time.month < scale))
+            if not np.isnan(values[gap]).all():
+                failures.append(f"SPEI-{scale} has values in or over the missing year 2005")
+            if np.isinf(values).any() or np.isnan(values[:, 0, 0]).all():
+                failures.append(f"SPEI-{scale} is infinite, or missing in the cell that never thaws")
+            rest = ~gap & (np.arange(len(time)) >= scale - 1)
+            for month in range(1, 13):
+                missing = np.isnan(values[rest & (time.month == month)])
+                if (missing.any(axis=0) != missing.all(axis=0)).any():
+                    failures.append(f"SPEI-{scale} is missing in some years of month {month} outside the gap")
+    return check_result(failures)
+
+
+def check_region_fractions(fractions, static, regions_file):
+    """Overlap fractions against the polygons of the regions file.
+
+    No cell is shared out beyond its whole area, the cells of every region
+    cover exactly the polygon's area, the region smaller than a cell (the
+    last polygon) is kept and every cell of the country mask overlaps the
+    region it is assigned to.
+    """
+    import geopandas as gpd
+    import shapely
+
+    failures = []
+    lat, lon = static.lat.values, static.lon.values
+    cell_area = np.outer(np.diff(cell_bounds(lat, -90.0, 90.0), axis=1)[:, 0],
+                         np.diff(cell_bounds(lon), axis=1)[:, 0]).ravel()
+    polygon_area = shapely.area(gpd.read_file(regions_file).geometry.values)
+    covered = fractions @ cell_area
+    if not np.allclose(covered, polygon_area, rtol=1e-6, atol=0):
+        worst = int(np.argmax(np.abs(covered - polygon_area) / polygon_area))
+        failures.append(f"region {worst} covers {covered[worst]} square degrees of cells, its polygon "
+                        f"{polygon_area[worst]}")
+    shared = np.asarray(fractions.sum(axis=0)).ravel()
+    if shared.max() > 1 + 1e-9:
+        failures.append(f"a cell is shared between regions by {shared.max()} of its area")
+    if not covered[-1] > 0:
+        failures.append("the region smaller than a cell has no weight")
+    mask = np.asarray(static['country_mask'].transpose('lat', 'lon').values).ravel()
+    cells = np.flatnonzero(~np.isnan(mask))
+    if not (np.asarray(fractions[mask[cells].astype('int64'), cells]).ravel() > 0).all():
+        failures.append("cells of the country mask do not overlap the region they are assigned to")
+    return check_result(failures)
+
+
+def check_input_problems(tmax_files, catalog_file):
+    """`variable_problems` on the catalog records of the synthetic Tmax files and on altered copies of them."""
+    failures = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        records = build_catalog(tmax_files, catalog_file)
+    problems, warnings = variable_problems('tmax', records)
+    if problems or warnings:
+        failures.append(f"the synthetic Tmax files have problems {problems} and warnings {warnings}")
+
+    first = records[0]
+    calendar_name = first['calendar']
+
+    def record(year, **changes):
+        altered = dict(first, path=f"tmax_{year}.nc", steps={str(year): days_in_year(year, calendar_name)})
+        altered.update(changes)
+        return altered
+
+    cases = {
+        # name: (records, years, number of problems, warnings expected)
+        'complete': ([record(2000), record(2001), record(2002)], None, 0, 0),
+        'missing year': ([record(2000), record(2002)], None, 0, 1),
+        'missing year outside the period': ([record(2000), record(2002), record(2003)], (2002, 2003), 0, 0),
+        'Celsius': ([record(2000), record(2001, units='degC')], None, 1, 0),
+        'no units': ([record(2000), record(2001, units=None)], None, 0, 1),
+        'two grids': ([record(2000), record(2001, grid='other', n_lat=1)], None, 1, 0),
+        'short year': ([record(2000, steps={'2000': 300})], None, 1, 0),
+        'split year': ([record(2000), record(2000, path="tmax_2000b.nc")], None, 1, 0),
+        'unreadable': ([record(2000), {'path': "broken.nc", 'error': "OSError: broken"}], None, 1, 0),
+    }
+    for name, (case_records, years, n_problems, n_warnings) in cases.items():
+        problems, warnings = variable_problems('tmax', case_records, years)
+        if (len(problems), len(warnings)) != (n_problems, n_warnings):
+            failures.append(f"{name}: expected {n_problems} problems and {n_warnings} warnings, "
+                            f"got {problems} and {warnings}")
+    return check_result(failures)
+
+
+def cube_reference(ds, query):
+    """Answer of a year cube query computed directly from the per-cell fields of a mask-weighted store."""
+    area = np.nan_to_num(np.asarray(ds['area_weights'].transpose('lat', 'lon').values, dtype='float64'))
+    mask = np.asarray(ds['country_mask'].transpose('lat', 'lon').values)
+    regions = ds.region.values if query.regions is None else np.asarray(query.regions)
+    weights = np.where(np.isin(mask, regions) & (area > query.min_area), area, 0.0)
+    years = [year for year in ds.year.values if query.first_year <= year <= query.last_year]
+    total = denominator = 0.0
+    for year in years:
+        values = np.asarray(ds[query.metric].sel(year=year).transpose('lat', 'lon').values, dtype='float64')
+        total += np.nansum(weights * values)
+        denominator += np.where(np.isnan(values), 0.0, weights).sum() if query.metric.endswith('_onset_doy') \
+            else weights.sum()
+    return total / denominator if denominator > 0 and years else np.nan
+
+
+def check_grid_stores(paths, cache_dir, workdir):
+    """Grid stores reproduce the table of their run, and year cube queries match the stored fields.
+
+    Runs every metric with a NetCDF store ('mask' weights) and the CDHW
+    days with a Zarr store ('overlap' weights); re-aggregating each store
+    must give the run's table. A cube of the NetCDF store then answers
+    queries over single regions, pooled regions, part of the period and an
+    area cutoff, compared with sums over the stored fields.
+    """
+    failures = []
+    run = partial(run_metrics, sources=paths['sources'], static_files=paths['static_files'], cache_dir=cache_dir,
+                  spei_file=paths['spei'])
+    with tempfile.TemporaryDirectory(dir=workdir) as tmp_dir:
+        stores = {
+            'netcdf': (os.path.join(tmp_dir, "grids.nc"), REFERENCE_METRICS, 'mask'),
+            'zarr': (os.path.join(tmp_dir, "grids.zarr"), CDHW_METRICS, 'overlap'),
+        }
+        for name, (store, metrics, weights) in stores.items():
+            with contextlib.redirect_stdout(io.StringIO()):
+                df = run(metrics, grid_store=store, region_weights=weights)
+                stored = store_region_means(store)
+            check = compare_results(stored, df, [m.name for m in metrics])
+            if check['status'] != 'ok':
+                failures.append(f"the {name} store does not reproduce its table: {check}")
+
+        store = stores['netcdf'][0]
+        cube_path = os.path.join(tmp_dir, "cube")
+        with contextlib.redirect_stdout(io.StringIO()):
+            build_year_cube(store, cube_path)
+        cube = open_year_cube(cube_path)
+        with open_grid_store(store) as ds:
+            ds = ds.load()
+        years = ds.year.values
+        area = np.nan_to_num(np.asarray(ds['area_weights'].values, dtype='float64'))
+        # The three regions with the most maize
+        mask = np.asarray(ds['country_mask'].values)
+        totals = np.bincount(np.nan_to_num(mask, nan=-1).astype('int64').ravel() + 1, weights=area.ravel())[1:]
+        regions = np.argsort(totals)[::-1][:3].tolist()
+        cutoff = float(np.median(area[area > 0]))
+        queries = []
+        for metric in [m.name for m in REFERENCE_METRICS]:
+            queries += [Query(metric, int(years[0]), int(years[-1]), None, 0.0),
+                        Query(metric, int(years[-1]), int(years[-1]), [regions[0]], 0.0),
+                        Query(metric, int(years[0]), int(years[-1]), regions, cutoff)]
+        answers = query_cube(cube, queries)
+        expected = np.array([cube_reference(ds, query) for query in queries])
+        bad = ~np.isclose(answers['value'].to_numpy(), expected, rtol=RTOL, atol=ATOL, equal_nan=True)
+        for i in np.flatnonzero(bad):
+            failures.append(f"cube query {queries[i]} gives {answers['value'].iloc[i]}, the fields {expected[i]}")
+    return check_result(failures)
+
+
+def component_checks(paths, static, fractions, cache_dir, workdir):
+    """Behaviour checks of the modules the engine cases do not compare against the reference loop.
+
+    Returns {check name: {'status', 'failures'}}.
+    """
+    template = open_variable(paths['sources']['tmax'][0])
+    checks = {
+        'regrid_weights': lambda: check_regrid(template.lat.values, template.lon.values),
+        'spei': lambda: check_spei(workdir),
+        'region_fractions': lambda: check_region_fractions(fractions, static, paths['static_files'][2]),
+        'input_problems': lambda: check_input_problems(paths['sources']['tmax'],
+                                                       os.path.join(workdir, "input_catalog_check.json")),
+        'grid_store_cube': lambda: check_grid_stores(paths, cache_dir, workdir),
+    }
+    results = {}
+    for name, check in checks.items():
+        print(f"Checking {name}...")
+        results[name] = check()
+    return results
+
+
+def engine_cases(paths, memory_budget_mb, workers):
+    """Benchmark cases: name -> (function returning a result table, metrics it computes, reference).
+
+    The cases replace the former per-chunk functions: `cdhw` covers what
+    process_chunk did, `mean_temp` process_temp_chunk and `precip`
+    process_precip_chunk, each now a metric list run by the fused engine.
+    The reference is the `reference_metrics` run a case is checked against:
+    'mask' or 'overlap' region weights with whole-month growing seasons, or
+    'day' for seasons cut at the planting and harvest days.
+    """
+    sources, spei_file, static_files = paths['sources'], paths['spei'], paths['static_files']
+    cache_dir = os.path.join(os.path.dirname(paths['spei']), "static_cache")
+    run = partial(run_metrics, sources=sources, static_files=static_files, cache_dir=cache_dir, spei_file=spei_file)
+
+    cases = {
+        'cdhw': (partial(run, CDHW_METRICS), CDHW_METRICS, 'mask'),
+        'mean_temp': (partial(run, MEAN_TEMP_METRICS), MEAN_TEMP_METRICS, 'mask'),
+        'precip': (partial(run, PRECIP_METRICS), PRECIP_METRICS, 'mask'),
+        'all_metrics': (partial(run, ALL_METRICS), ALL_METRICS, 'mask'),
+        'cdhw_compact': (partial(run, CDHW_METRICS, compact=True), CDHW_METRICS, 'mask'),
+        'cdhw_banded': (partial(run, CDHW_METRICS, memory_budget_mb=memory_budget_mb), CDHW_METRICS, 'mask'),
+        'cdhw_overlap': (partial(run, CDHW_METRICS, region_weights='overlap'), CDHW_METRICS, 'overlap'),
+        'cdhw_spells': (partial(run, SPELL_METRICS), SPELL_METRICS, 'mask'),
+        'cdhw_cropland': (partial(run, CDHW_METRICS, cropland_only=True), CDHW_METRICS, 'mask'),
+        'all_metrics_cropland': (partial(run, ALL_METRICS, cropland_only=True), ALL_METRICS, 'mask'),
+        'cdhw_day': (partial(run, CDHW_METRICS, growing_season='day'), CDHW_METRICS, 'day'),
+        'all_metrics_day': (partial(run, ALL_METRICS, growing_season='day'), ALL_METRICS, 'day'),
+        'cdhw_spells_day': (partial(run, SPELL_METRICS, growing_season='day'), SPELL_METRICS, 'day'),
+        'cdhw_banded_day': (partial(run, CDHW_METRICS, memory_budget_mb=memory_budget_mb, growing_season='day'),
+                            CDHW_METRICS, 'day'),
+        'all_metrics_cropland_day': (partial(run, ALL_METRICS, cropland_only=True, growing_season='day'),
+                                     ALL_METRICS, 'day'),
+    }
+
+    sweep = partial(sweep_year, tmax_thresholds_c=SWEEP_TMAX_C, spei_thresholds=SWEEP_SPEI,
+                    static_files=static_files)
+    year_sources = catalog_years({'tmax': sources['tmax']})
+    cases['cdhw_sweep'] = (lambda: sweep_as_cdhw(pd.concat(run_years(sweep, year_sources, static_files, cache_dir,
+                                                                     spei_file))),
+                           CDHW_METRICS, 'mask')
+    sweep_cropland = partial(sweep, cropland_only=True)
+    cases['cdhw_sweep_cropland'] = (lambda: sweep_as_cdhw(pd.concat(run_years(sweep_cropland, year_sources,
+                                                                              static_files, cache_dir, spei_file))),
+                                    CDHW_METRICS, 'mask')
+    if workers > 1:
+        cases['all_metrics_workers'] = (partial(run, ALL_METRICS, workers=workers), ALL_METRICS, 'mask')
+    return cases
+
+
+def run_benchmark(workdir, resolution=0.5, n_years=1, start_year=2001, seed=0, packed=False, compress=False,
+                  repeat=3, memory_budget_mb=DEFAULT_MEMORY_BUDGET_MB, workers=1, cases=None, check=True):
+    """Generates (or reuses) synthetic inputs in `workdir`, times every case and returns the report dict.
+
+    The working directory is changed to `workdir` while the cases run, so
+    paths relative to data/ in the scripts (such as the static cache of the
+    threshold sweep) land next to the synthetic inputs.
+    """
+    start = time.perf_counter()
+    paths = generate_inputs(workdir, resolution, range(start_year, start_year + n_years), seed, packed, compress)
+    generate_seconds = time.perf_counter() - start
+
+    template = open_variable(paths['sources']['tmax'][0]).isel(time=0, drop=True)
+    n_days = sum(open_variable(path).sizes['time'] for path in paths['sources']['tmax'])
+    cell_days = template.sizes['lat'] * template.sizes['lon'] * n_days
+    cache_dir = os.path.join(os.path.dirname(paths['spei']), "static_cache")
+
+    report = {
+        'version': REPORT_VERSION,
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'git': git_revision(),
+        'machine': machine_info(),
+        'params': {'resolution': resolution, 'years': n_years, 'seed': seed, 'packed': packed,
+                   'compress': compress, 'repeat': repeat, 'memory_budget_mb': memory_budget_mb,
+                   'workers': workers},
+        'grid': {'lat': template.sizes['lat'], 'lon': template.sizes['lon'], 'days': n_days},
+        'generate_seconds': generate_seconds,
+        'cases': {},
+    }
+
+    previous_dir = os.getcwd()
+    os.chdir(workdir)
+    try:
+        # Cold builds of the cached inputs: clear the caches before every run
+        def cold_static():
+            static_inputs._loaded_bundles.clear()
+            for name in os.listdir(cache_dir) if os.path.isdir(cache_dir) else []:
+                if name.startswith('static_inputs_'):
+                    path = os.path.join(cache_dir, name)
+                    if os.path.isfile(path):
+                        os.remove(path)
+            return load_static_inputs(template, *paths['static_files'], cache_dir)
+
+        print("Timing static inputs (cold build)...")
+        report['cases']['static_inputs'], static = measure(cold_static, repeat)
+
+        def cold_region_weights():
+            region_weights._loaded_weights.clear()
+            key = region_weights.region_weights_key(static.lat.values, static.lon.values, paths['static_files'][2])
+            path = os.path.join(cache_dir, f"region_weights_{key}.npz")
+            if os.path.exists(path):
+                os.remove(path)
+            return load_region_fractions(static.lat.values, static.lon.values, paths['static_files'][2], cache_dir)
+
+        print("Timing fractional region weights (cold build)...")
+        report['cases']['region_weights'], (fractions, _) = measure(cold_region_weights, repeat)
+
+        references = {}
+        if check:
+            year_sources = catalog_years(paths['sources'])
+            print("Running the reference loop...")
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                references['mask'] = reference_metrics(year_sources, paths['spei'], static, REFERENCE_METRICS)
+                references['overlap'] = reference_metrics(year_sources, paths['spei'], static, CDHW_METRICS,
+                                                          fractions)
+                references['day'] = reference_metrics(year_sources, paths['spei'], static, REFERENCE_METRICS,
+                                                      growing_season='day')
+            report['reference_seconds'] = time.perf_counter() - start
+            # The 'day' cases only test seasons across the new year if cropland has some
+            cropped = np.nan_to_num(static['area_weights'].values) > 0
+            report['wrapping_season_cells'] = int((cropped & (static['gs_start_day'].values >
+                                                              static['gs_end_day'].values)).sum())
+            report['checks'] = component_checks(paths, static, fractions, cache_dir, workdir)
+
+        for name, (func, metrics, reference) in engine_cases(paths, memory_budget_mb, workers).items():
+            if cases and name not in cases:
+                continue
+            print(f"Timing {name}...")
+            result, df = measure(func, repeat)
+            if name.endswith('_workers'):
+                result['peak_mb'] = None
+            result['cell_days_per_second'] = cell_days / result['seconds']
+            if check:
+                result['check'] = compare_results(df, references[reference], [m.name for m in metrics])
+            report['cases'][name] = result
+    finally:
+        os.chdir(previous_dir)
+    return report
+
+
+def print_report(report, baseline=None):
+    """Prints the timings, peak memory and checks, with speedups against a `baseline` report."""
+    print(f"\nGrid {report['grid']['lat']}x{report['grid']['lon']}, {report['grid']['days']} days, "
+          f"commit {(report['git'] or {}).get('commit', 'unknown')[:10]}")
+    if baseline is not None:
+        print(f"Baseline: commit {(baseline.get('git') or {}).get('commit', 'unknown')[:10]}")
+        if baseline.get('params') != report['params'] or baseline.get('grid') != report['grid']:
+            print("Warning: the baseline was run with different parameters")
+    print(f"{'case':<26}{'seconds':>10}{'peak MB':>10}{'speedup':>10}  check")
+    for name, case in report['cases'].items():
+        peak = f"{case['peak_mb']:.1f}" if case.get('peak_mb') is not None else "-"
+        speedup = "-"
+        if baseline is not None and name in baseline.get('cases', {}):
+            speedup = f"{baseline['cases'][name]['seconds'] / case['seconds']:.2f}x"
+        check = case.get('check', {}).get('status', '-')
+        print(f"{name:<26}{case['seconds']:>10.3f}{peak:>10}{speedup:>10}  {check}")
+    if report.get('wrapping_season_cells') == 0:
+        print("Warning: no cropland cell has a growing season across the new year")
+    for name, check in report.get('checks', {}).items():
+        print(f"check {name:<20}{check['status']:>10}")
+        for failure in check['failures']:
+            print(f"  {failure}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the metric engine on synthetic inputs and check it "
+                                                 "against a reference loop.")
+    parser.add_argument("--resolution", type=float, default=0.5, metavar="DEG",
+                        help="resolution of the daily grids, e.g. 0.5, 0.25 or 0.1 (default: %(default)s)")
+    parser.add_argument("--years", type=int, default=1, help="number of years (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the inputs (default: %(default)s)")
+    parser.add_argument("--packed", action="store_true", help="store Tmax as packed int16")
+    parser.add_argument("--compress", action="store_true", help="zlib-compress the daily files")
+    parser.add_argument("--workdir", default=None,
+                        help="directory for the synthetic inputs, reused between runs with the same settings "
+                             "(default: a temporary directory)")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per case (default: %(default)s)")
+    parser.add_argument("--memory-budget", type=float, default=DEFAULT_MEMORY_BUDGET_MB, metavar="MB",
+                        help="memory budget of the banded case (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="also time all metrics with this many worker processes (default: %(default)s)")
+    parser.add_argument("--cases", nargs="+", default=None, help="only run these engine cases")
+    parser.add_argument("--no-check", action="store_true",
+                        help="skip the comparison with the reference loop and the component checks")
+    parser.add_argument("--report", default="benchmark_report.json",
+                        help="JSON report to write (default: %(default)s)")
+    parser.add_argument("--compare", default=None, metavar="JSON",
+                        help="earlier report to show speedups against")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        report = run_benchmark(os.path.abspath(args.workdir or tmp_dir), args.resolution, args.years,
+                               seed=args.seed, packed=args.packed, compress=args.compress, repeat=args.repeat,
+                               memory_budget_mb=args.memory_budget, workers=args.workers, cases=args.cases,
+                               check=not args.no_check)
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    print(f"\nReport written to {args.report}")
+    checks = [case.get('check', {}) for case in report['cases'].values()] + list(report.get('checks', {}).values())
+    if any(check.get('status') == 'mismatch' for check in checks):
+        sys.exit(1)
@@ -0,0 +1,128 @@
+import argparse
+import glob
+import os
+
+import config
+from calculate_cdhw import CDHW_METRICS, CDHW_SPELL_METRICS, SPEI_FILE, TMAX_FILES_PATTERN
+from calculate_country_mean_temp import MEAN_TEMP_METRICS, TEMP_FILES_PATTERN
+from calculate_country_precipitation import PRECIP_FILES_PATTERN, PRECIP_METRICS
+from grid_store import write_parquet
+from metric_engine import GROWING_SEASONS, REGION_WEIGHTS, regions_suffix, run_metrics
+import profiling
+from parallel import PREFETCH_DEPTH, default_workers
+from regrid import REGRID_METHODS, TARGET_RESOLUTION
+
+MAIZE_AREA_FILE = config.MaizeAreaPath
+STATIC_FILES = (MAIZE_AREA_FILE, config.GrowingSeasonPath, config.COUNTRIES_SHP_FILE)
+# 静态输入缓存，与其他脚本共享
+STATIC_CACHE_DIR = os.path.join(os.path.dirname(MAIZE_AREA_FILE), "static_cache")
+OUTPUT_FILE = os.path.join(config.results_path, "country_annual_metrics.csv")
+# 逐年结果检查点：再次运行时只处理新增或变化的年份
+CHECKPOINT_DIR = os.path.join(os.path.dirname(MAIZE_AREA_FILE), "checkpoints", "all_metrics")
+# --profile json 的各阶段耗时报告
+PROFILE_FILE = os.path.join(os.path.dirname(MAIZE_AREA_FILE), "all_metrics_profile.json")
+
+def calculate_all_metrics(workers=1, memory_budget_mb=None, compact=False, tmax_pattern=TMAX_FILES_PATTERN,
+                          resume=True, regrid=None, regions_file=config.COUNTRIES_SHP_FILE, region_weights='mask',
+                          grid_store=None, parquet_dir=None, spells=False, cropland_only=False, years=None,
+                          prefetch=PREFETCH_DEPTH, growing_season='month'):
+    """
+    一次读取同时计算 CDHW 天数、生长季平均温度和生长季降雨总量，各选项见 parse_args
+
+    结果与三个单独脚本相同，但国家代码统一使用默认 ISO3 字段，不过滤 "-99"。
+    """
+    print("--- 开始融合计算 CDHW、平均温度和降雨总量 ---")
+
+    sources = {
+        'tmax': sorted(glob.glob(tmax_pattern)),
+        'temp': sorted(glob.glob(TEMP_FILES_PATTERN)),
+        'precip': sorted(glob.glob(PRECIP_FILES_PATTERN)),
+    }
+    for variable, files in sources.items():
+        print(f"找到 {len(files)} 个 {variable} 文件")
+
+    metrics = CDHW_METRICS + (CDHW_SPELL_METRICS if spells else []) + MEAN_TEMP_METRICS + PRECIP_METRICS
+    static_files = STATIC_FILES[:2] + (regions_file,)
+    suffix = regions_suffix(regions_file, config.COUNTRIES_SHP_FILE)
+    if growing_season != 'month':
+        suffix += f"_gs{growing_season}"
+    final_df = run_metrics(metrics, sources, static_files, STATIC_CACHE_DIR, spei_file=SPEI_FILE,
+                           workers=workers, memory_budget_mb=memory_budget_mb, compact=compact,
+                           checkpoint_dir=CHECKPOINT_DIR + suffix, resume=resume, regrid=regrid,
+                           region_weights=region_weights, grid_store=grid_store,
+                           cropland_only=cropland_only, years=years, prefetch=prefetch,
+                           growing_season=growing_season)
+
+    print("--- 整理最终结果 ---")
+    final_df = final_df.dropna(how='all', subset=[m.name for m in metrics])
+    final_df.sort_values(['year', 'country'], inplace=True)
+
+    # 创建输出目录
+    if not os.path.exists(config.results_path):
+        os.makedirs(config.results_path)
+
+    output_file = os.path.splitext(OUTPUT_FILE)[0] + suffix + ".csv"
+    final_df.to_csv(output_file, index=False)
+    if parquet_dir:
+        write_parquet(final_df, parquet_dir)
+
+    print("--- 计算完成 ---")
+    print(f"结果已保存到 {output_file}")
+    print(final_df.head(10))
+
+def parse_args(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="一次读取计算每个国家每年的 CDHW 天数、生长季平均温度和降雨总量")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="并行进程数，每年一个任务（0 表示使用全部核心）")
+    parser.add_argument("--memory-budget", type=float, default=None, metavar="MB",
+                        help="按约 MB 大小的纬度带分块读取每年的数据")
+    parser.add_argument("--compact", action="store_true",
+                        help="打包存储的 Tmax 保持原始整数形式，逐日掩码按位打包")
+    parser.add_argument("--tmax-pattern", default=TMAX_FILES_PATTERN,
+                        help="逐日 Tmax 文件的 glob 模式（默认: %(default)s）")
+    parser.add_argument("--years", type=int, nargs=2, default=None, metavar=("FIRST", "LAST"),
+                        help="只计算这些年份，输入文件按缓存的元数据索引选取")
+    parser.add_argument("--prefetch", type=int, default=PREFETCH_DEPTH, metavar="N",
+                        help="单进程运行时在后台线程中预读并解码的后续年份数，读取与计算重叠；"
+                             "每年多占用一年输入的内存（0 表示关闭，默认: %(default)s；--regrid 和 --memory-budget 时不预读）")
+    parser.add_argument("--growing-season", choices=GROWING_SEASONS, default='month',
+                        help="month: 生长季取播种和收获所在的整月；day: 只取精确的播种日至收获日（默认: %(default)s）")
+    parser.add_argument("--regrid", choices=REGRID_METHODS, default=None,
+                        help="按此方法将所有输入即时重采样到统一网格")
+    parser.add_argument("--regrid-resolution", type=float, default=TARGET_RESOLUTION, metavar="DEG",
+                        help="--regrid 的目标分辨率（默认: %(default)s）")
+    parser.add_argument("--regions", default=config.COUNTRIES_SHP_FILE, metavar="SHP",
+                        help="汇总所用的区域边界，例如省级 admin-1 shapefile（默认: %(default)s）")
+    parser.add_argument("--region-weights", choices=REGION_WEIGHTS, default='mask',
+                        help="mask: 每个网格只属于一个区域；overlap: 边界网格按面积比例分配给各区域（默认: %(default)s）")
+    parser.add_argument("--force", action="store_true",
+                        help="忽略已有检查点，重新计算所有年份")
+    parser.add_argument("--grid-output", default=None, metavar="STORE",
+                        help="同时保存逐网格年度指标和所用权重（.zarr 为 Zarr，否则为 NetCDF），可用 grid_store.py 重新汇总")
+    parser.add_argument("--parquet", default=None, metavar="DIR",
+                        help="同时写出按年份分区的 Parquet 数据集")
+    parser.add_argument("--cropland-only", action="store_true",
+                        help="只计算有玉米面积的网格：读取后即压缩为一维（时间, 网格）数组，国家结果不变")
+    parser.add_argument("--spells", action="store_true",
+                        help="同时统计 CDHW 事件次数、最长连续 CDHW 天数和首次发生日（跨年份连续计算）")
+    parser.add_argument("--profile", choices=profiling.PROFILE_MODES, default='off',
+                        help="记录各阶段耗时、CPU 时间、峰值内存和数组大小：summary 打印汇总表，json/jsonl 写出报告（默认: %(default)s）")
+    parser.add_argument("--profile-file", default=PROFILE_FILE, metavar="PATH",
+                        help="--profile json/jsonl 的报告文件（默认: %(default)s，jsonl 时扩展名为 .jsonl）")
+    return parser.parse_args(argv)
+
+def run(args):
+    """按 parse_args 的选项运行计算"""
+    profiling.configure(args.profile, profiling.report_path(args.profile_file, args.profile))
+    calculate_all_metrics(workers=args.workers or default_workers(), memory_budget_mb=args.memory_budget,
+                          compact=args.compact, tmax_pattern=args.tmax_pattern,
+                          resume=not args.force,
+                          regrid=(args.regrid, args.regrid_resolution) if args.regrid else None,
+                          regions_file=args.regions, region_weights=args.region_weights,
+                          grid_store=args.grid_output, parquet_dir=args.parquet, spells=args.spells,
+                          cropland_only=args.cropland_only, years=args.years,
+                          prefetch=args.prefetch, growing_season=args.growing_season)
+    profiling.finish()
+
+if __name__ == "__main__":
+    run(parse_args())
@@ -1,179 +1,358 @@
 import pandas as pd
 import xarray as xr
 import numpy as np
-import rioxarray
+import argparse
 import glob
 import os
-import geopandas as gpd
-import regionmask
+from functools import partial
+
+from metric_engine import (GROWING_SEASONS, REGION_WEIGHTS, catalog_years, growing_season_by_month, load_year,
+                           longest_spell, month_blocks, region_means, regions_suffix, run_metrics, run_years,
+                           spell_count, spell_onset, spei_for_months, spei_on_grid, threshold_count,
+                           thresholds_in_units, values_for_thresholds)
+import data_layout
+import profiling
+from fused_counts import season_days
+from grid_store import write_parquet
+from input_catalog import CATALOG_FILE
+from parallel import PREFETCH_DEPTH, default_workers
+from regrid import REGRID_METHODS, TARGET_RESOLUTION
+from spei_engine import gridded_spei
+from static_inputs import load_static_inputs, region_labels
+from threshold_sweep import annual_exceedance_counts, exceedance_bins, threshold_values
 
 # --- Configuration ---
-DATA_DIR = "data"
-TMAX_FILES_PATTERN = os.path.join(DATA_DIR, "MaxTemp_Merged_0.5deg", "ERA5_MaxTemp_*_0.5deg.nc")
-SPEI_FILE = os.path.join(DATA_DIR, "spei03.nc")
-MAIZE_AREA_FILE = os.path.join(DATA_DIR, "spam2000v3r7_harvested-area_MAIZ.tif")
-GROWING_SEASON_FILE = os.path.join(DATA_DIR, "global.maize.growing.season.csv")
-COUNTRIES_SHP_FILE = os.path.join(DATA_DIR, "ne_110m_admin_0_countries", "ne_110m_admin_0_countries.shp")
+DATA_DIR = data_layout.DATA_DIR
+TMAX_FILES_PATTERN = os.path.join(DATA_DIR, data_layout.TMAX_FILES)
+SPEI_FILE = os.path.join(DATA_DIR, data_layout.SPEI_FILE)
+# Daily precipitation and mean temperature, for SPEI computed at other scales (--spei-scale)
+PRECIP_FILES_PATTERN = os.path.join(DATA_DIR, data_layout.PRECIP_DIR, "*.nc")
+TEMP_FILES_PATTERN = os.path.join(DATA_DIR, data_layout.TEMP_DIR, "*.nc")
+MAIZE_AREA_FILE = os.path.join(DATA_DIR, data_layout.MAIZE_AREA_FILE)
+GROWING_SEASON_FILE = os.path.join(DATA_DIR, data_layout.GROWING_SEASON_FILE)
+COUNTRIES_SHP_FILE = os.path.join(DATA_DIR, data_layout.COUNTRIES_SHP_FILE)
 OUTPUT_FILE = os.path.join(DATA_DIR, "cdhw_country_annual_summary_AgERA5.csv")
+SWEEP_OUTPUT_FILE = os.path.join(DATA_DIR, "cdhw_country_threshold_sweep_AgERA5.csv")
+# Aligned area weights, country mask and growing-season months, shared by all scripts
+STATIC_CACHE_DIR = os.path.join(DATA_DIR, "static_cache")
+STATIC_FILES = (MAIZE_AREA_FILE, GROWING_SEASON_FILE, COUNTRIES_SHP_FILE)
+# Per-year results of earlier runs, so reruns only process new or changed years
+CHECKPOINT_DIR = os.path.join(DATA_DIR, "checkpoints", "cdhw")
+SWEEP_CHECKPOINT_DIR = os.path.join(DATA_DIR, "checkpoints", "cdhw_sweep")
+# Stage timings of --profile json
+PROFILE_FILE = os.path.join(DATA_DIR, "cdhw_profile.json")
+
+
+def set_data_dir(data_dir):
+    """Moves every path of the configuration above from DATA_DIR to `data_dir`; call before parse_args/main."""
+    global DATA_DIR, TMAX_FILES_PATTERN, SPEI_FILE, PRECIP_FILES_PATTERN, TEMP_FILES_PATTERN, MAIZE_AREA_FILE, \
+        GROWING_SEASON_FILE, COUNTRIES_SHP_FILE, OUTPUT_FILE, SWEEP_OUTPUT_FILE, STATIC_CACHE_DIR, STATIC_FILES, \
+        CHECKPOINT_DIR, SWEEP_CHECKPOINT_DIR, PROFILE_FILE
+
+    def moved(path):
+        return os.path.join(data_dir, os.path.relpath(path, DATA_DIR))
+
+    TMAX_FILES_PATTERN, SPEI_FILE, PRECIP_FILES_PATTERN, TEMP_FILES_PATTERN, OUTPUT_FILE, SWEEP_OUTPUT_FILE = map(
+        moved, (TMAX_FILES_PATTERN, SPEI_FILE, PRECIP_FILES_PATTERN, TEMP_FILES_PATTERN, OUTPUT_FILE,
+                SWEEP_OUTPUT_FILE))
+    MAIZE_AREA_FILE, GROWING_SEASON_FILE, COUNTRIES_SHP_FILE = map(moved, STATIC_FILES)
+    STATIC_FILES = (MAIZE_AREA_FILE, GROWING_SEASON_FILE, COUNTRIES_SHP_FILE)
+    STATIC_CACHE_DIR, CHECKPOINT_DIR, SWEEP_CHECKPOINT_DIR, PROFILE_FILE = map(
+        moved, (STATIC_CACHE_DIR, CHECKPOINT_DIR, SWEEP_CHECKPOINT_DIR, PROFILE_FILE))
+    DATA_DIR = data_dir
+
+
+def set_config(config):
+    """Takes the maize area, growing season, regions and daily mean temperature and precipitation from a config
+    module (see `data_layout.load_config`), with the static cache next to the maize area as in the other scripts.
+    Tmax, SPEI, outputs and checkpoints stay under DATA_DIR; call after set_data_dir, before parse_args/main."""
+    global PRECIP_FILES_PATTERN, TEMP_FILES_PATTERN, MAIZE_AREA_FILE, GROWING_SEASON_FILE, COUNTRIES_SHP_FILE, \
+        STATIC_CACHE_DIR, STATIC_FILES
+
+    PRECIP_FILES_PATTERN = os.path.join(config.PrecipitationPath, "*.nc")
+    TEMP_FILES_PATTERN = os.path.join(config.MeanTempPath, "*.nc")
+    MAIZE_AREA_FILE, GROWING_SEASON_FILE, COUNTRIES_SHP_FILE = (config.MaizeAreaPath, config.GrowingSeasonPath,
+                                                                config.COUNTRIES_SHP_FILE)
+    STATIC_FILES = (MAIZE_AREA_FILE, GROWING_SEASON_FILE, COUNTRIES_SHP_FILE)
+    STATIC_CACHE_DIR = os.path.join(os.path.dirname(MAIZE_AREA_FILE), "static_cache")
 
 # Thresholds
 T_THRESH_C_29 = 29.0
 T_THRESH_C_30 = 30.0
 SPEI_THRESH = -1.0
 
+# Default threshold sweep: Tmax from 25 to 40 degC in 0.5 degC steps, several SPEI cutoffs
+SWEEP_TMAX_C = (25.0, 40.0, 0.5)
+SWEEP_SPEI = [-1.0, -1.5, -2.0]
+
 # Convert Celsius to Kelvin
 T_THRESH_K_29 = T_THRESH_C_29 + 273.15
 T_THRESH_K_30 = T_THRESH_C_30 + 273.15
 
-def create_growing_season_mask_vectorized(times, da_start, da_end):
-    months = times.dt.month
-    mask1 = (months >= da_start) & (months <= da_end)
-    mask2 = (months >= da_start) | (months <= da_end)
-    return xr.where(da_start <= da_end, mask1, mask2)
-
-def process_chunk(tmax_file, ds_spei, da_area, df_gs, countries):
-    """Processes a single Tmax file using a robust, explicit loop for aggregation."""
-    print(f"--- Processing file: {tmax_file} ---")
-
-    # 1. Data Loading and Alignment (same as before)
-    ds_tmax = xr.open_dataset(tmax_file)
-    # obtain the variable name list from nc dataset 
-    variables = list(ds_tmax.data_vars) 
-    # rename the first variable to 'tmax'
-    ds_tmax = ds_tmax.rename({variables[0]: 'tmax'})
-    ds_tmax.rio.write_crs("EPSG:4326", inplace=True)
-
-    ds_spei_aligned = ds_spei.interp_like(ds_tmax, method='nearest')
-    da_area_aligned = da_area.rio.reproject_match(ds_tmax.tmax)
-    da_area_aligned = da_area_aligned.rename({'y': 'lat', 'x': 'lon'})
-    
-    spei_daily = ds_spei_aligned['spei'].resample(time='1D').ffill()
-
-    min_time = ds_tmax.time.min().values
-    max_time = ds_tmax.time.max().values
-    ds_tmax_aligned = ds_tmax.sel(time=slice(min_time, max_time))
-    spei_daily_aligned = spei_daily.sel(time=slice(min_time, max_time))
-
-    # 2. Mask Creation (same as before)
-    ds_gs = df_gs.set_index(['Latitude', 'Longitude']).to_xarray()
-    ds_gs = ds_gs.rename({'Latitude': 'lat', 'Longitude': 'lon'})
-    ds_gs_aligned = ds_gs.reindex_like(ds_tmax_aligned.isel(time=0, drop=True), method='nearest')
-    
-    def get_month_from_day_of_year(da):
-        original_shape = da.shape
-        flat_values = da.values.flatten()
-        with np.errstate(invalid='ignore'):
-            flat_months = pd.to_datetime(flat_values, format='%j', errors='coerce').month
-        return np.reshape(flat_months, original_shape)
-
-    start_month_2d = get_month_from_day_of_year(ds_gs_aligned['plant.start.day'])
-    end_month_2d = get_month_from_day_of_year(ds_gs_aligned['harvest.end.day'])
-
-    start_month_da = xr.DataArray(start_month_2d, coords=ds_gs_aligned.coords, dims=ds_gs_aligned.dims)
-    end_month_da = xr.DataArray(end_month_2d, coords=ds_gs_aligned.coords, dims=ds_gs_aligned.dims)
-
-    gs_mask = create_growing_season_mask_vectorized(ds_tmax_aligned.time, start_month_da, end_month_da)
-    country_mask = regionmask.mask_geopandas(countries, ds_tmax_aligned.lon, ds_tmax_aligned.lat)
-
-    # 3. CDHW Day Calculation (same as before)
-    drought_mask = (spei_daily_aligned < SPEI_THRESH)
-    heatwave_mask_29 = (ds_tmax_aligned['tmax'] > T_THRESH_K_29)
-    cdhw_days_29 = heatwave_mask_29 & drought_mask & gs_mask
-
-    heatwave_mask_30 = (ds_tmax_aligned['tmax'] > T_THRESH_K_30)
-    cdhw_days_30 = heatwave_mask_30 & drought_mask & gs_mask
-
-    annual_cdhw_29 = cdhw_days_29.groupby('time.year').sum(dim='time', dtype='int16')
-    annual_cdhw_30 = cdhw_days_30.groupby('time.year').sum(dim='time', dtype='int16')
-
-    area_weights = da_area_aligned.fillna(0).where(da_area_aligned > 0, 0)
-
-    # 4. ROBUST AGGREGATION WITH EXPLICIT LOOPS
-    print("Loading chunk data into memory for robust aggregation...")
-    annual_cdhw_29.load()
-    annual_cdhw_30.load()
-    area_weights.load()
-    country_mask.load()
-
-    results_list = []
-    regions = np.unique(country_mask.values)
-    regions = regions[~np.isnan(regions)]
-    country_name_map = {i: countries.iloc[i]['ADMIN'] for i in range(len(countries))}
-    # 尝试获取 ISO3 代码字段，常见列名依次为 'ADM0_A3', 'ISO_A3', 'ISO_A3_EH'
-    possible_iso_cols = [col for col in ['ADM0_A3', 'ISO_A3', 'ISO_A3_EH'] if col in countries.columns]
-    iso_col = possible_iso_cols[0] if possible_iso_cols else None
-    if iso_col is None:
-        raise ValueError("No ISO3 column found in countries shapefile. Available columns: %s" % list(countries.columns))
-    country_iso_map = {i: countries.iloc[i][iso_col] for i in range(len(countries))}
-
-    for year_val in annual_cdhw_29.year.values:
-        print(f"  Aggregating for year {year_val}...")
-        for region_idx in regions:
-            region_bool_mask = (country_mask == region_idx)
-            
-            cdhw29_year = annual_cdhw_29.sel(year=year_val)
-            cdhw30_year = annual_cdhw_30.sel(year=year_val)
-
-            country_weights = area_weights.where(region_bool_mask)
-            total_weight = country_weights.sum().item()
-            
-            if total_weight > 0:
-                country_cdhw29 = cdhw29_year.where(region_bool_mask)
-                weighted_sum_29 = (country_cdhw29 * country_weights).sum().item()
-                mean_29 = weighted_sum_29 / total_weight
-
-                country_cdhw30 = cdhw30_year.where(region_bool_mask)
-                weighted_sum_30 = (country_cdhw30 * country_weights).sum().item()
-                mean_30 = weighted_sum_30 / total_weight
+# Metrics of the summary table, computed by the fused engine in one pass over Tmax
+CDHW_METRICS = [
+    threshold_count('CDHW29_days', 'tmax', T_THRESH_K_29, spei_below=SPEI_THRESH),
+    threshold_count('CDHW30_days', 'tmax', T_THRESH_K_30, spei_below=SPEI_THRESH),
+]
+
+# Compound event structure of --spells: separate runs of consecutive CDHW days, the longest run
+# and the day of year of the first one, joined across file and year boundaries
+CDHW_SPELL_METRICS = [
+    spell_count('CDHW29_events', 'tmax', T_THRESH_K_29, spei_below=SPEI_THRESH),
+    longest_spell('CDHW29_longest_spell', 'tmax', T_THRESH_K_29, spei_below=SPEI_THRESH),
+    spell_onset('CDHW29_onset_doy', 'tmax', T_THRESH_K_29, spei_below=SPEI_THRESH),
+    spell_count('CDHW30_events', 'tmax', T_THRESH_K_30, spei_below=SPEI_THRESH),
+    longest_spell('CDHW30_longest_spell', 'tmax', T_THRESH_K_30, spei_below=SPEI_THRESH),
+    spell_onset('CDHW30_onset_doy', 'tmax', T_THRESH_K_30, spei_below=SPEI_THRESH),
+]
+
+def sweep_year(year, files, spei, tmax_thresholds_c, spei_thresholds, compact=False, regrid=None,
+               static_files=STATIC_FILES, region_weights='mask', cropland_only=False, growing_season='month'):
+    """CDHW days per country in one year for every combination of Tmax and SPEI thresholds.
+
+    Tmax is read and binned against all temperature thresholds once; each SPEI
+    cutoff then only needs one histogram of its qualified days. With
+    `cropland_only`, Tmax, the season masks and SPEI are gathered to the
+    cells with maize area before binning. `growing_season` 'day' limits the
+    season to the exact planting and harvest days of year. Returns a long table with one row
+    per year, country, SPEI threshold and Tmax threshold.
+    """
+    print(f"--- Sweeping thresholds for {year}: {files['tmax']} ---")
+    with profiling.stage('sweep_year', year=year):
+        with profiling.stage('read', variable='tmax', file=os.path.basename(files['tmax'])) as info:
+            tmax = load_year(files['tmax'], year, compact, regrid, STATIC_CACHE_DIR).load()
+            info['bytes'] = tmax.nbytes
+        n_time, n_lat, n_lon = tmax.shape
+        with profiling.stage('static_inputs'):
+            static = load_static_inputs(tmax.isel(time=0, drop=True), *static_files, STATIC_CACHE_DIR)
+        month_keys, blocks = month_blocks(tmax.time)
+        with profiling.stage('growing_season'):
+            if growing_season == 'day':
+                gs_values = np.ones((len(month_keys), n_lat, n_lon), dtype=bool)
             else:
-                mean_29 = np.nan
-                mean_30 = np.nan
-
-            results_list.append({
-                'year': year_val,
-                'country_code': int(region_idx),
-                'CDHW29_days': mean_29,
-                'CDHW30_days': mean_30,
-                'country_iso': country_iso_map[int(region_idx)]
-            })
-
-            print(f"{region_idx}: {country_name_map[region_idx]} ({country_iso_map[region_idx]})")
-
-    df = pd.DataFrame(results_list)
-    df['country'] = df['country_code'].map(country_name_map)
+                gs_values = growing_season_by_month(month_keys, static).values
+        with profiling.stage('spei'):
+            spei_monthly = spei_on_grid(spei_for_months(spei, month_keys), tmax.lat, tmax.lon)
+
+        values = tmax.values.reshape(n_time, -1)
+        gs_cells = gs_values.reshape(len(month_keys), -1)
+        spei_cells = spei_monthly.values.reshape(len(month_keys), -1)
+        season = None
+        if growing_season == 'day':
+            season = [static[name].transpose('lat', 'lon').values.ravel() for name in ('gs_start_day', 'gs_end_day')]
+        cells = None
+        if cropland_only:
+            cells = np.flatnonzero(static['area_weights'].transpose('lat', 'lon').values.ravel() > 0)
+            with profiling.stage('gather') as info:
+                values, gs_cells, spei_cells = values[:, cells], gs_cells[:, cells], spei_cells[:, cells]
+                season = None if season is None else [bound[cells] for bound in season]
+                info['bytes'] = values.nbytes
+        n_cells = values.shape[1]
+
+        tmax_thresholds_c = sorted(tmax_thresholds_c)
+        thresholds = thresholds_in_units(tmax, [t + 273.15 for t in tmax_thresholds_c])
+        with profiling.stage('bins') as info:
+            bins = exceedance_bins(values_for_thresholds(tmax, thresholds, values), thresholds)
+            info['bytes'] = bins.nbytes
+        year_index = np.zeros(n_time, dtype='int64')
+        day_of_year = tmax.time.dt.dayofyear.values
+
+        country_name_map, country_iso_map = region_labels(static)
+        coords = {'year': [year], 'lat': tmax.lat.values, 'lon': tmax.lon.values}
+        dfs = []
+        qualified = np.empty((n_time, n_cells), dtype=bool)
+        for spei_thresh in spei_thresholds:
+            with profiling.stage('count', spei_threshold=spei_thresh):
+                drought_monthly = spei_cells < spei_thresh
+                for i, block in enumerate(blocks):
+                    qualified[block] = gs_cells[i] & drought_monthly[i]
+                    if season is not None:
+                        qualified[block] &= season_days(day_of_year[block], *season)
+                counts = annual_exceedance_counts(bins, qualified, year_index, 1, len(thresholds))
+            with profiling.stage('region_means', spei_threshold=spei_thresh):
+                for j, tmax_thresh in enumerate(tmax_thresholds_c):
+                    annual = counts[:, j]
+                    if cells is not None:
+                        annual = np.zeros((1, n_lat * n_lon), dtype=counts.dtype)
+                        annual[:, cells] = counts[:, j]
+                    annual_cdhw = xr.DataArray(annual.reshape(1, n_lat, n_lon), coords=coords,
+                                               dims=('year', 'lat', 'lon'))
+                    df = region_means({'CDHW_days': annual_cdhw}, static, static_files[2], STATIC_CACHE_DIR,
+                                      region_weights)
+                    df.insert(1, 'spei_threshold', spei_thresh)
+                    df.insert(2, 'tmax_threshold_c', tmax_thresh)
+                    dfs.append(df)
+
+    df = pd.concat(dfs, ignore_index=True)
     df['country_iso'] = df['country_code'].map(country_iso_map)
+    df['country'] = df['country_code'].map(country_name_map)
     return df.drop(columns='country_code')
 
-def main():
-    """Main function to calculate CDHW by processing files one by one."""
-    print("--- Starting CDHW Calculation (Robust Aggregation) ---")
-
-    print("Step 1: Loading non-timeseries data...")
-    ds_spei = xr.open_dataset(SPEI_FILE).rename({'spei': 'spei'})
-    da_area = rioxarray.open_rasterio(MAIZE_AREA_FILE, masked=True).squeeze()
-    df_gs = pd.read_csv(GROWING_SEASON_FILE)
-    countries = gpd.read_file(COUNTRIES_SHP_FILE)
-
-    tmax_files = sorted(glob.glob(TMAX_FILES_PATTERN))
+def gridded_spei_file(scale, workers=1):
+    """SPEI over `scale` months computed from the daily precipitation and mean temperature, cached for reuse."""
+    precip_files = sorted(glob.glob(PRECIP_FILES_PATTERN))
+    temp_files = sorted(glob.glob(TEMP_FILES_PATTERN))
+    if not precip_files or not temp_files:
+        raise FileNotFoundError(f"No daily files to compute SPEI from: {PRECIP_FILES_PATTERN}, {TEMP_FILES_PATTERN}")
+    paths = gridded_spei(precip_files, temp_files, os.path.join(STATIC_CACHE_DIR, "spei"), [scale], workers=workers,
+                         catalog_file=os.path.join(STATIC_CACHE_DIR, CATALOG_FILE))
+    return paths[scale]
+
+def main(workers=1, memory_budget_mb=None, tmax_pattern=None,
+         tmax_thresholds_c=None, spei_thresholds=None, compact=False, resume=True, regrid=None,
+         regions_file=None, region_weights='mask', grid_store=None, parquet_dir=None, spells=False,
+         cropland_only=False, years=None, spei_scale=None, prefetch=PREFETCH_DEPTH, growing_season='month'):
+    """Main function to calculate CDHW, one year per task; the options are those of `parse_args`."""
+    tmax_pattern = tmax_pattern or TMAX_FILES_PATTERN
+    regions_file = regions_file or COUNTRIES_SHP_FILE
+    sweep = tmax_thresholds_c is not None
+    if sweep and memory_budget_mb:
+        raise ValueError("The threshold sweep is not available in streaming mode")
+    if sweep and grid_store:
+        raise ValueError("Gridded output is not available for the threshold sweep")
+    if sweep and spells:
+        raise ValueError("Spell statistics are not available for the threshold sweep")
+    print("--- Starting CDHW Calculation (Grouped Aggregation) ---")
+
+    tmax_files = sorted(glob.glob(tmax_pattern))
     if not tmax_files:
-        raise FileNotFoundError(f"No Tmax files found: {TMAX_FILES_PATTERN}")
-
-    all_results_dfs = []
-    for tmax_file in tmax_files:
-        chunk_df = process_chunk(tmax_file, ds_spei, da_area, df_gs, countries)
-        all_results_dfs.append(chunk_df)
+        raise FileNotFoundError(f"No Tmax files found: {tmax_pattern}")
+
+    static_files = (MAIZE_AREA_FILE, GROWING_SEASON_FILE, regions_file)
+    suffix = regions_suffix(regions_file, COUNTRIES_SHP_FILE)
+    spei_file = SPEI_FILE
+    if spei_scale:
+        spei_file = gridded_spei_file(spei_scale, workers)
+        # Own output and checkpoint names, so the tables of the SPEI file are kept
+        suffix += f"_spei{spei_scale:02d}"
+    if growing_season != 'month':
+        suffix += f"_gs{growing_season}"
+
+    if sweep:
+        task = partial(sweep_year, tmax_thresholds_c=tmax_thresholds_c, spei_thresholds=spei_thresholds,
+                       compact=compact, regrid=regrid, static_files=static_files, region_weights=region_weights,
+                       cropland_only=cropland_only, growing_season=growing_season)
+        config = {'task': 'sweep', 'tmax_thresholds_c': sorted(tmax_thresholds_c),
+                  'spei_thresholds': list(spei_thresholds), 'regrid': list(regrid) if regrid else None,
+                  'region_weights': region_weights}
+        if growing_season != 'month':
+            config['growing_season'] = growing_season
+        year_sources = catalog_years({'tmax': tmax_files}, years, spei_file,
+                                     os.path.join(STATIC_CACHE_DIR, CATALOG_FILE), workers)
+        all_results_dfs = run_years(task, year_sources, static_files, STATIC_CACHE_DIR,
+                                    spei_file, workers, SWEEP_CHECKPOINT_DIR + suffix, config, resume, regrid,
+                                    region_weights, prefetch, ['tmax'] if compact else [])
+        final_df = pd.concat(all_results_dfs)
+    else:
+        if memory_budget_mb:
+            print(f"Reading each year in blocks of about {memory_budget_mb} MB")
+        metrics = CDHW_METRICS + (CDHW_SPELL_METRICS if spells else [])
+        final_df = run_metrics(metrics, {'tmax': tmax_files}, static_files, STATIC_CACHE_DIR,
+                               spei_file=spei_file, workers=workers, memory_budget_mb=memory_budget_mb,
+                               compact=compact, checkpoint_dir=CHECKPOINT_DIR + suffix, resume=resume,
+                               regrid=regrid, region_weights=region_weights, grid_store=grid_store,
+                               cropland_only=cropland_only, years=years, prefetch=prefetch,
+                               growing_season=growing_season)
 
     print("--- Finalizing Results ---")
-    final_df = pd.concat(all_results_dfs).dropna()
+    # Regions without maize area; spell onsets stay NaN in years without events
+    final_df = final_df.dropna() if sweep else final_df.dropna(subset=[m.name for m in CDHW_METRICS])
+    output_file = os.path.splitext(SWEEP_OUTPUT_FILE if sweep else OUTPUT_FILE)[0] + suffix + ".csv"
     # 为方便合并，保持 iso3 代码列，同时按 year、country 排序
-    final_df.sort_values(['year', 'country'], inplace=True)
+    if sweep:
+        final_df.sort_values(['year', 'country', 'spei_threshold', 'tmax_threshold_c'], inplace=True)
+    else:
+        final_df.sort_values(['year', 'country'], inplace=True)
 
-    final_df.to_csv(OUTPUT_FILE, index=False)
+    final_df.to_csv(output_file, index=False)
+    if parquet_dir:
+        write_parquet(final_df, parquet_dir)
 
     print("--- Calculation Complete ---")
-    print(f"Results saved to {OUTPUT_FILE}")
+    print(f"Results saved to {output_file}")
     print("Sample of the final results:")
     print(final_df.head())
 
+def parse_args(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="Calculate country-level annual CDHW days.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes, one year per task (0 = all cores)")
+    parser.add_argument("--memory-budget", type=float, default=None, metavar="MB",
+                        help="read each year in latitude bands of about this many MB; "
+                             "use for native 0.1 degree or multi-year Tmax files")
+    parser.add_argument("--tmax-pattern", default=TMAX_FILES_PATTERN,
+                        help="glob pattern of the daily Tmax files (default: %(default)s)")
+    parser.add_argument("--years", type=int, nargs=2, default=None, metavar=("FIRST", "LAST"),
+                        help="only process these years; files are picked from the cached metadata index")
+    parser.add_argument("--prefetch", type=int, default=PREFETCH_DEPTH, metavar="N",
+                        help="in a single process, read and decode the next N years in a background thread "
+                             "while the current one is computed; each holds a year of input in memory "
+                             "(0 = off, default: %(default)s; ignored with --regrid and --memory-budget)")
+    parser.add_argument("--spei-scale", type=int, default=None, metavar="MONTHS",
+                        help="use SPEI over this many months computed from the daily precipitation and mean "
+                             "temperature (Thornthwaite PET, log-logistic fit) instead of the SPEI file; "
+                             "cached for reuse")
+    parser.add_argument("--growing-season", choices=GROWING_SEASONS, default='month',
+                        help="'month' counts the whole months of planting and harvest; 'day' only the days "
+                             "between the exact planting and harvest days of year (default: %(default)s)")
+    parser.add_argument("--sweep", action="store_true",
+                        help=f"write CDHW days for a grid of Tmax and SPEI thresholds to {SWEEP_OUTPUT_FILE}")
+    parser.add_argument("--sweep-tmax", type=float, nargs=3, default=SWEEP_TMAX_C, metavar=("START", "STOP", "STEP"),
+                        help="Tmax thresholds of the sweep in degC (default: %(default)s)")
+    parser.add_argument("--sweep-spei", type=float, nargs="+", default=SWEEP_SPEI,
+                        help="SPEI thresholds of the sweep (default: %(default)s)")
+    parser.add_argument("--compact", action="store_true",
+                        help="keep packed Tmax in its on-disk integer form and bit-pack the daily masks")
+    parser.add_argument("--regrid", choices=REGRID_METHODS, default=None,
+                        help="regrid native-resolution Tmax on the fly with this method "
+                             "instead of reading files pre-resampled with regrid.py")
+    parser.add_argument("--regrid-resolution", type=float, default=TARGET_RESOLUTION, metavar="DEG",
+                        help="target grid resolution for --regrid (default: %(default)s)")
+    parser.add_argument("--regions", default=COUNTRIES_SHP_FILE, metavar="SHP",
+                        help="polygons to aggregate to, e.g. an admin-1 shapefile (default: %(default)s)")
+    parser.add_argument("--region-weights", choices=REGION_WEIGHTS, default='mask',
+                        help="'mask' gives each cell to one region; 'overlap' shares boundary cells by area "
+                             "fraction, so regions smaller than a cell are not lost (default: %(default)s)")
+    parser.add_argument("--force", action="store_true",
+                        help="recompute every year instead of reusing the checkpoints of earlier runs")
+    parser.add_argument("--grid-output", default=None, metavar="STORE",
+                        help="also save the per-cell annual CDHW days and the weights used to a chunked, "
+                             "compressed store (.zarr for Zarr, otherwise NetCDF), for re-aggregation with "
+                             "grid_store.py")
+    parser.add_argument("--parquet", default=None, metavar="DIR",
+                        help="also write the results as a Parquet dataset partitioned by year")
+    parser.add_argument("--cropland-only", action="store_true",
+                        help="compute only the cells with maize area, gathered into 1-D (time, cell) arrays "
+                             "right after reading; same results, less time and memory on sparse cropland")
+    parser.add_argument("--spells", action="store_true",
+                        help="also count separate CDHW events, the longest run of consecutive CDHW days and the "
+                             "day of year of the first event, with runs joined across year boundaries")
+    parser.add_argument("--profile", choices=profiling.PROFILE_MODES, default='off',
+                        help="per-stage wall time, CPU time, peak RSS and array bytes: a summary table, "
+                             "a JSON report or JSON lines (default: %(default)s)")
+    parser.add_argument("--profile-file", default=PROFILE_FILE, metavar="PATH",
+                        help="report file of --profile json/jsonl (default: %(default)s, .jsonl for jsonl)")
+    args = parser.parse_args(argv)
+    if args.sweep and args.memory_budget:
+        parser.error("--sweep cannot be combined with --memory-budget")
+    if args.sweep and args.grid_output:
+        parser.error("--sweep cannot be combined with --grid-output")
+    if args.sweep and args.spells:
+        parser.error("--sweep cannot be combined with --spells")
+    return args
+
+def run(args):
+    """Runs the calculation with the options of `parse_args`."""
+    profiling.configure(args.profile, profiling.report_path(args.profile_file, args.profile))
+    main(workers=args.workers or default_workers(), memory_budget_mb=args.memory_budget,
+         tmax_pattern=args.tmax_pattern,
+         tmax_thresholds_c=threshold_values(*args.sweep_tmax) if args.sweep else None,
+         spei_thresholds=args.sweep_spei, compact=args.compact, resume=not args.force,
+         regrid=(args.regrid, args.regrid_resolution) if args.regrid else None,
+         regions_file=args.regions, region_weights=args.region_weights, grid_store=args.grid_output,
+         parquet_dir=args.parquet, spells=args.spells, cropland_only=args.cropland_only, years=args.years,
+         spei_scale=args.spei_scale, prefetch=args.prefetch, growing_season=args.growing_season)
+    profiling.finish()
+
 if __name__ == "__main__":
-    main()
+    run(parse_args())
@@ -1,160 +1,106 @@
 import pandas as pd
-import xarray as xr
-import numpy as np
-import rioxarray
+import argparse
 import glob
 import os
-import geopandas as gpd
-import regionmask
 
 import config
+from grid_store import write_parquet
+from metric_engine import GROWING_SEASONS, growing_season_mean, run_metrics
+import profiling
+from parallel import PREFETCH_DEPTH, default_workers
 
 # Thresholds and configuration
 TEMP_FILES_PATTERN = os.path.join(config.MeanTempPath, "*.nc")
 MAIZE_AREA_FILE = config.MaizeAreaPath
 GROWING_SEASON_FILE = config.GrowingSeasonPath
 COUNTRIES_SHP_FILE = config.COUNTRIES_SHP_FILE
+STATIC_FILES = (MAIZE_AREA_FILE, GROWING_SEASON_FILE, COUNTRIES_SHP_FILE)
+# 静态输入缓存（对齐后的面积权重、国家掩码、生长季月份），与其他脚本共享
+STATIC_CACHE_DIR = os.path.join(os.path.dirname(MAIZE_AREA_FILE), "static_cache")
+# 逐年结果检查点：再次运行时只处理新增或变化的年份
+CHECKPOINT_DIR = os.path.join(os.path.dirname(MAIZE_AREA_FILE), "checkpoints", "mean_temp")
+# --profile json 的各阶段耗时报告
+PROFILE_FILE = os.path.join(os.path.dirname(MAIZE_AREA_FILE), "mean_temp_profile.json")
 OUTPUT_FILE = os.path.join(config.results_path, "country_mean_temperature.csv")
 
-def create_growing_season_mask_vectorized(times, da_start, da_end):
-    """创建生长季节掩码的向量化函数"""
-    months = times.dt.month
-    mask1 = (months >= da_start) & (months <= da_end)
-    mask2 = (months >= da_start) | (months <= da_end)
-    return xr.where(da_start <= da_end, mask1, mask2)
+# 生长季平均温度：开尔文转换为摄氏度
+MEAN_TEMP_METRICS = [growing_season_mean('mean_temp', 'temp', offset=-273.15)]
 
-def get_month_from_day_of_year(da):
-    """将年积日转换为月份"""
-    original_shape = da.shape
-    flat_values = da.values.flatten()
-    with np.errstate(invalid='ignore'):
-        flat_months = pd.to_datetime(flat_values, format='%j', errors='coerce').month
-    return np.reshape(flat_months, original_shape)
-
-def process_temp_chunk(temp_file, da_area, df_gs, countries):
-    """处理单个温度文件，计算每个国家的面积加权平均温度"""
-    print(f"--- 正在处理文件: {temp_file} ---")
-
-    # 1. 数据加载和对齐
-    ds_temp = xr.open_dataset(temp_file)
-    # 获取变量名列表
-    variables = list(ds_temp.data_vars)
-    # 重命名第一个变量为 'temp'
-    ds_temp = ds_temp.rename({variables[0]: 'temp'})
-    ds_temp.rio.write_crs("EPSG:4326", inplace=True)
-
-    # 对齐面积数据
-    da_area_aligned = da_area.rio.reproject_match(ds_temp.temp)
-    da_area_aligned = da_area_aligned.rename({'y': 'lat', 'x': 'lon'})
-
-    # 2. 生长季节掩码创建
-    ds_gs = df_gs.set_index(['Latitude', 'Longitude']).to_xarray()
-    ds_gs = ds_gs.rename({'Latitude': 'lat', 'Longitude': 'lon'})
-    ds_gs_aligned = ds_gs.reindex_like(ds_temp.isel(time=0, drop=True), method='nearest')
-
-    start_month_2d = get_month_from_day_of_year(ds_gs_aligned['plant.start.day'])
-    end_month_2d = get_month_from_day_of_year(ds_gs_aligned['harvest.end.day'])
-
-    start_month_da = xr.DataArray(start_month_2d, coords=ds_gs_aligned.coords, dims=ds_gs_aligned.dims)
-    end_month_da = xr.DataArray(end_month_2d, coords=ds_gs_aligned.coords, dims=ds_gs_aligned.dims)
-
-    gs_mask = create_growing_season_mask_vectorized(ds_temp.time, start_month_da, end_month_da)
-    
-    # 创建国家掩码，使用 regionmask.from_geopandas 来确保索引一致性
-    country_regions = regionmask.from_geopandas(countries, names="ADMIN", abbrevs="ISO_A3")
-    country_mask = country_regions.mask(ds_temp.lon, ds_temp.lat)
-
-    # 3. 应用生长季节掩码到温度数据并转换为摄氏度
-    temp_gs = ds_temp['temp'].where(gs_mask)
-    # 将开尔文温度转换为摄氏度
-    temp_gs_celsius = temp_gs - 273.15
-
-    # 4. 按年份聚合温度数据
-    annual_temp_mean = temp_gs_celsius.groupby('time.year').mean(dim='time')
-
-    # 5. 面积权重
-    area_weights = da_area_aligned.fillna(0).where(da_area_aligned > 0, 0)
-
-    # 6. 稳健聚合：使用显式循环
-    print("将数据加载到内存中进行稳健聚合...")
-    annual_temp_mean.load()
-    area_weights.load()
-    country_mask.load()
-
-    results_list = []
-    regions = np.unique(country_mask.values)
-    regions = regions[~np.isnan(regions)]
-    
-    # 使用 regionmask 的映射来创建名称和ISO代码映射
-    country_name_map = dict(zip(country_regions.numbers, country_regions.names))
-    country_iso_map = dict(zip(country_regions.numbers, country_regions.abbrevs))
-
-    for year_val in annual_temp_mean.year.values:
-        print(f"  正在聚合 {year_val} 年数据...")
-        for region_idx in regions:
-            region_bool_mask = (country_mask == region_idx)
-            
-            temp_year = annual_temp_mean.sel(year=year_val)
-            country_weights = area_weights.where(region_bool_mask)
-            total_weight = country_weights.sum().item()
-            
-            if total_weight > 0:
-                country_temp = temp_year.where(region_bool_mask)
-                weighted_sum = (country_temp * country_weights).sum().item()
-                mean_temp = weighted_sum / total_weight
-            else:
-                mean_temp = np.nan
-
-            results_list.append({
-                'year': year_val,
-                'country_code': int(region_idx),
-                'mean_temp': mean_temp,
-                'country_iso': country_iso_map[int(region_idx)]
-            })
-
-    df = pd.DataFrame(results_list)
-    df['country'] = df['country_code'].map(country_name_map)
-    df['country_iso'] = df['country_code'].map(country_iso_map)
-    return df.drop(columns='country_code')
-
-def calculate_country_mean_temp():
+def calculate_country_mean_temp(workers=1, resume=True, grid_store=None, parquet_dir=None, cropland_only=False,
+                                years=None, prefetch=PREFETCH_DEPTH, growing_season='month'):
     """
     计算每个国家每年生长季节内的面积加权平均温度
     """
     print("--- 开始计算国家面积加权平均温度 ---")
 
-    print("步骤1: 加载非时间序列数据...")
-    da_area = rioxarray.open_rasterio(MAIZE_AREA_FILE, masked=True).squeeze()
-    df_gs = pd.read_csv(GROWING_SEASON_FILE)
-    countries = gpd.read_file(COUNTRIES_SHP_FILE)
-    countries = countries[countries.ISO_A3 != "-99"]  # 过滤无效国家
-
+    print("步骤1: 查找输入文件...")
     temp_files = sorted(glob.glob(TEMP_FILES_PATTERN))
     if not temp_files:
         raise FileNotFoundError(f"未找到温度文件: {TEMP_FILES_PATTERN}")
 
     print(f"找到 {len(temp_files)} 个温度文件")
 
-    all_results_dfs = []
-    for temp_file in temp_files:
-        chunk_df = process_temp_chunk(temp_file, da_area, df_gs, countries)
-        all_results_dfs.append(chunk_df)
+    # 由融合计算引擎逐年处理：静态输入每个网格只构建一次，多进程时以内存映射方式只读共享
+    final_df = run_metrics(MEAN_TEMP_METRICS, {'temp': temp_files}, STATIC_FILES, STATIC_CACHE_DIR,
+                           workers=workers, iso_col='ISO_A3', checkpoint_dir=CHECKPOINT_DIR, resume=resume,
+                           grid_store=grid_store, cropland_only=cropland_only, years=years,
+                           prefetch=prefetch, growing_season=growing_season)
 
     print("--- 整理最终结果 ---")
-    final_df = pd.concat(all_results_dfs).dropna()
+    final_df = final_df[final_df['country_iso'] != "-99"]  # 过滤无效国家
+    final_df = final_df.dropna()
     final_df.sort_values(['year', 'country'], inplace=True)
 
     # 创建输出目录
     if not os.path.exists(config.results_path):
         os.makedirs(config.results_path)
 
-    final_df.to_csv(OUTPUT_FILE, index=False)
+    output_file = OUTPUT_FILE
+    if growing_season != 'month':
+        output_file = os.path.splitext(OUTPUT_FILE)[0] + f"_gs{growing_season}.csv"
+    final_df.to_csv(output_file, index=False)
+    if parquet_dir:
+        write_parquet(final_df, parquet_dir)
 
     print("--- 计算完成 ---")
-    print(f"结果已保存到 {OUTPUT_FILE}")
+    print(f"结果已保存到 {output_file}")
     print("最终结果样本:")
     print(final_df.head(10))
     print(f"总共计算了 {len(final_df)} 条记录")
 
+def parse_args(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="计算每个国家每年生长季节内的面积加权平均温度")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="并行进程数，每年一个任务（0 表示使用全部核心）")
+    parser.add_argument("--years", type=int, nargs=2, default=None, metavar=("FIRST", "LAST"),
+                        help="只计算这些年份，输入文件按缓存的元数据索引选取")
+    parser.add_argument("--prefetch", type=int, default=PREFETCH_DEPTH, metavar="N",
+                        help="单进程运行时在后台线程中预读并解码的后续年份数，读取与计算重叠；"
+                             "每年多占用一年输入的内存（0 表示关闭，默认: %(default)s）")
+    parser.add_argument("--growing-season", choices=GROWING_SEASONS, default='month',
+                        help="month: 生长季取播种和收获所在的整月；day: 只取精确的播种日至收获日（默认: %(default)s）")
+    parser.add_argument("--force", action="store_true",
+                        help="忽略已有检查点，重新计算所有年份")
+    parser.add_argument("--grid-output", default=None, metavar="STORE",
+                        help="同时保存逐网格年度结果和所用权重（.zarr 为 Zarr，否则为 NetCDF），可用 grid_store.py 重新汇总")
+    parser.add_argument("--parquet", default=None, metavar="DIR",
+                        help="同时写出按年份分区的 Parquet 数据集")
+    parser.add_argument("--cropland-only", action="store_true",
+                        help="只计算有玉米面积的网格：读取后即压缩为一维（时间, 网格）数组，国家结果不变")
+    parser.add_argument("--profile", choices=profiling.PROFILE_MODES, default='off',
+                        help="记录各阶段耗时、CPU 时间、峰值内存和数组大小：summary 打印汇总表，json/jsonl 写出报告（默认: %(default)s）")
+    parser.add_argument("--profile-file", default=PROFILE_FILE, metavar="PATH",
+                        help="--profile json/jsonl 的报告文件（默认: %(default)s，jsonl 时扩展名为 .jsonl）")
+    return parser.parse_args(argv)
+
+def run(args):
+    """按 parse_args 的选项运行计算"""
+    profiling.configure(args.profile, profiling.report_path(args.profile_file, args.profile))
+    calculate_country_mean_temp(workers=args.workers or default_workers(), resume=not args.force,
+                                grid_store=args.grid_output, parquet_dir=args.parquet,
+                                cropland_only=args.cropland_only, years=args.years,
+                                prefetch=args.prefetch, growing_season=args.growing_season)
+    profiling.finish()
+
 if __name__ == "__main__":
-    calculate_country_mean_temp()
+    run(parse_args())
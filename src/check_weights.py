@@ -1,17 +1,18 @@
-import rioxarray
-import geopandas as gpd
-import regionmask
 import numpy as np
 
 MAIZE_AREA_FILE = "data/spam2000v3r7_harvested-area_MAIZ.tif"
 COUNTRIES_SHP_FILE = "data/ne_110m_admin_0_countries/ne_110m_admin_0_countries.shp"
 
-def check_weights():
+def check_weights(maize_area_file=MAIZE_AREA_FILE, countries_file=COUNTRIES_SHP_FILE):
+    import rioxarray
+    import geopandas as gpd
+    import regionmask
+
     print("--- Analyzing Maize Harvested Area Data ---")
     
     # Load data
-    da_area = rioxarray.open_rasterio(MAIZE_AREA_FILE, masked=True).squeeze()
-    countries = gpd.read_file(COUNTRIES_SHP_FILE)
+    da_area = rioxarray.open_rasterio(maize_area_file, masked=True).squeeze()
+    countries = gpd.read_file(countries_file)
     
     # Create a mask to assign grid cells to countries
     # 使用二维整数掩膜，索引值对应 countries DataFrame 的行号
@@ -51,5 +52,27 @@ def check_weights():
     for region_idx in countries_with_maize[dim_name].values:
         print(f" - {country_name_map.get(int(region_idx), 'Unknown')}")
 
+def check_static_weights(static):
+    """Same check on a static-input bundle, i.e. the aligned area weights and country mask the runs use.
+
+    Needs only the bundle, so a cached one is checked without geopandas or regionmask.
+    """
+    print("--- Analyzing the aligned maize area weights ---")
+    mask = static['country_mask'].values
+    weights = static['area_weights'].values
+    valid = ~np.isnan(mask) & (weights > 0)
+    positions = np.searchsorted(static['region'].values, mask[valid].astype('int64'))
+    n_regions = static.sizes['region']
+    total_area = np.bincount(positions, weights=weights[valid], minlength=n_regions)
+    n_cells = np.bincount(positions, minlength=n_regions)
+    names = static['region_name'].values
+
+    with_maize = np.flatnonzero(total_area > 0)
+    print(f"Found {len(with_maize)} countries with non-zero maize harvested area.")
+    print("----------------------------------------------------")
+    print("List of countries with maize data:")
+    for i in with_maize:
+        print(f" - {names[i]}: {n_cells[i]} cells, area weight {total_area[i]:.1f}")
+
 if __name__ == "__main__":
     check_weights()
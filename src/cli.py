@@ -0,0 +1,186 @@
+# Single entry point for the calculations and checks:
+#
+#     python cli.py [--data-dir DIR] [--config FILE] COMMAND [options]
+#
+# Only the standard library is imported up front; each command imports the
+# modules it needs when it runs, so --help and the checks start at once.
+# `python cli.py COMMAND --help` lists the options of a command.
+import argparse
+import os
+import sys
+
+import data_layout
+
+COMMANDS = {
+    'cdhw': "country-level annual CDHW days (calculate_cdhw.py)",
+    'mean-temp': "growing-season mean temperature per country (calculate_country_mean_temp.py)",
+    'precip': "growing-season precipitation total per country (calculate_country_precipitation.py)",
+    'all-metrics': "CDHW days, mean temperature and precipitation per country in one pass (calculate_all_metrics.py)",
+    'ensemble': "CDHW days of every model and scenario of a run table on one worker pool (ensemble.py)",
+    'spei': "gridded SPEI at several scales from daily precipitation and mean temperature (spei_engine.py)",
+    'check-weights': "countries with maize area in the aligned weights, from the static cache when present",
+    'check-inputs': "index the metadata of every input in parallel and report grid, unit and time problems",
+}
+
+
+def input_paths(args):
+    """Tmax pattern, SPEI file and config (maize area, growing season, regions, temp/precip dirs) of `args`."""
+    config = data_layout.load_config(args.config, args.data_dir)
+    data_dir = args.data_dir or data_layout.DATA_DIR
+    return (os.path.join(data_dir, data_layout.TMAX_FILES), os.path.join(data_dir, data_layout.SPEI_FILE),
+            config)
+
+
+def configure_cdhw(args):
+    """Points calculate_cdhw, whose paths the ensemble, SPEI and all-metrics commands share, at `args`."""
+    import calculate_cdhw
+
+    if args.data_dir:
+        calculate_cdhw.set_data_dir(args.data_dir)
+    if args.config:
+        calculate_cdhw.set_config(data_layout.load_config(args.config, args.data_dir))
+    return calculate_cdhw
+
+
+def run_cdhw(args, argv, prog):
+    calculate_cdhw = configure_cdhw(args)
+    calculate_cdhw.run(calculate_cdhw.parse_args(argv, prog))
+
+
+def run_ensemble(args, argv, prog):
+    configure_cdhw(args)
+    import ensemble
+
+    ensemble.run(ensemble.parse_args(argv, prog))
+
+
+def run_spei(args, argv, prog):
+    configure_cdhw(args)
+    import spei_engine
+
+    spei_engine.run(spei_engine.parse_args(argv, prog))
+
+
+def run_mean_temp(args, argv, prog):
+    data_layout.load_config(args.config, args.data_dir)
+    import calculate_country_mean_temp
+
+    calculate_country_mean_temp.run(calculate_country_mean_temp.parse_args(argv, prog))
+
+
+def run_precip(args, argv, prog):
+    data_layout.load_config(args.config, args.data_dir)
+    import calculate_country_precipitation
+
+    calculate_country_precipitation.run(calculate_country_precipitation.parse_args(argv, prog))
+
+
+def run_all_metrics(args, argv, prog):
+    data_layout.load_config(args.config, args.data_dir)
+    # Tmax and SPEI come from calculate_cdhw, bound when calculate_all_metrics is imported
+    configure_cdhw(args)
+    import calculate_all_metrics
+
+    calculate_all_metrics.run(calculate_all_metrics.parse_args(argv, prog))
+
+
+def run_check_weights(args, argv, prog):
+    tmax_pattern, _, config = input_paths(args)
+    parser = argparse.ArgumentParser(prog=prog, description=COMMANDS['check-weights'])
+    parser.add_argument("--tmax-pattern", default=tmax_pattern,
+                        help="daily files whose grid the weights are aligned to (default: %(default)s)")
+    parser.add_argument("--resolution", type=float, default=None, metavar="DEG",
+                        help="align to the global grid of this resolution instead, as with --regrid")
+    parser.add_argument("--regions", default=config.COUNTRIES_SHP_FILE, metavar="SHP",
+                        help="polygons the cells are assigned to (default: %(default)s)")
+    parser.add_argument("--native", action="store_true",
+                        help="check the maize raster on its own grid instead (needs rioxarray, geopandas, regionmask)")
+    opts = parser.parse_args(argv)
+
+    from check_weights import check_static_weights, check_weights
+
+    if opts.native:
+        check_weights(config.MaizeAreaPath, opts.regions)
+        return
+
+    import glob
+
+    from static_inputs import load_static_inputs
+
+    if opts.resolution:
+        from regrid import grid_template
+
+        template = grid_template(opts.resolution)
+    else:
+        from metric_engine import open_variable
+
+        paths = sorted(glob.glob(opts.tmax_pattern))
+        if not paths:
+            parser.error(f"no files match {opts.tmax_pattern}; give --tmax-pattern or --resolution")
+        template = open_variable(paths[0]).isel(time=0, drop=True)
+    cache_dir = os.path.join(os.path.dirname(config.MaizeAreaPath), "static_cache")
+    static = load_static_inputs(template, config.MaizeAreaPath, config.GrowingSeasonPath, opts.regions, cache_dir)
+    check_static_weights(static)
+
+
+def run_check_inputs(args, argv, prog):
+    tmax_pattern, spei_file, config = input_paths(args)
+    parser = argparse.ArgumentParser(prog=prog, description=COMMANDS['check-inputs'])
+    parser.add_argument("--tmax-pattern", default=tmax_pattern,
+                        help="glob pattern of the daily Tmax files (default: %(default)s)")
+    parser.add_argument("--years", type=int, nargs=2, default=None, metavar=("FIRST", "LAST"),
+                        help="only check these years")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="processes scanning new or changed files (0 = all cores)")
+    opts = parser.parse_args(argv)
+
+    from input_catalog import CATALOG_FILE, check_inputs
+    from parallel import default_workers
+
+    patterns = {
+        'tmax': opts.tmax_pattern,
+        'temp': os.path.join(config.MeanTempPath, "*.nc"),
+        'precip': os.path.join(config.PrecipitationPath, "*.nc"),
+    }
+    files = {
+        'maize area': config.MaizeAreaPath,
+        'growing season': config.GrowingSeasonPath,
+        'regions': config.COUNTRIES_SHP_FILE,
+    }
+    catalog_file = os.path.join(os.path.dirname(config.MaizeAreaPath), "static_cache", CATALOG_FILE)
+    if not check_inputs(patterns, files, spei_file, catalog_file, opts.workers or default_workers(), opts.years):
+        sys.exit(1)
+
+
+HANDLERS = {
+    'cdhw': run_cdhw,
+    'ensemble': run_ensemble,
+    'mean-temp': run_mean_temp,
+    'precip': run_precip,
+    'all-metrics': run_all_metrics,
+    'spei': run_spei,
+    'check-weights': run_check_weights,
+    'check-inputs': run_check_inputs,
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Maize heat and drought metrics per country.",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="commands:\n" + "\n".join(f"  {name:<14}{text}" for name, text in COMMANDS.items()))
+    parser.add_argument("--data-dir", default=None, metavar="DIR",
+                        help=f"directory holding the inputs in the default layout (default: {data_layout.DATA_DIR})")
+    parser.add_argument("--config", default=None, metavar="FILE",
+                        help="config.py with MeanTempPath, PrecipitationPath, MaizeAreaPath, GrowingSeasonPath, "
+                             "COUNTRIES_SHP_FILE and results_path, used by every command; Tmax, SPEI and the CDHW "
+                             "outputs stay under --data-dir (default: the layout under --data-dir if given, "
+                             "else a config.py on the import path, else the layout under data)")
+    parser.add_argument("command", choices=COMMANDS, metavar="COMMAND", help="one of: " + ", ".join(COMMANDS))
+    parser.add_argument("options", nargs=argparse.REMAINDER, help="options of the command")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    HANDLERS[args.command](args, args.options, f"{os.path.basename(sys.argv[0])} {args.command}")
@@ -0,0 +1,51 @@
+import importlib.util
+import os
+import sys
+import types
+
+# Default location of the inputs, caches and outputs
+DATA_DIR = "data"
+
+# Input files relative to the data directory
+TMAX_FILES = os.path.join("MaxTemp_Merged_0.5deg", "ERA5_MaxTemp_*_0.5deg.nc")
+TEMP_DIR = "temp"
+PRECIP_DIR = "precip"
+SPEI_FILE = "spei03.nc"
+MAIZE_AREA_FILE = "spam2000v3r7_harvested-area_MAIZ.tif"
+GROWING_SEASON_FILE = "global.maize.growing.season.csv"
+COUNTRIES_SHP_FILE = os.path.join("ne_110m_admin_0_countries", "ne_110m_admin_0_countries.shp")
+RESULTS_DIR = "results"
+
+
+def data_config(data_dir=DATA_DIR):
+    """A config module with the default layout under `data_dir`, for the scripts that import `config`."""
+    config = types.ModuleType('config')
+    config.MeanTempPath = os.path.join(data_dir, TEMP_DIR)
+    config.PrecipitationPath = os.path.join(data_dir, PRECIP_DIR)
+    config.MaizeAreaPath = os.path.join(data_dir, MAIZE_AREA_FILE)
+    config.GrowingSeasonPath = os.path.join(data_dir, GROWING_SEASON_FILE)
+    config.COUNTRIES_SHP_FILE = os.path.join(data_dir, COUNTRIES_SHP_FILE)
+    config.results_path = os.path.join(data_dir, RESULTS_DIR)
+    return config
+
+
+def load_config(path=None, data_dir=None):
+    """Installs the `config` module read by calculate_country_*.py and calculate_all_metrics.py.
+
+    `path` is a config.py file anywhere on disk. Without it, a `data_dir`
+    gives the default layout under that directory; otherwise a config.py on
+    the import path is used, falling back to the default layout under DATA_DIR.
+    """
+    if path:
+        spec = importlib.util.spec_from_file_location('config', path)
+        config = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(config)
+    elif data_dir:
+        config = data_config(data_dir)
+    else:
+        try:
+            import config
+        except ImportError:
+            config = data_config()
+    sys.modules['config'] = config
+    return config
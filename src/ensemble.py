@@ -0,0 +1,146 @@
+import argparse
+import glob
+import os
+
+import pandas as pd
+
+import calculate_cdhw
+import profiling
+from grid_store import write_parquet
+from metric_engine import GROWING_SEASONS, REGION_WEIGHTS, finish_metrics, plan_metrics, regions_suffix, run_year_jobs
+from parallel import PREFETCH_DEPTH, default_workers
+
+# Columns of the run table: a run is named by model and scenario and reads the daily
+# Tmax files matching its tmax pattern; an optional spei column gives its own SPEI file
+RUN_COLUMNS = ['model', 'scenario', 'tmax']
+# Partition columns of the output dataset, one partition per run
+PARTITION_COLUMNS = ('model', 'scenario')
+
+
+def read_runs(path):
+    """Reads a run table (CSV with the RUN_COLUMNS, optionally spei), one row per run."""
+    runs = pd.read_csv(path, dtype=str, keep_default_na=False)
+    missing = [col for col in RUN_COLUMNS if col not in runs.columns]
+    if missing:
+        raise ValueError(f"Run table {path} lacks the columns {missing}")
+    duplicated = runs.duplicated(['model', 'scenario'])
+    if duplicated.any():
+        raise ValueError(f"Runs listed twice in {path}: "
+                         f"{runs.loc[duplicated, ['model', 'scenario']].to_dict('records')}")
+    return runs
+
+
+def run_ensemble(runs, output_dir, workers=1, spei_file=None, checkpoint_root=None, regions_file=None,
+                 region_weights='mask', memory_budget_mb=None, compact=False, spells=False, cropland_only=False,
+                 resume=True, years=None, prefetch=PREFETCH_DEPTH, growing_season='month'):
+    """CDHW metrics of every run of a model ensemble, with one worker pool for all of them.
+
+    `runs` is a run table (see `read_runs`). Every (run, year) task is
+    scheduled on the same pool, so a batch of many GCMs and scenarios keeps
+    all workers busy; the static inputs are built once per distinct grid and
+    shared by the runs on it. Runs without their own SPEI use `spei_file`.
+    Each run is checkpointed under `checkpoint_root`/model/scenario, so a
+    rerun only computes new or changed runs and years, and its table is
+    written to its own model/scenario partition of the Parquet dataset
+    `output_dir`, replacing only that partition. The inputs of all runs are
+    indexed and checked before any work starts, so a bad file of the last
+    run fails the batch at once. With one worker, the next `prefetch`
+    run-years are read in the background. The other options are those of
+    `calculate_cdhw.main`.
+
+    Returns the tables of all runs with model and scenario columns.
+    """
+    regions_file = regions_file or calculate_cdhw.COUNTRIES_SHP_FILE
+    checkpoint_root = checkpoint_root or os.path.join(calculate_cdhw.DATA_DIR, "checkpoints", "ensemble")
+    static_files = (calculate_cdhw.MAIZE_AREA_FILE, calculate_cdhw.GROWING_SEASON_FILE, regions_file)
+    suffix = regions_suffix(regions_file, calculate_cdhw.COUNTRIES_SHP_FILE)
+    if growing_season != 'month':
+        suffix += f"_gs{growing_season}"
+    metrics = calculate_cdhw.CDHW_METRICS + (calculate_cdhw.CDHW_SPELL_METRICS if spells else [])
+
+    plans = []
+    for run in runs.to_dict('records'):
+        tmax_files = sorted(glob.glob(run['tmax']))
+        if not tmax_files:
+            raise FileNotFoundError(f"No Tmax files found for {run['model']} {run['scenario']}: {run['tmax']}")
+        checkpoint_dir = os.path.join(checkpoint_root, run['model'], run['scenario'] + suffix)
+        plans.append(plan_metrics(metrics, {'tmax': tmax_files}, static_files, calculate_cdhw.STATIC_CACHE_DIR,
+                                  spei_file=run.get('spei') or spei_file, memory_budget_mb=memory_budget_mb,
+                                  compact=compact, checkpoint_dir=checkpoint_dir, resume=resume,
+                                  region_weights=region_weights, cropland_only=cropland_only, years=years,
+                                  workers=workers, growing_season=growing_season))
+    n_tasks = sum(len(plan.job.year_sources) for plan in plans)
+    print(f"--- Ensemble of {len(plans)} runs, {n_tasks} run-years ---")
+
+    results = run_year_jobs([plan.job for plan in plans], workers, prefetch)
+
+    tables = []
+    for run, plan, dfs in zip(runs.to_dict('records'), plans, results):
+        df = finish_metrics(plan, dfs)
+        # Regions without maize area; spell onsets stay NaN in years without events
+        df = df.dropna(subset=[m.name for m in calculate_cdhw.CDHW_METRICS])
+        df = df.sort_values(['year', 'country'])
+        df.insert(0, 'scenario', run['scenario'])
+        df.insert(0, 'model', run['model'])
+        write_parquet(df, output_dir, partition_cols=PARTITION_COLUMNS)
+        tables.append(df)
+    return pd.concat(tables, ignore_index=True)
+
+
+def parse_args(argv=None, prog=None):
+    parser = argparse.ArgumentParser(prog=prog, description="CDHW days of a multi-model, multi-scenario ensemble.")
+    parser.add_argument("runs", help="CSV run table with columns model, scenario, tmax (glob pattern) "
+                                     "and optionally spei (SPEI file of the run)")
+    parser.add_argument("--output", default=os.path.join(calculate_cdhw.DATA_DIR, "cdhw_ensemble"), metavar="DIR",
+                        help="Parquet dataset partitioned by model and scenario (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes shared by all runs, one run-year per task (0 = all cores)")
+    parser.add_argument("--years", type=int, nargs=2, default=None, metavar=("FIRST", "LAST"),
+                        help="only process these years of every run")
+    parser.add_argument("--prefetch", type=int, default=PREFETCH_DEPTH, metavar="N",
+                        help="in a single process, read and decode the next N run-years in a background thread "
+                             "while the current one is computed; each holds a run-year of input in memory "
+                             "(0 = off, default: %(default)s)")
+    parser.add_argument("--spei", default=calculate_cdhw.SPEI_FILE, metavar="NC",
+                        help="SPEI of the runs without their own (default: %(default)s)")
+    parser.add_argument("--checkpoint-dir", default=None, metavar="DIR",
+                        help="root of the per-run checkpoints (default: checkpoints/ensemble in the data directory)")
+    parser.add_argument("--memory-budget", type=float, default=None, metavar="MB",
+                        help="read each year in latitude bands of about this many MB")
+    parser.add_argument("--compact", action="store_true",
+                        help="keep packed Tmax in its on-disk integer form and bit-pack the daily masks")
+    parser.add_argument("--regions", default=calculate_cdhw.COUNTRIES_SHP_FILE, metavar="SHP",
+                        help="polygons to aggregate to (default: %(default)s)")
+    parser.add_argument("--region-weights", choices=REGION_WEIGHTS, default='mask',
+                        help="how cells are assigned to the regions (default: %(default)s)")
+    parser.add_argument("--growing-season", choices=GROWING_SEASONS, default='month',
+                        help="'month' counts the whole months of planting and harvest; 'day' only the days "
+                             "between the exact planting and harvest days of year (default: %(default)s)")
+    parser.add_argument("--spells", action="store_true",
+                        help="also count CDHW events, the longest run of CDHW days and the onset day of year")
+    parser.add_argument("--cropland-only", action="store_true",
+                        help="compute only the cells with maize area; same results")
+    parser.add_argument("--force", action="store_true",
+                        help="recompute every run and year instead of reusing checkpoints")
+    parser.add_argument("--profile", choices=profiling.PROFILE_MODES, default='off',
+                        help="per-stage wall time, CPU time, peak RSS and array bytes (default: %(default)s)")
+    parser.add_argument("--profile-file", default=os.path.join(calculate_cdhw.DATA_DIR, "ensemble_profile.json"),
+                        metavar="PATH", help="report file of --profile json/jsonl (default: %(default)s)")
+    return parser.parse_args(argv)
+
+
+def run(args):
+    """Runs the ensemble with the options of `parse_args`."""
+    profiling.configure(args.profile, profiling.report_path(args.profile_file, args.profile))
+    table = run_ensemble(read_runs(args.runs), args.output, workers=args.workers or default_workers(),
+                         spei_file=args.spei, checkpoint_root=args.checkpoint_dir, regions_file=args.regions,
+                         region_weights=args.region_weights, memory_budget_mb=args.memory_budget,
+                         compact=args.compact, spells=args.spells, cropland_only=args.cropland_only,
+                         resume=not args.force, years=args.years, prefetch=args.prefetch,
+                         growing_season=args.growing_season)
+    print(f"--- Ensemble complete: {len(table)} rows written to {args.output} ---")
+    profiling.finish()
+
+
+if __name__ == "__main__":
+    run(parse_args())
@@ -0,0 +1,155 @@
+import os
+import sys
+
+import numpy as np
+
+# Cells per block of the compiled kernel: a thread walks all days of one block of
+# cells, so the block's counters stay in cache while the days stream past
+KERNEL_BLOCK_CELLS = 2048
+
+# Compiled kernel once built; False if numba is not installed
+_kernel = None
+
+
+def season_days(day_of_year, start_day, end_day):
+    """Growing-season test of every day and cell from planting and harvest days of year.
+
+    `day_of_year` gives the day of year of each time step and `start_day`,
+    `end_day` the season of each cell (any shape). As with the monthly mask,
+    a season with start_day > end_day runs across the new year and cells
+    without planting and harvest days (NaN) are never in it. Returns a
+    (time, ...) boolean array.
+    """
+    doy = np.asarray(day_of_year).reshape((-1,) + (1,) * np.ndim(start_day))
+    return np.where(start_day <= end_day, (doy >= start_day) & (doy <= end_day),
+                    (doy >= start_day) | (doy <= end_day))
+
+
+def _compile_kernel():
+    import numba
+    from numba import njit, prange
+
+    if 'NUMBA_THREADING_LAYER' not in os.environ:
+        # Worker pools fork this process: of numba's threading layers only the workqueue
+        # survives that (TBB hangs at exit, GNU OpenMP aborts the child)
+        numba.config.THREADING_LAYER = 'workqueue'
+    block_cells = KERNEL_BLOCK_CELLS
+
+    @njit(parallel=True, cache=True, nogil=True)
+    def kernel(values, thresholds, qualified, day_month, day_of_year, start_day, end_day, by_day, counts):
+        n_time, n_cells = values.shape
+        n_thresholds = thresholds.shape[0]
+        for b in prange((n_cells + block_cells - 1) // block_cells):
+            lo = b * block_cells
+            hi = min(lo + block_cells, n_cells)
+            n = hi - lo
+            # Branch-free 0/1 tests over contiguous rows, so the inner loops vectorise
+            block_counts = np.zeros((n_thresholds, n), dtype=np.int32)
+            ok = np.empty(n, dtype=np.int32)
+            for t in range(n_time):
+                row = values[t, lo:hi]
+                qualified_row = qualified[day_month[t], lo:hi]
+                if by_day:
+                    d = day_of_year[t]
+                    s = start_day[lo:hi]
+                    e = end_day[lo:hi]
+                    for i in range(n):
+                        ok[i] = np.int32(qualified_row[i] and ((s[i] <= e[i] and s[i] <= d <= e[i])
+                                                               or (not s[i] <= e[i] and (d >= s[i] or d <= e[i]))))
+                else:
+                    for i in range(n):
+                        ok[i] = np.int32(qualified_row[i])
+                for k in range(n_thresholds):
+                    threshold = thresholds[k]
+                    row_counts = block_counts[k]
+                    for i in range(n):
+                        row_counts[i] += np.int32(row[i] > threshold) & ok[i]
+            for k in range(n_thresholds):
+                for i in range(n):
+                    counts[k, lo + i] += block_counts[k, i]
+
+    # Loads the machine code and starts the thread pool now rather than in the first count
+    kernel(np.zeros((1, 1)), np.zeros(1), np.ones((1, 1), dtype=bool), np.zeros(1, dtype=np.int64),
+           np.zeros(1, dtype=np.int64), np.zeros(1), np.zeros(1), True, np.zeros((1, 1), dtype=np.int16))
+    return kernel
+
+
+def counting_kernel():
+    """The compiled kernel of `count_qualified_days`, or None if numba is not installed.
+
+    numba is imported on first use only. The machine code is cached next to
+    this module, so later processes load it instead of compiling again.
+    """
+    global _kernel
+    if _kernel is None:
+        try:
+            _kernel = _compile_kernel()
+        except ImportError:
+            _kernel = False
+    return _kernel or None
+
+
+def limit_threads(n_threads):
+    """Caps the threads of the compiled kernel, e.g. to 1 in each worker of a process pool."""
+    if 'numba' in sys.modules:
+        import numba
+
+        numba.set_num_threads(max(1, min(n_threads, numba.config.NUMBA_NUM_THREADS)))
+    else:
+        os.environ['NUMBA_NUM_THREADS'] = str(max(1, n_threads))
+
+
+def count_qualified_days(values, thresholds, qualified_monthly, day_month, day_of_year=None, season=None,
+                         dtype='int16'):
+    """Qualified days above each threshold per cell, in one pass over the daily values.
+
+    `values` is a (time, ...) array of one year, `qualified_monthly` holds
+    one boolean day filter per month (growing season and drought) and
+    `day_month` gives the month position of every day. With `season` =
+    (start_day, end_day) per cell, a day also has to fall between the
+    planting and harvest days of its cell (see `season_days`), tested with
+    `day_of_year`. The heat, drought and season tests and the counts of all
+    thresholds are fused: the compiled kernel (numba) allocates nothing but
+    the counts and runs on several threads; without numba, each month is
+    reduced to the cells its filter lets through before comparing. Both
+    give the counts of `values > threshold` exactly, thresholds taken in
+    the dtype of `values` as NumPy would compare them.
+
+    Returns a (n_thresholds, ...) array of `dtype`.
+    """
+    shape = values.shape[1:]
+    n_time = values.shape[0]
+    values = values.reshape(n_time, -1)
+    qualified_monthly = np.ascontiguousarray(qualified_monthly, dtype=bool).reshape(len(qualified_monthly), -1)
+    thresholds = np.asarray(thresholds).astype(values.dtype)
+    day_month = np.asarray(day_month, dtype='int64')
+    counts = np.zeros((len(thresholds), values.shape[1]), dtype=dtype)
+    if season is not None:
+        start_day, end_day = (np.asarray(bound, dtype='float64').reshape(-1) for bound in season)
+        day_of_year = np.asarray(day_of_year, dtype='int64')
+
+    kernel = counting_kernel()
+    if kernel is not None:
+        if season is None:
+            start_day = end_day = np.zeros(0)
+            day_of_year = np.zeros(n_time, dtype='int64')
+        kernel(np.ascontiguousarray(values), thresholds, qualified_monthly, day_month, day_of_year, start_day,
+               end_day, season is not None, counts)
+        return counts.reshape((len(thresholds),) + shape)
+
+    starts = np.flatnonzero(np.r_[True, day_month[1:] != day_month[:-1]])
+    stops = np.r_[starts[1:], n_time]
+    for start, stop in zip(starts, stops):
+        cells = np.flatnonzero(qualified_monthly[day_month[start]])
+        if len(cells) == 0:
+            continue
+        block = values[start:stop][:, cells]
+        in_season = None
+        if season is not None:
+            in_season = season_days(day_of_year[start:stop], start_day[cells], end_day[cells])
+        for k, threshold in enumerate(thresholds):
+            hot = block > threshold
+            if in_season is not None:
+                hot &= in_season
+            counts[k, cells] += hot.sum(axis=0, dtype=dtype)
+    return counts.reshape((len(thresholds),) + shape)
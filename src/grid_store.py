@@ -0,0 +1,226 @@
+import argparse
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from scipy import sparse
+
+from region_aggregation import overlap_region_means, weighted_region_means
+from static_inputs import ISO_COLUMNS, NAME_COLUMNS
+
+# Bump whenever the layout of the stores changes.
+GRID_STORE_VERSION = 1
+# Chunk edge (cells) of the lat/lon chunks; every year is its own chunk
+GRID_CHUNK = 256
+# Static variables stored next to the annual fields
+STATIC_VARIABLES = ['area_weights', 'country_mask', 'gs_start_month', 'gs_end_month', 'gs_start_day', 'gs_end_day']
+
+
+def save_grid_piece(path, year, lat, lon, fields):
+    """Writes the annual per-cell fields of one year (name -> (lat, lon) array)."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+    np.savez(tmp_path, year=year, lat=lat, lon=lon, **{f"field_{name}": values for name, values in fields.items()})
+    os.replace(tmp_path, path)
+
+
+def read_grid_piece(path):
+    with np.load(path) as piece:
+        fields = {name[len("field_"):]: piece[name] for name in piece.files if name.startswith("field_")}
+        return int(piece['year']), piece['lat'], piece['lon'], fields
+
+
+def is_zarr(store):
+    return store.rstrip('/').endswith('.zarr')
+
+
+def static_dataset(static, metrics, region_weights, region_fractions=None):
+    """Static part of a store: area weights, country mask, growing-season months, region labels and metadata."""
+    ds = static[STATIC_VARIABLES + [name for name in static.data_vars if name.startswith('region_')]].copy()
+    ds.attrs = {
+        'grid_store_version': GRID_STORE_VERSION,
+        'metrics': json.dumps([m._asdict() for m in metrics]),
+        'region_weights': region_weights,
+    }
+    if region_fractions is not None:
+        # The sparse (regions, cells) overlap matrix in CSR form
+        ds['region_fraction_data'] = ('fraction', region_fractions.data)
+        ds['region_fraction_indices'] = ('fraction', region_fractions.indices.astype('int64'))
+        ds['region_fraction_indptr'] = ('fraction_row', region_fractions.indptr.astype('int64'))
+    for name in ds.data_vars:
+        if ds[name].dtype.kind == 'U':
+            ds[name] = ds[name].astype(object)
+    return ds
+
+
+def year_dataset(year, lat, lon, fields):
+    return xr.Dataset({name: (('year', 'lat', 'lon'), values[None]) for name, values in fields.items()},
+                      coords={'year': [year], 'lat': lat, 'lon': lon})
+
+
+def write_grid_store(store, pieces, static, metrics, region_weights='mask', region_fractions=None):
+    """Writes the per-cell annual fields of every year to a chunked, compressed Zarr or NetCDF store.
+
+    `pieces` are the per-year files from `save_grid_piece` in year order;
+    they are appended one year at a time, so only one year is in memory.
+    The store also holds the static inputs used for the regional means
+    (area weights, country mask, growing-season months, region names and
+    codes) and, for 'overlap' weights, the region overlap matrix. A '.zarr'
+    path gives a Zarr store, anything else NetCDF-4. Existing stores are
+    replaced.
+    """
+    chunks = (1, min(GRID_CHUNK, static.sizes['lat']), min(GRID_CHUNK, static.sizes['lon']))
+    base = static_dataset(static, metrics, region_weights, region_fractions)
+    tmp_store = f"{store}.{os.getpid()}.tmp"
+
+    for i, path in enumerate(pieces):
+        year, lat, lon, fields = read_grid_piece(path)
+        if not (np.array_equal(lat, static.lat.values) and np.array_equal(lon, static.lon.values)):
+            raise ValueError(f"Annual fields of {year} are not on the grid of the static inputs")
+        ds = year_dataset(year, lat, lon, fields)
+        # Appending to a Zarr store replaces its attributes with those of the appended data
+        ds.attrs = base.attrs
+        if is_zarr(store):
+            if i == 0:
+                encoding = {name: {'chunks': chunks} for name in fields}
+                xr.merge([base, ds]).to_zarr(tmp_store, mode='w', encoding=encoding, consolidated=True)
+            else:
+                ds.to_zarr(tmp_store, append_dim='year', consolidated=True)
+        elif i == 0:
+            encoding = {name: {'zlib': True, 'complevel': 4, 'chunksizes': chunks} for name in fields}
+            encoding.update({name: {'zlib': True, 'complevel': 4} for name in STATIC_VARIABLES})
+            xr.merge([base, ds]).to_netcdf(tmp_store, encoding=encoding, unlimited_dims=['year'])
+        else:
+            import netCDF4
+
+            with netCDF4.Dataset(tmp_store, 'a') as nc:
+                n = len(nc.dimensions['year'])
+                nc['year'][n] = year
+                for name, values in fields.items():
+                    nc[name][n] = values
+
+    if os.path.isdir(store):
+        shutil.rmtree(store)
+    os.replace(tmp_store, store)
+    print(f"Annual grids of {len(pieces)} years written to {store}")
+
+
+def open_grid_store(store):
+    """Opens a store written by `write_grid_store` lazily."""
+    if is_zarr(store):
+        return xr.open_zarr(store, consolidated=True)
+    return xr.open_dataset(store, engine='netcdf4')
+
+
+def region_table(regions_file, iso_col=None):
+    """Region numbers, names and codes of a shapefile, numbered by row like the country mask."""
+    import geopandas as gpd
+
+    regions = gpd.read_file(regions_file)
+    name_col = next((col for col in NAME_COLUMNS if col in regions.columns), None)
+    iso_col = iso_col or next((col for col in ISO_COLUMNS if col in regions.columns), None)
+    if name_col is None or iso_col is None:
+        raise ValueError("No region name or code column found in %s" % regions_file)
+    labels = pd.DataFrame({'country_iso': regions[iso_col].astype(str), 'country': regions[name_col].astype(str)},
+                          index=regions.index.astype('int64'))
+    return regions, labels
+
+
+def store_region_means(store, regions_file=None, region_weights='mask', cache_dir=None, iso_col=None):
+    """Regional means of every metric in a grid store, one year at a time, without recomputing the metrics.
+
+    Without `regions_file` the regions and weights saved in the store are
+    used, which reproduces the original table. With another regions file,
+    e.g. admin-1 units, cells are assigned by the polygon containing their
+    centre ('mask') or shared by area fraction ('overlap', cached in
+    `cache_dir`, by default next to the store).
+
+    Spell onsets are averaged over the cells with a spell, like in the run.
+
+    Returns a DataFrame with columns year, one per metric, country_iso and country.
+    """
+    ds = open_grid_store(store)
+    definitions = json.loads(ds.attrs['metrics'])
+    metrics = [m['name'] for m in definitions]
+    onsets = [m['name'] for m in definitions if m['kind'] == 'onset']
+    lat, lon = ds.lat.values, ds.lon.values
+
+    fractions = codes = country_mask = None
+    if regions_file is None:
+        code_col = f'region_iso_{iso_col}' if iso_col else next(name for name in ds.data_vars
+                                                                 if name.startswith('region_iso_'))
+        labels = pd.DataFrame({'country_iso': ds[code_col].values.tolist(),
+                               'country': ds['region_name'].values.tolist()}, index=ds.region.values)
+        if ds.attrs['region_weights'] == 'overlap':
+            fractions = sparse.csr_matrix((ds['region_fraction_data'].values, ds['region_fraction_indices'].values,
+                                           ds['region_fraction_indptr'].values),
+                                          shape=(ds.sizes['region'], len(lat) * len(lon)))
+            codes = ds.region.values
+        else:
+            country_mask = ds['country_mask'].load()
+    else:
+        regions, labels = region_table(regions_file, iso_col)
+        if region_weights == 'overlap':
+            from region_weights import load_region_fractions
+
+            fractions, codes = load_region_fractions(lat, lon, regions_file,
+                                                     cache_dir or os.path.dirname(os.path.abspath(store)))
+        else:
+            import regionmask
+
+            country_mask = regionmask.mask_geopandas(regions, lon, lat).transpose('lat', 'lon')
+
+    area_weights = ds['area_weights'].load()
+    dfs = []
+    for year in ds.year.values:
+        annual = {name: ds[name].sel(year=[year]).load() for name in metrics}
+        for name in onsets:
+            annual[f"{name}_cells"] = annual[name].notnull()
+        if fractions is not None:
+            df = overlap_region_means(annual, area_weights, fractions, codes)
+        else:
+            df = weighted_region_means(annual, area_weights, country_mask)
+        for name in onsets:
+            cells = df.pop(f"{name}_cells")
+            with np.errstate(invalid='ignore', divide='ignore'):
+                df[name] = np.where(cells > 0, df[name] / cells, np.nan)
+        dfs.append(df)
+    df = pd.concat(dfs, ignore_index=True)
+    df = df.join(labels, on='country_code').drop(columns='country_code')
+    return df
+
+
+def write_parquet(df, path, partition_cols=('year',)):
+    """Writes a result table as a Parquet dataset partitioned by year.
+
+    Partitions present in `df` are replaced; other partitions already in
+    `path` are kept, so a run over new years extends the dataset.
+    """
+    df.to_parquet(path, index=False, partition_cols=list(partition_cols), existing_data_behavior='delete_matching')
+    print(f"Parquet dataset written to {path}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Re-aggregate a grid store of annual per-cell metrics to regions.")
+    parser.add_argument("store", help="Zarr (.zarr) or NetCDF store written with --grid-output")
+    parser.add_argument("output", help="output table, .csv or a Parquet dataset directory")
+    parser.add_argument("--regions", default=None, metavar="SHP",
+                        help="regions to aggregate to (default: the regions saved in the store)")
+    parser.add_argument("--region-weights", choices=['mask', 'overlap'], default='mask',
+                        help="how cells are assigned to the --regions polygons (default: %(default)s)")
+    parser.add_argument("--iso-col", default=None, help="region code column (default: the first ISO column)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    table = store_region_means(args.store, args.regions, args.region_weights, iso_col=args.iso_col)
+    table = table.sort_values(['year', 'country'])
+    if args.output.endswith('.csv'):
+        table.to_csv(args.output, index=False)
+        print(f"Results saved to {args.output}")
+    else:
+        write_parquet(table, args.output)
@@ -0,0 +1,250 @@
+import calendar
+import json
+import os
+
+import numpy as np
+
+from parallel import map_in_order
+
+# Bump whenever the content of the records changes.
+CATALOG_VERSION = 1
+# Name of the cached index in the cache directory
+CATALOG_FILE = "input_catalog.json"
+
+# Units the metrics assume: temperature thresholds are in Kelvin, precipitation totals in mm per day
+TEMPERATURE_VARIABLES = ['tmax', 'temp']
+KELVIN_UNITS = ['K', 'kelvin', 'Kelvin', 'degK', 'degrees_K']
+PRECIP_VARIABLES = ['precip']
+
+# Time steps of a complete year per CF calendar; other calendars follow the Gregorian leap rule
+CALENDAR_DAYS = {'noleap': 365, '365_day': 365, 'all_leap': 366, '366_day': 366, '360_day': 360}
+
+
+def file_stamp(path):
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+def scan_file(path):
+    """Metadata of the first variable of a NetCDF file, without reading its values.
+
+    Only the attributes and the time, lat and lon coordinates are read.
+    Returns a JSON-serialisable record: variable name, units, storage dtype,
+    grid shape, extent and digest, calendar, first and last time step and
+    the number of time steps of every year; or the error if the file cannot
+    be opened.
+    """
+    import xarray as xr
+
+    from static_inputs import grid_digest
+
+    size, mtime_ns = file_stamp(path)
+    record = {'path': path, 'size': size, 'mtime_ns': mtime_ns}
+    try:
+        with xr.open_dataset(path, engine='netcdf4') as ds:
+            name = list(ds.data_vars)[0]
+            da = ds[name]
+            years, counts = np.unique(ds.time.dt.year.values, return_counts=True)
+            record.update({
+                'variable': name,
+                'units': da.attrs.get('units'),
+                'dtype': str(da.encoding.get('dtype', da.dtype)),
+                'dims': list(da.dims),
+                'n_lat': ds.sizes['lat'],
+                'n_lon': ds.sizes['lon'],
+                'lat': [float(ds.lat[0]), float(ds.lat[-1])],
+                'lon': [float(ds.lon[0]), float(ds.lon[-1])],
+                'grid': grid_digest(ds.lat.values, ds.lon.values),
+                'calendar': ds.time.encoding.get('calendar', 'standard'),
+                'start': str(ds.time.values[0])[:10],
+                'end': str(ds.time.values[-1])[:10],
+                'steps': {str(year): int(n) for year, n in zip(years, counts)},
+            })
+    except Exception as e:
+        record['error'] = f"{type(e).__name__}: {e}"
+    return record
+
+
+def read_catalog(catalog_file):
+    """Records of a cached index by absolute path; empty if there is none or it is outdated."""
+    if not catalog_file or not os.path.exists(catalog_file):
+        return {}
+    with open(catalog_file) as f:
+        catalog = json.load(f)
+    if catalog.get('version') != CATALOG_VERSION:
+        return {}
+    return {record['path']: record for record in catalog['files']}
+
+
+def write_catalog(catalog_file, records):
+    os.makedirs(os.path.dirname(os.path.abspath(catalog_file)), exist_ok=True)
+    tmp_path = f"{catalog_file}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({'version': CATALOG_VERSION, 'files': sorted(records.values(), key=lambda r: r['path'])}, f,
+                  indent=1)
+    os.replace(tmp_path, catalog_file)
+
+
+def build_catalog(paths, catalog_file=None, workers=1):
+    """Metadata records (see `scan_file`) of `paths`, in the same order.
+
+    Files whose size and modification time match the cached index in
+    `catalog_file` are not opened; the others are scanned in parallel with
+    `workers` processes and the index is updated. Entries of files that no
+    longer exist are dropped from it.
+    """
+    cached = read_catalog(catalog_file)
+    records = {}
+    todo = []
+    for path in dict.fromkeys(os.path.abspath(p) for p in paths):
+        record = cached.get(path)
+        if record is not None and (record['size'], record['mtime_ns']) == file_stamp(path):
+            records[path] = record
+        else:
+            todo.append(path)
+    if todo:
+        print(f"Scanning the metadata of {len(todo)} of {len(records) + len(todo)} input files...")
+        for record in map_in_order(scan_file, todo, workers):
+            records[record['path']] = record
+        if catalog_file:
+            kept = {path: record for path, record in cached.items() if os.path.exists(path)}
+            kept.update(records)
+            write_catalog(catalog_file, kept)
+    return [records[os.path.abspath(p)] for p in paths]
+
+
+def days_in_year(year, calendar_name):
+    if calendar_name in CALENDAR_DAYS:
+        return CALENDAR_DAYS[calendar_name]
+    return 366 if calendar.isleap(year) else 365
+
+
+def unit_problems(variable, units):
+    """Problems with the units of a variable's files, given the units the metrics assume."""
+    if units is None:
+        return []
+    if variable in TEMPERATURE_VARIABLES and units not in KELVIN_UNITS:
+        return [f"{variable} is in '{units}', but the temperature thresholds and offsets are in Kelvin"]
+    if variable in PRECIP_VARIABLES and (units.endswith('s-1') or units.endswith('/s')):
+        return [f"{variable} is a flux in '{units}', but the season totals expect mm per day"]
+    return []
+
+
+def variable_problems(variable, records, years=None):
+    """Problems that would spoil a run over `years` (all years if None), and warnings, of one variable's files.
+
+    Problems: files that cannot be opened, files on different grids, units
+    the metrics do not expect, a year split between files and years with
+    missing days. Warnings: files without units, years missing between the
+    first and the last.
+    """
+    problems, warnings = [], []
+    for record in records:
+        if 'error' in record:
+            problems.append(f"{record['path']} cannot be opened: {record['error']}")
+    records = [r for r in records if 'error' not in r]
+    if years is not None:
+        records = [r for r in records if any(years[0] <= int(year) <= years[1] for year in r['steps'])]
+    if not records:
+        return problems, warnings
+
+    grids = {}
+    for record in records:
+        grids.setdefault(record['grid'], record)
+    if len(grids) > 1:
+        shapes = ", ".join(f"{r['n_lat']}x{r['n_lon']} ({os.path.basename(r['path'])})" for r in grids.values())
+        problems.append(f"{variable} files are on {len(grids)} different grids: {shapes}")
+
+    for units in sorted({str(r['units']) for r in records if r['units'] is not None}):
+        problems += unit_problems(variable, units)
+    if any(r['units'] is None for r in records):
+        warnings.append(f"{variable}: some files have no units attribute; assuming the expected units")
+
+    owners = {}
+    for record in records:
+        for year, n in record['steps'].items():
+            year = int(year)
+            if years is not None and not years[0] <= year <= years[1]:
+                continue
+            if year in owners:
+                problems.append(f"Year {year} of {variable} is split between {owners[year]['path']} "
+                                f"and {record['path']}")
+                continue
+            owners[year] = record
+            expected = days_in_year(year, record['calendar'])
+            if n != expected:
+                problems.append(f"{variable} {year} has {n} of {expected} days in {record['path']}")
+    found = sorted(owners)
+    missing = sorted(set(range(found[0], found[-1] + 1)) - set(found)) if found else []
+    if missing:
+        warnings.append(f"{variable}: no files for the years {missing}")
+    return problems, warnings
+
+
+def spei_problems(record, years):
+    """Problems of the monthly SPEI file for a run over `years` (a list)."""
+    if 'error' in record:
+        return [f"{record['path']} cannot be opened: {record['error']}"]
+    short = [year for year in years if record['steps'].get(str(year), 0) < 12]
+    if short:
+        return [f"SPEI ({record['start']} .. {record['end']}) lacks months of the years {short}"]
+    return []
+
+
+def check_inputs(patterns, files, spei_file=None, catalog_file=None, workers=1, years=None):
+    """Pre-flight check of every input from the metadata index, without reading any data.
+
+    `patterns` maps variables to glob patterns of their daily files and
+    `files` names other inputs (static files), which only need to exist.
+    Prints a summary per variable and every problem and warning found
+    (see `variable_problems`, `spei_problems`). Returns True if there are
+    no problems.
+    """
+    import glob
+
+    paths = {variable: sorted(glob.glob(pattern)) for variable, pattern in patterns.items()}
+    spei_paths = [spei_file] if spei_file and os.path.exists(spei_file) else []
+    # One scan of all new or changed files, so the pool is started once
+    scanned = [path for variable_paths in paths.values() for path in variable_paths] + spei_paths
+    records = dict(zip(scanned, build_catalog(scanned, catalog_file, workers)))
+
+    problems = []
+    all_years = set()
+    for variable, pattern in patterns.items():
+        print(f"--- {variable}: {len(paths[variable])} files matching {pattern} ---")
+        if not paths[variable]:
+            # Not an error: each calculation needs only some of the variables
+            continue
+        variable_records = [records[path] for path in paths[variable]]
+        ok = [r for r in variable_records if 'error' not in r]
+        if ok:
+            found = sorted({int(year) for r in ok for year in r['steps']})
+            units = sorted({str(r['units']) for r in ok})
+            grids = sorted({f"{r['n_lat']}x{r['n_lon']}" for r in ok})
+            print(f"  {ok[0]['variable']}: years {found[0]}-{found[-1]}, grid {', '.join(grids)}, "
+                  f"units {', '.join(units)}, calendar {ok[0]['calendar']}")
+            all_years.update(year for year in found if years is None or years[0] <= year <= years[1])
+        variable_issues, warnings = variable_problems(variable, variable_records, years)
+        problems += variable_issues
+        for warning in warnings:
+            print(f"  Warning: {warning}")
+
+    if spei_paths:
+        record = records[spei_file]
+        if 'error' not in record:
+            print(f"--- SPEI: {spei_file}, {record['start']} .. {record['end']}, "
+                  f"grid {record['n_lat']}x{record['n_lon']} ---")
+        problems += spei_problems(record, sorted(all_years))
+    elif spei_file:
+        problems.append(f"SPEI file missing: {spei_file}")
+    for label, path in files.items():
+        if not os.path.exists(path):
+            problems.append(f"{label} missing: {path}")
+
+    for problem in problems:
+        print(f"  !!! {problem}")
+    if problems:
+        print(f"\n--- {len(problems)} problems found; fix them before running. ---")
+    else:
+        print("\n--- All inputs were found and check out (metadata only). ---")
+    return not problems
@@ -0,0 +1,1089 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from collections import namedtuple
+from functools import partial
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import profiling
+from fused_counts import count_qualified_days, counting_kernel, limit_threads, season_days
+from grid_store import read_grid_piece, save_grid_piece, write_grid_store
+from input_catalog import CATALOG_FILE, build_catalog, spei_problems, variable_problems
+from packed_masks import count_days, pack_days
+from parallel import PREFETCH_DEPTH, map_in_order, read_ahead
+from regrid import grid_template, regrid_array
+from region_aggregation import overlap_region_means, weighted_region_means
+from region_weights import load_region_fractions
+from spells import SPELL_PARTS, carry_backward, carry_forward, spell_state, spell_statistics
+from static_inputs import (attach_static_inputs, export_static_inputs, file_digest, file_digest_memo, grid_digest,
+                           load_static_inputs, region_labels)
+
+# Banded mode: rough peak bytes per (day, grid cell) of one variable in a block,
+# covering the decoded values and the intermediate boolean masks
+BYTES_PER_CELL_DAY = 24
+# Same in compact mode: raw values plus masks that only exist per packing chunk
+BYTES_PER_CELL_DAY_COMPACT = 4
+
+# Compact mode: days per packing chunk (a multiple of 8, so chunks fill whole bytes)
+COMPACT_CHUNK_DAYS = 64
+
+# Ways of assigning grid cells to regions: 'mask' gives every cell to the one
+# polygon containing its centre, 'overlap' shares boundary cells by area fraction
+REGION_WEIGHTS = ['mask', 'overlap']
+
+# Growing-season precision: 'month' takes the whole months of planting and harvest
+# (the calendar months of their days of year), 'day' the exact days of year
+GROWING_SEASONS = ['month', 'day']
+
+# xarray backend of the NetCDF inputs; naming it skips probing every installed
+# backend, which would import rioxarray (rasterio, pyproj) on the first open
+NETCDF_ENGINE = 'netcdf4'
+
+# Bump whenever the content or layout of the per-year checkpoints changes.
+CHECKPOINT_VERSION = 1
+
+# A metric computed per grid cell and year, then averaged per country with the area weights.
+#   kind 'count': growing-season days with variable > threshold (Kelvin for temperatures),
+#                 only in months with SPEI < spei_below when spei_below is set
+#   kind 'mean':  mean of variable + offset over the valid growing-season days
+#   kind 'sum':   sum of variable over the valid growing-season days
+#   kinds 'events', 'longest', 'onset': spells of consecutive days qualifying like a count
+#                 (number of spells, longest spell in days, day of year of the first spell),
+#                 joined across file and year boundaries and counted in the year they start
+Metric = namedtuple('Metric', ['name', 'kind', 'variable', 'threshold', 'spei_below', 'offset'])
+
+SPELL_KINDS = ('events', 'longest', 'onset')
+
+# One calculation for `run_year_jobs`: `task(year, files, spei)` for every year of
+# `year_sources`, with the other arguments of `run_years`. `prefetch` names the
+# variables the task reads in raw packed form, or is None if its years must not
+# be read whole in advance (banded reads, and regridding, which reads the native
+# data in time chunks)
+YearJob = namedtuple('YearJob', ['task', 'year_sources', 'static_files', 'cache_dir', 'spei_file', 'checkpoint_dir',
+                                 'config', 'resume', 'regrid', 'region_weights', 'prefetch'])
+
+# SPEI files opened so far in this process, by path
+_spei_files = {}
+# Years read ahead for the task being run in this process: futures by `prefetch_key`
+_prefetched = {}
+# Tasks and SPEI files of the jobs run by pool workers, set by _init_worker
+_worker_jobs = None
+# Threads that regrid the time chunks of a year in this process (see `regrid_array`)
+_regrid_threads = 1
+
+
+def threshold_count(name, variable, threshold, spei_below=None):
+    """Metric: growing-season days above `threshold`, optionally only in drought months."""
+    return Metric(name, 'count', variable, threshold, spei_below, 0.0)
+
+
+def growing_season_mean(name, variable, offset=0.0):
+    """Metric: mean of `variable` + `offset` over the growing season."""
+    return Metric(name, 'mean', variable, None, None, offset)
+
+
+def growing_season_sum(name, variable):
+    """Metric: total of `variable` over the growing season."""
+    return Metric(name, 'sum', variable, None, None, 0.0)
+
+
+def spell_count(name, variable, threshold, spei_below=None):
+    """Metric: number of spells of consecutive days that `threshold_count` would count."""
+    return Metric(name, 'events', variable, threshold, spei_below, 0.0)
+
+
+def longest_spell(name, variable, threshold, spei_below=None):
+    """Metric: length in days of the longest such spell."""
+    return Metric(name, 'longest', variable, threshold, spei_below, 0.0)
+
+
+def spell_onset(name, variable, threshold, spei_below=None):
+    """Metric: day of year of the first such spell (NaN without spells)."""
+    return Metric(name, 'onset', variable, threshold, spei_below, 0.0)
+
+
+def spell_condition(metric):
+    """Name shared by the spell metrics of one daily condition; prefix of their per-cell state fields."""
+    return f"spell_{metric.variable}_{metric.threshold:g}_{metric.spei_below}"
+
+
+def create_growing_season_mask_vectorized(times, da_start, da_end):
+    """创建生长季节掩码的向量化函数（考虑跨年生长季）"""
+    months = times.dt.month
+    mask1 = (months >= da_start) & (months <= da_end)
+    mask2 = (months >= da_start) | (months <= da_end)
+    return xr.where(da_start <= da_end, mask1, mask2)
+
+
+def open_variable(path, compact=False):
+    """Opens the first variable of a NetCDF file lazily.
+
+    With `compact`, packed integer data (scale_factor/add_offset) is kept in
+    its on-disk integer form instead of being decoded to floats; the packing
+    attributes stay in `attrs` for `thresholds_in_units`.
+    """
+    ds = xr.open_dataset(path, engine=NETCDF_ENGINE)
+    # obtain the variable name list from nc dataset, the first one is the data
+    name = list(ds.data_vars)[0]
+    da = ds[name]
+    if compact:
+        encoding = da.encoding
+        packed = 'scale_factor' in encoding or 'add_offset' in encoding
+        if packed and np.issubdtype(encoding.get('dtype', np.float64), np.integer) and encoding.get('scale_factor', 1) > 0:
+            da = xr.open_dataset(path, engine=NETCDF_ENGINE, mask_and_scale=False)[name]
+    return da
+
+
+def select_year(da, year):
+    """Time steps of `da` that fall in `year`, still lazy."""
+    return da.isel(time=np.flatnonzero(da.time.dt.year.values == year))
+
+
+def load_year(path, year, compact=False, regrid=None, cache_dir=None, memory_budget_mb=None):
+    """One year of the first variable of `path` as a (time, lat, lon) array.
+
+    With `regrid` = (method, resolution) the native-resolution data is
+    regridded on the fly to the global grid of that resolution, in time
+    chunks spread over `_regrid_threads` threads, so no intermediate
+    regridded files are needed. Otherwise the array stays lazy, unless
+    `run_year_jobs` has already read the year in the background (see
+    `prefetch_year`).
+    """
+    key = prefetch_key(path, year, compact and not regrid)
+    if key in _prefetched:
+        da = _prefetched[key].result()[key]
+    else:
+        da = select_year(open_variable(path, compact=compact and not regrid), year).transpose('time', 'lat', 'lon')
+    if regrid:
+        method, resolution = regrid
+        da = regrid_array(da, resolution, method, cache_dir, memory_budget_mb, _regrid_threads)
+    return da
+
+
+def prefetch_key(path, year, compact):
+    return os.path.abspath(path), year, bool(compact)
+
+
+def prefetch_year(year, files, raw_variables=()):
+    """Reads one year of every input file into memory, as `load_year` would open it without regridding.
+
+    Variables in `raw_variables` keep their packed on-disk form (compact
+    mode). Runs in the background thread of `read_ahead`; returns the
+    arrays by `prefetch_key`.
+    """
+    arrays = {}
+    for variable, path in files.items():
+        compact = variable in raw_variables
+        da = select_year(open_variable(path, compact=compact), year).transpose('time', 'lat', 'lon')
+        arrays[prefetch_key(path, year, compact)] = da.load()
+    return arrays
+
+
+def open_spei(spei_file):
+    """Opens the monthly SPEI lazily."""
+    return xr.open_dataset(spei_file, engine=NETCDF_ENGINE)['spei']
+
+
+def thresholds_in_units(values, thresholds):
+    """Converts thresholds to the units of `values`, raw packed integers included.
+
+    For packed data each threshold becomes the largest raw integer whose
+    decoded value (raw * scale_factor + add_offset, in the float type xarray
+    would decode to) does not exceed it, so `raw > threshold` gives exactly
+    the same days as comparing the decoded values.
+    """
+    if not np.issubdtype(values.dtype, np.integer):
+        return list(thresholds)
+    scale = np.asarray(values.attrs.get('scale_factor', 1.0))
+    offset = np.asarray(values.attrs.get('add_offset', 0.0))
+    float_dtype = np.float32 if scale.dtype == np.float32 and offset.dtype == np.float32 else np.float64
+
+    def decode(raw):
+        return np.asarray(raw, dtype=float_dtype) * scale.astype(float_dtype) + offset.astype(float_dtype)
+
+    info = np.iinfo(values.dtype)
+    raw_thresholds = []
+    for t in thresholds:
+        t = float_dtype(t)
+        raw = int(np.floor((float(t) - float(offset)) / float(scale)))
+        while decode(raw + 1) <= t:
+            raw += 1
+        while decode(raw) > t:
+            raw -= 1
+        raw_thresholds.append(int(np.clip(raw, info.min, info.max)))
+    return raw_thresholds
+
+
+def values_for_thresholds(da, thresholds, values=None):
+    """Values of `da` ready for `> threshold` tests; integer fill values never exceed a threshold.
+
+    `values` replaces the data of `da`, e.g. by the gathered cropland cells.
+    """
+    values = da.values if values is None else values
+    fill = da.attrs.get('_FillValue', da.attrs.get('missing_value'))
+    if np.issubdtype(values.dtype, np.integer) and fill is not None and fill > min(thresholds):
+        values = np.where(values == fill, np.iinfo(values.dtype).min, values)
+    return values
+
+
+def month_blocks(times):
+    """Splits a daily time axis into runs of consecutive days in the same calendar month.
+
+    Returns the month key (year * 12 + month - 1) and the time slice of each run.
+    """
+    keys = times.dt.year.values * 12 + times.dt.month.values - 1
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    stops = np.r_[starts[1:], len(keys)]
+    return keys[starts], [slice(start, stop) for start, stop in zip(starts, stops)]
+
+
+def growing_season_by_month(month_keys, static):
+    """Growing-season mask per calendar month, one (lat, lon) field per month key.
+
+    The season is defined on whole months, so this holds the same
+    information as a daily mask at a fraction of the size.
+    """
+    month_starts = (np.asarray(month_keys) - 1970 * 12).astype('datetime64[M]').astype('datetime64[ns]')
+    times = xr.DataArray(month_starts, dims='month')
+    gs_mask = create_growing_season_mask_vectorized(times, static['gs_start_month'], static['gs_end_month'])
+    return gs_mask.transpose('month', 'lat', 'lon')
+
+
+def spei_for_months(spei, month_keys):
+    """Selects the monthly SPEI of the given month keys, NaN for months missing from the record.
+
+    Only the requested months are read, so memory-mapped or lazily opened
+    SPEI is never loaded in full.
+    """
+    spei = spei.transpose('time', 'lat', 'lon')
+    spei_keys = spei.time.dt.year.values * 12 + spei.time.dt.month.values - 1
+    pos = np.clip(np.searchsorted(spei_keys, month_keys), 0, len(spei_keys) - 1)
+    found = spei_keys[pos] == month_keys
+
+    values = np.full((len(month_keys), spei.sizes['lat'], spei.sizes['lon']), np.nan, dtype='float32')
+    if found.any():
+        values[found] = spei.isel(time=pos[found]).values
+    return xr.DataArray(values, coords={'month': month_keys, 'lat': spei.lat.values, 'lon': spei.lon.values},
+                        dims=('month', 'lat', 'lon'))
+
+
+def spei_on_grid(spei_months, lat, lon):
+    """Regrids monthly SPEI from `spei_for_months` to a target grid (nearest neighbour)."""
+    return spei_months.interp(lat=np.asarray(lat), lon=np.asarray(lon), method='nearest')
+
+
+def block_days(blocks):
+    """Position of the month block of every day, for `month_blocks` slices."""
+    return np.repeat(np.arange(len(blocks)), [block.stop - block.start for block in blocks])
+
+
+def count_days_above(values, blocks, thresholds, qualified_monthly, compact=False, day_of_year=None, season=None):
+    """Qualified days above each threshold per cell, for the daily values of one year.
+
+    `values` is (time, lat, lon), `blocks` are its month slices from
+    `month_blocks` and `qualified_monthly` holds one (lat, lon) day filter per
+    month, never expanded to a daily cube. With `season` = (start_day,
+    end_day) per cell, only days of year `day_of_year` within each cell's
+    season count. The tests and all thresholds are fused in one pass (see
+    `fused_counts.count_qualified_days`). With `compact` and without numba,
+    the heat masks and the filter are bit-packed 8 days per byte within
+    chunks of COMPACT_CHUNK_DAYS days, combined with a bytewise AND and
+    counted with popcounts instead; the counts are the same.
+
+    Returns a (n_thresholds, lat, lon) array, int16 (uint16 if compact).
+    """
+    dtype = 'uint16' if compact else 'int16'
+    day_month = block_days(blocks)
+    if not compact or season is not None or counting_kernel() is not None:
+        return count_qualified_days(values, thresholds, qualified_monthly, day_month, day_of_year, season, dtype)
+
+    counts = np.zeros((len(thresholds),) + values.shape[1:], dtype=dtype)
+    for start in range(0, len(day_month), COMPACT_CHUNK_DAYS):
+        stop = min(start + COMPACT_CHUNK_DAYS, len(day_month))
+        qualified = pack_days(qualified_monthly[day_month[start:stop]])
+        for j, threshold in enumerate(thresholds):
+            counts[j] += count_days(pack_days(values[start:stop] > threshold) & qualified)
+    return counts
+
+
+def season_totals(values, blocks, gs_monthly, offset=0.0, day_of_year=None, season=None):
+    """Sum of `values` + `offset` and number of valid days per cell over the growing season.
+
+    Missing values are skipped. With `season` (see `count_days_above`) the
+    season is also limited to the exact days of year. The sums are
+    accumulated in float64.
+    """
+    total = np.zeros(values.shape[1:], dtype='float64')
+    n_days = np.zeros(values.shape[1:], dtype='int32')
+    for i, block in enumerate(blocks):
+        block_values = values[block].astype('float64') + offset
+        valid = gs_monthly[i] & ~np.isnan(block_values)
+        if season is not None:
+            valid &= season_days(day_of_year[block], *season)
+        total += np.where(valid, block_values, 0.0).sum(axis=0)
+        n_days += valid.sum(axis=0, dtype='int32')
+    return total, n_days
+
+
+def spell_days(values, threshold, qualified, day_of_year, season=None):
+    """Daily spell condition of one month block: above `threshold`, qualified and, with `season`, in season."""
+    days = (values > threshold) & qualified
+    if season is not None:
+        days &= season_days(day_of_year, *season)
+    return days
+
+
+def gather_cells(values, cells):
+    """(time, lat, lon) values of the flat cells `cells` as a (time, cell) array."""
+    return values.reshape(values.shape[0], -1)[:, cells]
+
+
+def band_monthly(month_keys, static, rows, spei_months=None, by_day=False):
+    """Growing-season mask and monthly SPEI of the months `month_keys` on the rows `rows` of the grid.
+
+    Only the band is built, so banded runs never hold a whole-grid field of
+    every month. `spei_months` is the monthly SPEI on its own grid (see
+    `spei_for_months`), regridded here to the band's cells. With `by_day`
+    every month may hold season days (the days of year decide), so the mask
+    is all True.
+    """
+    band_static = static.isel(lat=rows)
+    with profiling.stage('growing_season'):
+        if by_day:
+            gs_monthly = np.ones((len(month_keys), band_static.sizes['lat'], band_static.sizes['lon']), dtype=bool)
+        else:
+            gs_monthly = growing_season_by_month(month_keys, band_static).values
+    spei_monthly = None
+    if spei_months is not None:
+        with profiling.stage('spei') as info:
+            spei_monthly = spei_on_grid(spei_months, band_static.lat, band_static.lon).values
+            info['bytes'] = spei_monthly.nbytes
+    return gs_monthly, spei_monthly
+
+
+def band_fields(variables, rows, metrics, monthly, static, compact=False, cells=None, season=None):
+    """Annual per-cell fields of every metric for one latitude band of one year.
+
+    `variables` maps variable names to lazily opened (time, lat, lon) arrays
+    of the year; each is read once for all of its metrics. `monthly` maps a
+    month key tuple to the monthly SPEI of those months on the SPEI grid
+    (None without SPEI metrics); the season masks and SPEI of the band are
+    built from it and the static inputs `static` (see `band_monthly`).
+    `season` = (start_day, end_day) on the full grid limits the season to
+    those days of year as well. With `cells`
+    (flat indices within the band), the daily values, season masks and SPEI
+    are gathered to those cells right after reading and every field is
+    computed for them only, as (cell,) arrays.
+    """
+    fields = {}
+    # Band masks and SPEI by month key tuple, shared by the variables of the same months
+    band_months = {}
+    for variable, da in variables.items():
+        var_metrics = [m for m in metrics if m.variable == variable]
+        with profiling.stage('read', variable=variable) as info:
+            block = da.isel(lat=rows).load()
+            info['bytes'] = block.nbytes
+        month_keys, blocks = month_blocks(block.time)
+        if tuple(month_keys) not in band_months:
+            band_months[tuple(month_keys)] = band_monthly(month_keys, static, rows, monthly[tuple(month_keys)],
+                                                          season is not None)
+        gs_monthly, spei_monthly = band_months[tuple(month_keys)]
+        band_season = None if season is None else [bound[rows] for bound in season]
+        data = block.values
+        if cells is not None:
+            with profiling.stage('gather', variable=variable) as info:
+                data = gather_cells(data, cells)
+                gs_monthly = gather_cells(gs_monthly, cells)
+                spei_monthly = None if spei_monthly is None else gather_cells(spei_monthly, cells)
+                band_season = None if season is None else [bound.reshape(-1)[cells] for bound in band_season]
+                info['bytes'] = data.nbytes
+        day_of_year = block.time.dt.dayofyear.values
+
+        counts = [m for m in var_metrics if m.kind == 'count']
+        spells = [m for m in var_metrics if m.kind in SPELL_KINDS]
+        if counts or spells:
+            thresholds = thresholds_in_units(block, [m.threshold for m in counts + spells])
+            values = values_for_thresholds(block, thresholds, data)
+            # One day filter per SPEI cutoff, shared by all thresholds with that cutoff
+            for spei_below in dict.fromkeys(m.spei_below for m in counts):
+                group = [j for j, m in enumerate(counts) if m.spei_below == spei_below]
+                qualified = gs_monthly if spei_below is None else gs_monthly & (spei_monthly < spei_below)
+                with profiling.stage('count', variable=variable):
+                    group_counts = count_days_above(values, blocks, [thresholds[j] for j in group], qualified,
+                                                    compact, day_of_year, band_season)
+                for k, j in enumerate(group):
+                    fields[counts[j].name] = group_counts[k]
+
+        # The run-length state of each spell condition; the spell metrics are derived from it
+        # once the neighbouring years are known (see `join_spells`)
+        for j, m in enumerate(spells):
+            key = spell_condition(m)
+            if f"{key}_lead" in fields:
+                continue
+            threshold = thresholds[len(counts) + j]
+            qualified = gs_monthly if m.spei_below is None else gs_monthly & (spei_monthly < m.spei_below)
+            with profiling.stage('spells', variable=variable):
+                state = spell_state((spell_days(values[b], threshold, qualified[i], day_of_year[b], band_season),
+                                     day_of_year[b]) for i, b in enumerate(blocks))
+            fields.update({f"{key}_{part}": state[part] for part in SPELL_PARTS})
+
+        totals = {}
+        for m in var_metrics:
+            if m.kind == 'count' or m.kind in SPELL_KINDS:
+                continue
+            if m.offset not in totals:
+                with profiling.stage('season_totals', variable=variable):
+                    totals[m.offset] = season_totals(data, blocks, gs_monthly, m.offset, day_of_year, band_season)
+            total, n_days = totals[m.offset]
+            if m.kind == 'mean':
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    fields[m.name] = np.where(n_days > 0, total / n_days, np.nan)
+            else:
+                fields[m.name] = total
+    return fields
+
+
+def rows_per_block(n_days, n_lon, memory_budget_mb, compact=False):
+    """Number of latitude rows per block that fits in the memory budget."""
+    bytes_per_cell_day = BYTES_PER_CELL_DAY_COMPACT if compact else BYTES_PER_CELL_DAY
+    row_bytes = n_days * n_lon * bytes_per_cell_day
+    return max(1, int(memory_budget_mb * 2**20 // row_bytes))
+
+
+def region_means(annual_vars, static, regions_file, cache_dir, region_weights='mask'):
+    """Area-weighted regional means of annual (year, lat, lon) fields.
+
+    With `region_weights` 'overlap', cells are weighted by the fraction of
+    their area inside each polygon of `regions_file` (one sparse matrix
+    product per variable); otherwise by the country mask of the static inputs.
+    """
+    if region_weights == 'overlap':
+        fractions, codes = load_region_fractions(static.lat.values, static.lon.values, regions_file, cache_dir)
+        return overlap_region_means(annual_vars, static['area_weights'], fractions, codes)
+    return weighted_region_means(annual_vars, static['area_weights'], static['country_mask'])
+
+
+def spell_fields(fields, metrics, carries=None):
+    """Per-cell fields of the spell metrics from the spell states in `fields`.
+
+    `carries` maps a spell condition to the (carry_in, carry_out) run
+    lengths at the year's boundaries (see `spells.spell_statistics`);
+    without them the year is taken on its own.
+    """
+    statistics = {}
+    for m in metrics:
+        if m.kind not in SPELL_KINDS:
+            continue
+        key = spell_condition(m)
+        if key not in statistics:
+            state = {part: fields[f"{key}_{part}"] for part in SPELL_PARTS}
+            carry_in, carry_out = carries[key] if carries else (0, 0)
+            statistics[key] = dict(zip(SPELL_KINDS, spell_statistics(state, carry_in, carry_out)))
+    return {m.name: statistics[spell_condition(m)][m.kind] for m in metrics if m.kind in SPELL_KINDS}
+
+
+def annual_region_means(year, fields, metrics, static, regions_file, cache_dir, region_weights='mask'):
+    """Regional means of the (lat, lon) field of every metric of one year (see `region_means`).
+
+    Spell onsets are averaged over the cells with a spell only.
+    """
+    coords = {'year': [year], 'lat': static.lat.values, 'lon': static.lon.values}
+    annual = {}
+    for m in metrics:
+        values = fields[m.name]
+        if m.kind == 'onset':
+            has_spell = ~np.isnan(values)
+            annual[f"{m.name}_cells"] = xr.DataArray(has_spell[None], coords=coords, dims=('year', 'lat', 'lon'))
+            values = np.where(has_spell, values, 0.0)
+        annual[m.name] = xr.DataArray(values[None], coords=coords, dims=('year', 'lat', 'lon'))
+    df = region_means(annual, static, regions_file, cache_dir, region_weights)
+    for m in metrics:
+        if m.kind == 'onset':
+            cells = df.pop(f"{m.name}_cells")
+            with np.errstate(invalid='ignore', divide='ignore'):
+                df[m.name] = np.where(cells > 0, df[m.name] / cells, np.nan)
+    return df
+
+
+def regions_suffix(regions_file, default_file):
+    """File name suffix for results aggregated to a regions file other than the default countries."""
+    if os.path.abspath(regions_file) == os.path.abspath(default_file):
+        return ""
+    return "_" + os.path.splitext(os.path.basename(regions_file))[0]
+
+
+def fill_value(dtype):
+    """Value of the cells left out by `cropland_only`: NaN for floats, 0 or False otherwise."""
+    return np.nan if np.issubdtype(dtype, np.floating) else 0
+
+
+def aggregate_grid(year, variables, spei, metrics, static_files, cache_dir, memory_budget_mb=None, compact=False,
+                   region_weights='mask', cropland_only=False, growing_season='month'):
+    """Country means of the metrics of one year for variables that share a grid.
+
+    The static inputs, SPEI and growing-season masks are prepared once and
+    shared by every variable and metric, one latitude band at a time. With
+    `cropland_only` the cells without maize area are left out right after
+    reading (see `band_fields`); in the per-cell fields they are NaN or 0.
+    Returns the aggregated DataFrame, the static inputs and the annual
+    (lat, lon) field of every metric; for spell metrics, the spell states
+    instead, and the table holds the year on its own.
+    """
+    first = next(iter(variables.values()))
+    with profiling.stage('static_inputs'):
+        static = load_static_inputs(first.isel(time=0, drop=True), *static_files, cache_dir)
+    n_lat, n_lon = first.sizes['lat'], first.sizes['lon']
+
+    if any(m.kind == 'count' for m in metrics):
+        with profiling.stage('kernel'):
+            # Imports numba and loads the compiled counting kernel once per process
+            counting_kernel()
+
+    needs_spei = any(m.spei_below is not None for m in metrics)
+    season = None
+    if growing_season == 'day':
+        season = [np.asarray(static[name].transpose('lat', 'lon').values) for name in ('gs_start_day', 'gs_end_day')]
+    # Monthly SPEI on its own grid, read once per year; each band regrids only its rows (see `band_monthly`)
+    monthly = {}
+    for da in variables.values():
+        month_keys, _ = month_blocks(da.time)
+        if tuple(month_keys) not in monthly:
+            spei_months = None
+            if needs_spei:
+                with profiling.stage('spei_read') as info:
+                    spei_months = spei_for_months(spei, month_keys)
+                    info['bytes'] = spei_months.nbytes
+            monthly[tuple(month_keys)] = spei_months
+
+    first_row, last_row = 0, n_lat
+    cropland = None
+    if cropland_only:
+        cropland = np.asarray(static['area_weights'].transpose('lat', 'lon').values) > 0
+        crop_rows = np.flatnonzero(cropland.any(axis=1))
+        if len(crop_rows) == 0:
+            raise ValueError(f"No cells with maize area on the grid of {year}")
+        first_row, last_row = crop_rows[0], crop_rows[-1] + 1
+        print(f"  Year {year}: {cropland.sum()} of {cropland.size} cells have maize area")
+
+    block_rows = last_row - first_row
+    if memory_budget_mb:
+        n_days = sum(da.sizes['time'] for da in variables.values())
+        block_rows = rows_per_block(n_days, n_lon, memory_budget_mb, compact)
+        print(f"  Year {year}: {-(-(last_row - first_row) // block_rows)} blocks of {block_rows} latitude rows")
+
+    fields = {}
+    for row_start in range(first_row, last_row, block_rows):
+        rows = slice(row_start, min(row_start + block_rows, last_row))
+        cells = None
+        if cropland is not None:
+            cells = np.flatnonzero(cropland[rows])
+            if len(cells) == 0:
+                continue
+        with profiling.stage('band', rows=[rows.start, rows.stop]):
+            band = band_fields(variables, rows, metrics, monthly, static, compact, cells, season)
+        for name, values in band.items():
+            if name not in fields:
+                fields[name] = np.full((n_lat, n_lon), fill_value(values.dtype), dtype=values.dtype)
+            if cells is None:
+                fields[name][rows] = values
+            else:
+                fields[name].reshape(-1)[rows.start * n_lon + cells] = values
+
+    annual = dict(fields, **spell_fields(fields, metrics))
+    with profiling.stage('region_means'):
+        df = annual_region_means(year, annual, metrics, static, static_files[2], cache_dir, region_weights)
+    return df, static, fields
+
+
+def process_year(year, files, spei, metrics, static_files, cache_dir, memory_budget_mb=None, compact=False,
+                 iso_col=None, regrid=None, region_weights='mask', grid_paths=None, cropland_only=False,
+                 growing_season='month'):
+    """Computes every metric of one year per country, reading each input file once.
+
+    Variables on different grids are aggregated separately and joined by
+    country. With `grid_paths` ({year: path}), the annual per-cell fields
+    (and spell states) are also saved to the year's path for
+    `grid_store.write_grid_store` and `join_spells`; all variables must then
+    be on one grid.
+    """
+    print(f"--- Processing year {year}: {', '.join(os.path.basename(path) for path in files.values())} ---")
+
+    with profiling.stage('year', year=year):
+        grids = {}
+        for variable, path in files.items():
+            var_metrics = [m for m in metrics if m.variable == variable]
+            raw = compact and all(m.kind == 'count' for m in var_metrics)
+            with profiling.stage('open', variable=variable, file=os.path.basename(path)):
+                da = load_year(path, year, raw, regrid, cache_dir, memory_budget_mb)
+            grids.setdefault(grid_digest(da.lat.values, da.lon.values), {})[variable] = da
+
+        if grid_paths and len(grids) > 1:
+            raise ValueError(f"Gridded output and spell metrics need all variables of {year} on one grid; "
+                             "regrid them first")
+
+        df = static = None
+        for variables in grids.values():
+            grid_metrics = [m for m in metrics if m.variable in variables]
+            grid_df, static, fields = aggregate_grid(year, variables, spei, grid_metrics, static_files, cache_dir,
+                                                     memory_budget_mb, compact, region_weights, cropland_only,
+                                                     growing_season)
+            df = grid_df if df is None else df.merge(grid_df, on=['year', 'country_code'], how='outer')
+
+        if grid_paths:
+            with profiling.stage('grid_piece', year=year):
+                save_grid_piece(grid_paths[year], year, static.lat.values, static.lon.values, fields)
+
+    country_name_map, country_iso_map = region_labels(static, iso_col)
+    df = df.sort_values('country_code')
+    df['country_iso'] = df['country_code'].map(country_iso_map)
+    df['country'] = df['country_code'].map(country_name_map)
+    return df.drop(columns='country_code')
+
+
+def catalog_years(sources, years=None, spei_file=None, catalog_file=None, workers=1):
+    """Maps every year to the file holding it for each variable.
+
+    `sources` maps variable names to lists of files; files may hold one or
+    several years. The years come from the metadata index of
+    `input_catalog` (kept in `catalog_file`; only new or changed files are
+    scanned, in parallel with `workers` processes), so no data is read and
+    indexed files are not even opened. With `years` = (first, last) only
+    that range is kept. The inputs are checked before any work starts
+    (one grid per variable, units, complete years, the SPEI months of the
+    years for `spei_file`), and a ValueError lists every problem found.
+    Returns {year: {variable: file}} in year order.
+    """
+    year_sources = {}
+    problems = []
+    for variable, files in sources.items():
+        if not files:
+            raise FileNotFoundError(f"No input files for {variable}")
+        records = build_catalog(files, catalog_file, workers)
+        variable_issues, warnings = variable_problems(variable, records, years)
+        problems += variable_issues
+        for warning in warnings:
+            print(f"Warning: {warning}")
+        for path, record in zip(files, records):
+            for year in map(int, record.get('steps', {})):
+                if years is None or years[0] <= year <= years[1]:
+                    year_sources.setdefault(year, {})[variable] = path
+    if years and not year_sources:
+        raise ValueError(f"No input files hold the years {years[0]}-{years[1]}")
+    if spei_file and year_sources:
+        problems += spei_problems(build_catalog([spei_file], catalog_file)[0], sorted(year_sources))
+    if problems:
+        raise ValueError("The inputs are not ready for this run:\n  " + "\n  ".join(problems))
+    return dict(sorted(year_sources.items()))
+
+
+def input_stamp(path):
+    """Identifies a data file by path, size and modification time, without reading it."""
+    st = os.stat(path)
+    return f"{os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns}"
+
+
+def checkpoint_keys(year_sources, config, static_files, spei_file=None):
+    """Checkpoint key of every year.
+
+    A key covers the task configuration, the content of the static input
+    files, the size and mtime of the year's data files and the SPEI values
+    of the year's twelve months, so extending the SPEI record with new months
+    does not invalidate the years already done.
+    """
+    base = hashlib.sha1()
+    base.update(f"v{CHECKPOINT_VERSION} pandas {pd.__version__}".encode())
+    base.update(json.dumps(config, sort_keys=True).encode())
+    for path in static_files:
+        base.update(file_digest(path).encode())
+
+    spei = open_spei(spei_file) if spei_file else None
+    keys = {}
+    for year, files in year_sources.items():
+        h = base.copy()
+        for variable in sorted(files):
+            h.update(f"{variable}={input_stamp(files[variable])}".encode())
+        if spei is not None:
+            spei_values = spei_for_months(spei, np.arange(year * 12, year * 12 + 12)).values
+            h.update(np.ascontiguousarray(spei_values).tobytes())
+        keys[year] = h.hexdigest()[:20]
+    return keys
+
+
+def checkpoint_path(checkpoint_dir, year, key):
+    return os.path.join(checkpoint_dir, f"{year}_{key}.pkl")
+
+
+def grid_piece_path(checkpoint_dir, year, key):
+    """Annual per-cell fields saved next to the year's checkpoint, for the grid store."""
+    return os.path.join(checkpoint_dir, f"{year}_{key}.npz")
+
+
+def _checkpointed(task, checkpoint_dir, keys, year, files, spei):
+    """Runs `task` for one year and saves its result before returning it."""
+    df = task(year, files, spei)
+    path = checkpoint_path(checkpoint_dir, year, keys[year])
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with profiling.stage('checkpoint', year=year):
+        df.to_pickle(tmp_path)
+        os.replace(tmp_path, path)
+    return df
+
+
+def write_manifest(checkpoint_dir, year_sources, keys):
+    """Records which checkpoint and input files make up each year and removes stale checkpoints.
+
+    Entries and checkpoints of years outside `year_sources` (e.g. of a run
+    over another year range) are kept.
+    """
+    path = os.path.join(checkpoint_dir, "manifest.json")
+    manifest = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            manifest = json.load(f)
+    manifest.update({str(year): {'key': keys[year], 'files': files,
+                                 'checkpoint': os.path.basename(checkpoint_path(checkpoint_dir, year, keys[year]))}
+                     for year, files in year_sources.items()})
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+    # Grid pieces share the name of their checkpoint
+    current = {os.path.splitext(entry['checkpoint'])[0] for entry in manifest.values()}
+    years = {str(year) for year in year_sources}
+    for name in os.listdir(checkpoint_dir):
+        stem, ext = os.path.splitext(name)
+        if ext in ('.pkl', '.npz') and stem.split('_')[0] in years and stem not in current:
+            os.remove(os.path.join(checkpoint_dir, name))
+
+
+def job_spei(spei_file):
+    """The SPEI of a job, opened lazily once per process."""
+    if not spei_file:
+        return None
+    if spei_file not in _spei_files:
+        _spei_files[spei_file] = open_spei(spei_file)
+    return _spei_files[spei_file]
+
+
+def _init_worker(static_dirs, file_digests, jobs, regrid_threads=1):
+    """Attaches the memory-mapped static inputs and records the (task, SPEI file) of every job in a pool worker."""
+    global _worker_jobs, _regrid_threads
+    _worker_jobs = jobs
+    _regrid_threads = regrid_threads
+    # The workers already use every core between them
+    limit_threads(1)
+    for directory in static_dirs:
+        attach_static_inputs(directory, file_digests)
+
+
+def _run_on_worker(item):
+    j, year, files = item
+    task, spei_file = _worker_jobs[j]
+    return task(year, files, job_spei(spei_file))
+
+
+def job_static_inputs(job, todo):
+    """Static inputs of every input grid of a job, built or read once per grid and cached.
+
+    Returns {cache key: (static, cache_dir)}. Jobs on the same grid with the
+    same static files share one bundle (see `load_static_inputs`).
+    """
+    first_files = {}
+    for files in todo.values():
+        for variable, path in files.items():
+            first_files.setdefault(variable, path)
+    templates = [grid_template(job.regrid[1])] if job.regrid else [open_variable(path).isel(time=0, drop=True)
+                                                                   for path in first_files.values()]
+    statics = {}
+    for template in templates:
+        with profiling.stage('static_inputs'):
+            static = load_static_inputs(template, *job.static_files, job.cache_dir)
+        statics[static.attrs['cache_key']] = static, job.cache_dir
+    return statics
+
+
+def run_year_jobs(jobs, workers=1, prefetch=PREFETCH_DEPTH):
+    """Runs several YearJobs with one shared process pool; returns the results of each job in year order.
+
+    Every (job, year) task goes to the same pool, so a batch of many small
+    runs (e.g. an ensemble of models and scenarios) keeps all workers busy
+    instead of waiting for each run's last years. The static inputs are
+    prepared once per distinct grid and static files and shared read-only
+    (memory-mapped) with the workers; each worker opens the SPEI files of
+    its tasks lazily, once. Checkpoints are handled per job as in `run_years`.
+    In a single process, a background thread reads and decodes the inputs
+    of the next `prefetch` tasks while the current one is computed, holding
+    at most prefetch + 1 years in memory (see `prefetch_year`; jobs with
+    banded reads or regridding are not read ahead). Cores the pool leaves
+    idle, e.g. all of them in a single process, regrid time chunks in threads.
+    """
+    global _regrid_threads
+    results = [{} for _ in jobs]
+    tasks, todos, job_keys = [], [], []
+    for job, done in zip(jobs, results):
+        task = job.task
+        todo = dict(job.year_sources)
+        keys = None
+        if job.checkpoint_dir:
+            os.makedirs(job.checkpoint_dir, exist_ok=True)
+            keys = checkpoint_keys(job.year_sources, job.config, job.static_files, job.spei_file)
+            if job.resume:
+                for year in job.year_sources:
+                    path = checkpoint_path(job.checkpoint_dir, year, keys[year])
+                    if os.path.exists(path):
+                        done[year] = pd.read_pickle(path)
+                        del todo[year]
+                print(f"Checkpoints: {len(done)} of {len(job.year_sources)} years up to date, {len(todo)} to process")
+            else:
+                print(f"Recomputing all {len(todo)} years and refreshing their checkpoints")
+            task = partial(_checkpointed, task, job.checkpoint_dir, keys)
+        tasks.append(task)
+        todos.append(todo)
+        job_keys.append(keys)
+
+    items = [(j, year, files) for j, todo in enumerate(todos) for year, files in todo.items()]
+    if items:
+        print("Step 1: Loading non-timeseries data...")
+        statics = {}
+        fractions_done = set()
+        for job, todo in zip(jobs, todos):
+            if not todo:
+                continue
+            job_statics = job_static_inputs(job, todo)
+            statics.update(job_statics)
+            if job.region_weights == 'overlap':
+                for key, (static, _) in job_statics.items():
+                    if (key, job.static_files[2]) not in fractions_done:
+                        with profiling.stage('region_weights'):
+                            load_region_fractions(static.lat.values, static.lon.values, job.static_files[2],
+                                                  job.cache_dir)
+                        fractions_done.add((key, job.static_files[2]))
+
+        if workers <= 1 or len(items) <= 1:
+            def read(item):
+                j, year, files = item
+                return {} if jobs[j].prefetch is None else prefetch_year(year, files, jobs[j].prefetch)
+
+            dfs = []
+            _regrid_threads = max(1, workers)
+            try:
+                for (j, year, files), future in read_ahead(items, read, prefetch if len(items) > 1 else 0):
+                    if future is not None and jobs[j].prefetch is not None:
+                        _prefetched.update((prefetch_key(path, year, variable in jobs[j].prefetch), future)
+                                           for variable, path in files.items())
+                    try:
+                        dfs.append(tasks[j](year, files, job_spei(jobs[j].spei_file)))
+                    finally:
+                        _prefetched.clear()
+            finally:
+                _regrid_threads = 1
+        else:
+            initargs = ([export_static_inputs(static, cache_dir) for static, cache_dir in statics.values()],
+                        file_digest_memo(), [(task, job.spei_file) for task, job in zip(tasks, jobs)],
+                        max(1, workers // min(workers, len(items))))
+            dfs = map_in_order(_run_on_worker, items, workers, _init_worker, initargs)
+        for (j, year, _), df in zip(items, dfs):
+            results[j][year] = df
+
+    for job, keys in zip(jobs, job_keys):
+        if job.checkpoint_dir:
+            write_manifest(job.checkpoint_dir, job.year_sources, keys)
+    return [[done[year] for year in job.year_sources] for job, done in zip(jobs, results)]
+
+
+def run_years(task, year_sources, static_files, cache_dir, spei_file=None, workers=1, checkpoint_dir=None,
+              config=None, resume=True, regrid=None, region_weights='mask', prefetch=PREFETCH_DEPTH,
+              raw_variables=()):
+    """Runs `task(year, files, spei)` for every year and returns the results in year order.
+
+    The static inputs are prepared once per grid and shared read-only
+    (memory-mapped) with the workers. With `checkpoint_dir`, every year's
+    result is saved as soon as it is computed, keyed by `config` and the
+    inputs, and reused unless `resume` is False. The task must read its
+    inputs with `load_year`, in raw form for `raw_variables`; with
+    `raw_variables` None nothing is read ahead (see `run_year_jobs`).
+    """
+    raw_variables = None if raw_variables is None or regrid else frozenset(raw_variables)
+    job = YearJob(task, year_sources, static_files, cache_dir, spei_file, checkpoint_dir, config, resume, regrid,
+                  region_weights, raw_variables)
+    return run_year_jobs([job], workers, prefetch)[0]
+
+
+def join_spells(dfs, grid_paths, metrics, static, regions_file, cache_dir, region_weights='mask', store_dir=None):
+    """Replaces the spell columns of the per-year tables with spells joined across years.
+
+    `dfs` are the per-year tables of `run_years` and `grid_paths` ({year:
+    path}, in year order) their grid pieces holding the spell states. A
+    backward pass over the pieces finds how far the last spell of every
+    year goes on into the following years, a forward pass how long the
+    spell open at its start has lasted; only one year's states are in memory
+    at a time and consecutive years are joined. With `store_dir`, pieces
+    with the final spell fields in place of the states are written there for
+    the grid store.
+
+    Returns the paths of the pieces for the grid store.
+    """
+    spell_metrics = [m for m in metrics if m.kind in SPELL_KINDS]
+    keys = list(dict.fromkeys(spell_condition(m) for m in spell_metrics))
+    years = list(grid_paths)
+    carry_dir = tempfile.mkdtemp(prefix="spell_carries_")
+
+    def states(path):
+        fields = read_grid_piece(path)[3]
+        return fields, {key: {part: fields[f"{key}_{part}"] for part in SPELL_PARTS} for key in keys}
+
+    carry_out = None
+    for i in range(len(years) - 1, -1, -1):
+        if carry_out is None or years[i + 1] != years[i] + 1:
+            carry_out = {key: 0 for key in keys}
+        else:
+            next_states = states(grid_paths[years[i + 1]])[1]
+            carry_out = {key: carry_backward(next_states[key], carry_out[key]) for key in keys}
+        np.savez(os.path.join(carry_dir, f"{years[i]}.npz"), **{key: carry_out[key] for key in keys})
+
+    pieces = []
+    carry_in = {key: 0 for key in keys}
+    for i, year in enumerate(years):
+        if i > 0 and year != years[i - 1] + 1:
+            carry_in = {key: 0 for key in keys}
+        fields, year_states = states(grid_paths[year])
+        with np.load(os.path.join(carry_dir, f"{year}.npz")) as saved:
+            carries = {key: (carry_in[key], saved[key]) for key in keys}
+        joined = spell_fields(fields, spell_metrics, carries)
+        df = annual_region_means(year, joined, spell_metrics, static, regions_file, cache_dir, region_weights)
+        if len(df) != len(dfs[i]):
+            raise ValueError(f"Regions of the spell metrics of {year} do not match the other metrics")
+        for m in spell_metrics:
+            dfs[i][m.name] = df[m.name].to_numpy()
+        carry_in = {key: carry_forward(year_states[key], carry_in[key]) for key in keys}
+
+        if store_dir:
+            store_fields = {name: values for name, values in fields.items() if not name.startswith('spell_')}
+            store_fields.update(joined)
+            path = os.path.join(store_dir, f"{year}.npz")
+            save_grid_piece(path, year, static.lat.values, static.lon.values, store_fields)
+            pieces.append(path)
+    shutil.rmtree(carry_dir, ignore_errors=True)
+    return pieces if store_dir else list(grid_paths.values())
+
+
+# A run_metrics calculation: its YearJob and what finish_metrics needs afterwards
+MetricRun = namedtuple('MetricRun', ['job', 'metrics', 'grid_paths', 'piece_dir', 'grid_store'])
+
+
+def plan_metrics(metrics, sources, static_files, cache_dir, spei_file=None, memory_budget_mb=None, compact=False,
+                 iso_col=None, checkpoint_dir=None, resume=True, regrid=None, region_weights='mask', grid_store=None,
+                 cropland_only=False, years=None, workers=1, growing_season='month'):
+    """Sets up a `run_metrics` calculation without running it, reading only the input metadata.
+
+    Returns a MetricRun, whose job goes to `run_year_jobs`, possibly together
+    with other jobs, and whose results go to `finish_metrics`.
+    """
+    needs_spei = any(m.spei_below is not None for m in metrics)
+    if needs_spei and not spei_file:
+        raise ValueError("Metrics with an SPEI condition need spei_file")
+
+    used = {m.variable for m in metrics}
+    year_sources = catalog_years({variable: files for variable, files in sources.items() if variable in used},
+                                 years, spei_file if needs_spei else None, os.path.join(cache_dir, CATALOG_FILE),
+                                 workers)
+    # Only settings that change the results belong in the checkpoint key
+    config = {'task': 'metrics', 'metrics': [m._asdict() for m in metrics], 'iso_col': iso_col,
+              'regrid': list(regrid) if regrid else None, 'region_weights': region_weights}
+    if cropland_only:
+        # Same table, but the grid pieces leave out the cells without maize area
+        config['cropland_only'] = True
+    if growing_season != 'month':
+        config['growing_season'] = growing_season
+
+    spell_metrics = [m for m in metrics if m.kind in SPELL_KINDS]
+    grid_paths = piece_dir = None
+    if grid_store or spell_metrics:
+        if checkpoint_dir:
+            os.makedirs(checkpoint_dir, exist_ok=True)
+            keys = checkpoint_keys(year_sources, config, static_files, spei_file if needs_spei else None)
+            grid_paths = {year: grid_piece_path(checkpoint_dir, year, key) for year, key in keys.items()}
+            # A checkpoint without its grid piece (from a run without grid output) is recomputed
+            for year, key in keys.items():
+                path = checkpoint_path(checkpoint_dir, year, key)
+                if os.path.exists(path) and not os.path.exists(grid_paths[year]):
+                    os.remove(path)
+        else:
+            piece_dir = tempfile.mkdtemp(prefix="grid_pieces_")
+            grid_paths = {year: os.path.join(piece_dir, f"{year}.npz") for year in year_sources}
+
+    task = partial(process_year, metrics=metrics, static_files=static_files, cache_dir=cache_dir,
+                   memory_budget_mb=memory_budget_mb, compact=compact, iso_col=iso_col, regrid=regrid,
+                   region_weights=region_weights, grid_paths=grid_paths, cropland_only=cropland_only,
+                   growing_season=growing_season)
+    # Variables process_year reads in packed form, for reading the years ahead in the same form.
+    # Banded reads and regridding (which reads native data in time chunks) are not read ahead,
+    # so their memory stays bounded
+    raw_variables = None if memory_budget_mb or regrid else frozenset(
+        variable for variable in used
+        if compact and all(m.kind == 'count' for m in metrics if m.variable == variable))
+    job = YearJob(task, year_sources, static_files, cache_dir, spei_file if needs_spei else None, checkpoint_dir,
+                  config, resume, regrid, region_weights, raw_variables)
+    return MetricRun(job, metrics, grid_paths, piece_dir, grid_store)
+
+
+def finish_metrics(run, dfs):
+    """Joins the spells across years, writes the grid store and assembles the table of a MetricRun.
+
+    `dfs` are the per-year results of its job from `run_year_jobs`.
+    """
+    job, metrics, grid_paths = run.job, run.metrics, run.grid_paths
+    spell_metrics = [m for m in metrics if m.kind in SPELL_KINDS]
+    if grid_paths:
+        first_path = next(iter(job.year_sources.values()))[metrics[0].variable]
+        template = grid_template(job.regrid[1]) if job.regrid else open_variable(first_path).isel(time=0, drop=True)
+        static = load_static_inputs(template, *job.static_files, job.cache_dir)
+        pieces = list(grid_paths.values())
+        store_dir = tempfile.mkdtemp(prefix="grid_pieces_") if run.grid_store and spell_metrics else None
+        if spell_metrics:
+            with profiling.stage('join_spells'):
+                pieces = join_spells(dfs, grid_paths, metrics, static, job.static_files[2], job.cache_dir,
+                                     job.region_weights, store_dir)
+        if run.grid_store:
+            fractions = None
+            if job.region_weights == 'overlap':
+                fractions, _ = load_region_fractions(static.lat.values, static.lon.values, job.static_files[2],
+                                                     job.cache_dir)
+            with profiling.stage('grid_store'):
+                write_grid_store(run.grid_store, pieces, static, metrics, job.region_weights, fractions)
+        for directory in (run.piece_dir, store_dir):
+            if directory:
+                shutil.rmtree(directory, ignore_errors=True)
+
+    columns = ['year'] + [m.name for m in metrics] + ['country_iso', 'country']
+    return pd.concat(dfs, ignore_index=True).reindex(columns=columns)
+
+
+def run_metrics(metrics, sources, static_files, cache_dir, spei_file=None, workers=1, memory_budget_mb=None,
+                compact=False, iso_col=None, checkpoint_dir=None, resume=True, regrid=None,
+                region_weights='mask', grid_store=None, cropland_only=False, years=None, prefetch=PREFETCH_DEPTH,
+                growing_season='month'):
+    """Computes every metric per country and year in one read pass over the inputs.
+
+    `sources` maps the variables of the metrics to lists of input files and
+    `static_files` is the (maize area, growing season, regions) triple.
+    `workers`, `memory_budget_mb`, `compact`, `cropland_only` and `prefetch`
+    change how the work is done, not the results. `regrid` = (method,
+    resolution) regrids the inputs on the fly (see `load_year`), and
+    `grid_store` also writes the per-cell annual fields (see
+    `grid_store.write_grid_store`). Spell metrics are joined across years at
+    the end (see `join_spells`).
+
+    Returns a DataFrame with columns year, one per metric (NaN where the
+    variable has no data for that year), country_iso and country.
+    """
+    run = plan_metrics(metrics, sources, static_files, cache_dir, spei_file, memory_budget_mb, compact, iso_col,
+                       checkpoint_dir, resume, regrid, region_weights, grid_store, cropland_only, years, workers,
+                       growing_season)
+    return finish_metrics(run, run_year_jobs([run.job], workers, prefetch)[0])
@@ -0,0 +1,26 @@
+import numpy as np
+
+# Bits set in each byte value, for NumPy versions without np.bitwise_count
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype='uint8')
+
+
+def pack_days(mask):
+    """Bit-packs a boolean (time, ...) mask along time, 8 days per byte."""
+    return np.packbits(mask, axis=0)
+
+
+def unpack_days(packed, n_days):
+    """Inverse of `pack_days` for a mask of `n_days` time steps."""
+    return np.unpackbits(packed, axis=0, count=n_days).view(bool)
+
+
+def popcount(packed):
+    """Number of set bits in every byte of a packed mask."""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(packed)
+    return _POPCOUNT_TABLE[packed]
+
+
+def count_days(packed):
+    """Number of set days per cell of a packed (bytes, ...) mask, as uint16."""
+    return popcount(packed).sum(axis=0, dtype='uint16')
@@ -0,0 +1,75 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+# Default number of tasks whose inputs `read_ahead` reads in the background; each
+# one holds a year of input in memory
+PREFETCH_DEPTH = 1
+
+
+def default_workers():
+    """Number of usable CPU cores."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def save_shared_array(values, path):
+    """Writes an array to a .npy file that worker processes can memory-map."""
+    np.save(path, np.ascontiguousarray(values))
+    return path
+
+
+def open_shared_array(path):
+    """Opens an array written by `save_shared_array` as a read-only memory map."""
+    return np.load(path, mmap_mode='r')
+
+
+def map_in_order(func, items, workers=1, initializer=None, initargs=()):
+    """Applies `func` to every item and returns the results in input order.
+
+    With workers > 1 the items are spread over a process pool; `initializer`
+    runs once per worker and should attach the shared read-only inputs. With
+    a single worker everything runs in this process and `initializer` is not
+    called, so the caller's in-memory state is used directly.
+    """
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    workers = min(workers, len(items))
+    print(f"Processing {len(items)} tasks with {workers} worker processes...")
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as executor:
+        # executor.map yields results in submission order, whatever order they finish in
+        return list(executor.map(func, items))
+
+
+def read_ahead(items, read, depth=PREFETCH_DEPTH):
+    """Yields (item, future of `read(item)`) in order, reading up to `depth` items ahead.
+
+    A single background thread works through the items in order while the
+    caller processes the current one, so file reads and decoding overlap
+    with the computation even in a single process. At most depth + 1 results
+    are held at a time: the current item's and those read ahead. With depth
+    0 nothing is read ahead and the futures are None.
+    """
+    items = list(items)
+    if depth <= 0:
+        for item in items:
+            yield item, None
+        return
+
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="read_ahead")
+    pending = deque()
+    submitted = 0
+    try:
+        for i, item in enumerate(items):
+            while submitted < len(items) and submitted <= i + depth:
+                pending.append(executor.submit(read, items[submitted]))
+                submitted += 1
+            yield item, pending.popleft()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,197 @@
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+# off: no instrumentation; summary: table per stage at the end of the run;
+# json: one report with every record and the summary; jsonl: one line per record as it completes
+PROFILE_MODES = ['off', 'summary', 'json', 'jsonl']
+
+# Settings are passed to worker processes through the environment
+_MODE_ENV = 'CDHW_PROFILE'
+_FILE_ENV = 'CDHW_PROFILE_FILE'
+
+_mode = os.environ.get(_MODE_ENV, 'off')
+_spool = os.environ.get(_FILE_ENV)
+_output = None
+# Open stages of this process: (name, fields, start wall, start cpu, peak RSS so far)
+_stack = []
+# Returned when instrumentation is off, so a disabled stage costs one function call
+_DISABLED = contextlib.nullcontext({})
+
+_rss_resettable = None
+
+
+def _peak_rss():
+    """Peak resident set size in bytes since the last reset (since process start without reset).
+
+    None where neither /proc nor the resource module exist (native Windows).
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def _larger(a, b):
+    """The larger of two peaks, either of which may be unknown (None)."""
+    if a is None or b is None:
+        return b if a is None else a
+    return max(a, b)
+
+
+def _reset_peak_rss():
+    """Resets the peak RSS to the current RSS where the kernel allows it (Linux /proc/self/clear_refs)."""
+    global _rss_resettable
+    if _rss_resettable is False:
+        return
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        _rss_resettable = True
+    except OSError:
+        _rss_resettable = False
+
+
+def configure(mode='off', path=None):
+    """Switches the instrumentation for this process and the worker processes it starts.
+
+    In 'json' and 'jsonl' mode the report is written to `path`. Records are
+    appended to a spool file as stages complete (one short write per line,
+    so workers can share it); `finish` turns them into the report.
+    """
+    global _mode, _spool, _output
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"Unknown profile mode {mode!r}, expected one of {PROFILE_MODES}")
+    _mode = mode
+    _output = path
+    os.environ[_MODE_ENV] = mode
+    if mode == 'off':
+        _spool = None
+        os.environ.pop(_FILE_ENV, None)
+        return
+    if mode == 'jsonl':
+        _spool = path
+        open(path, 'w').close()
+    else:
+        fd, _spool = tempfile.mkstemp(prefix='cdhw_profile_', suffix='.jsonl')
+        os.close(fd)
+    os.environ[_FILE_ENV] = _spool
+
+
+def _write(record):
+    line = (json.dumps(record) + '\n').encode()
+    fd = os.open(_spool, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+@contextlib.contextmanager
+def _stage(name, fields):
+    if _stack:
+        # The peak of the enclosing stage so far, before this stage resets it
+        parent = _stack[-1]
+        parent[4] = _larger(parent[4], _peak_rss())
+    _reset_peak_rss()
+    entry = [name, fields, time.perf_counter(), time.process_time(), None]
+    _stack.append(entry)
+    try:
+        yield fields
+    finally:
+        _stack.pop()
+        peak = _larger(entry[4], _peak_rss())
+        if _stack:
+            _stack[-1][4] = _larger(_stack[-1][4], peak)
+        context = {}
+        for _, outer_fields, _, _, _ in _stack:
+            context.update(outer_fields)
+        context.update(fields)
+        _write({
+            'stage': '/'.join([outer[0] for outer in _stack] + [name]),
+            'pid': os.getpid(),
+            'wall_s': time.perf_counter() - entry[2],
+            'cpu_s': time.process_time() - entry[3],
+            'peak_rss_mb': None if peak is None else peak / 2**20,
+            **context,
+        })
+
+
+def stage(name, **fields):
+    """Context manager timing one stage of a run.
+
+    Records wall time, CPU time of this process and peak RSS of the stage.
+    `fields` (year, file, ...) are recorded with it and with every stage
+    nested inside it; the yielded dict takes more, e.g. `info['bytes'] =
+    values.nbytes`. Stage names are joined with their enclosing stages
+    ('year/read'). Does nothing when the instrumentation is off.
+    """
+    if _mode == 'off':
+        return _DISABLED
+    return _stage(name, fields)
+
+
+def report_path(path, mode):
+    """`path` with the extension matching `mode` if it ends in .json or .jsonl."""
+    stem, ext = os.path.splitext(path)
+    if ext not in ('.json', '.jsonl'):
+        return path
+    return stem + ('.jsonl' if mode == 'jsonl' else '.json')
+
+
+def read_records(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize(records):
+    """Totals per stage: calls, wall and CPU seconds, largest peak RSS and array bytes."""
+    summary = {}
+    for record in records:
+        row = summary.setdefault(record['stage'], {'stage': record['stage'], 'calls': 0, 'wall_s': 0.0,
+                                                   'cpu_s': 0.0, 'peak_rss_mb': None, 'bytes': 0})
+        row['calls'] += 1
+        row['wall_s'] += record['wall_s']
+        row['cpu_s'] += record['cpu_s']
+        row['peak_rss_mb'] = _larger(row['peak_rss_mb'], record['peak_rss_mb'])
+        row['bytes'] += record.get('bytes', 0)
+    return sorted(summary.values(), key=lambda row: row['stage'])
+
+
+def print_summary(summary):
+    print(f"{'stage':<40}{'calls':>7}{'wall s':>10}{'cpu s':>10}{'peak MB':>10}{'array MB':>10}")
+    for row in summary:
+        peak = "-" if row['peak_rss_mb'] is None else f"{row['peak_rss_mb']:.0f}"
+        print(f"{row['stage']:<40}{row['calls']:>7}{row['wall_s']:>10.2f}{row['cpu_s']:>10.2f}"
+              f"{peak:>10}{row['bytes'] / 2**20:>10.1f}")
+
+
+def finish():
+    """Writes the report of the run according to the mode set by `configure`."""
+    if _mode == 'off' or not _spool or not os.path.exists(_spool):
+        return
+    records = read_records(_spool)
+    summary = summarize(records)
+    print("--- Stage profile ---")
+    print_summary(summary)
+    if _mode == 'jsonl':
+        print(f"Stage records written to {_spool}")
+        return
+    os.remove(_spool)
+    if _mode == 'json':
+        with open(_output, 'w') as f:
+            json.dump({'records': records, 'summary': summary}, f, indent=2)
+        print(f"Stage report written to {_output}")
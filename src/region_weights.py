@@ -0,0 +1,102 @@
+import hashlib
+import os
+
+import numpy as np
+from scipy import sparse
+
+from regrid import cell_bounds
+from static_inputs import file_digest, grid_digest
+
+# Bump whenever the content or layout of the cached matrices changes.
+REGION_WEIGHTS_VERSION = 1
+
+# Matrices already loaded in this process, keyed by cache key.
+_loaded_weights = {}
+
+
+def build_region_fractions(regions, lat, lon):
+    """Sparse (regions, cells) fraction of each grid cell's area that lies inside each region.
+
+    `regions` is a GeoDataFrame of polygons in lon/lat degrees; cells are
+    flattened latitude-major like a C-ordered (lat, lon) array. Cells fully
+    inside a polygon get 1 without any geometry clipping; only cells on a
+    boundary are intersected. Unlike a one-polygon-per-cell mask, a region
+    smaller than a cell still gets its share of that cell.
+    """
+    import shapely
+
+    lat_bounds = cell_bounds(lat, -90.0, 90.0)
+    lon_bounds = cell_bounds(lon)
+    n_lon = len(lon)
+
+    rows, cols, fractions = [], [], []
+    for r, geom in enumerate(regions.geometry.values):
+        if geom is None or geom.is_empty:
+            continue
+        minx, miny, maxx, maxy = geom.bounds
+        ilat = np.flatnonzero((lat_bounds[:, 1] > miny) & (lat_bounds[:, 0] < maxy))
+        ilon = np.flatnonzero((lon_bounds[:, 1] > minx) & (lon_bounds[:, 0] < maxx))
+        if not len(ilat) or not len(ilon):
+            continue
+        i, j = (index.ravel() for index in np.meshgrid(ilat, ilon, indexing='ij'))
+        boxes = shapely.box(lon_bounds[j, 0], lat_bounds[i, 0], lon_bounds[j, 1], lat_bounds[i, 1])
+
+        shapely.prepare(geom)
+        fraction = shapely.contains_properly(geom, boxes).astype('float64')
+        edge = (fraction == 0) & shapely.intersects(geom, boxes)
+        fraction[edge] = shapely.area(shapely.intersection(boxes[edge], geom)) / shapely.area(boxes[edge])
+
+        keep = fraction > 0
+        rows.append(np.full(keep.sum(), r))
+        cols.append(i[keep] * n_lon + j[keep])
+        fractions.append(fraction[keep])
+
+    if not rows:
+        return sparse.csr_matrix((len(regions), len(lat) * n_lon))
+    return sparse.csr_matrix((np.concatenate(fractions), (np.concatenate(rows), np.concatenate(cols))),
+                             shape=(len(regions), len(lat) * n_lon))
+
+
+def region_weights_key(lat, lon, regions_file):
+    """Cache key for the overlap matrix of `regions_file` on a grid."""
+    h = hashlib.sha1()
+    h.update(f"v{REGION_WEIGHTS_VERSION}".encode())
+    h.update(grid_digest(lat, lon).encode())
+    h.update(file_digest(regions_file).encode())
+    return h.hexdigest()[:20]
+
+
+def load_region_fractions(lat, lon, regions_file, cache_dir):
+    """Returns the (regions, cells) overlap matrix and region codes of `regions_file`, building them once.
+
+    Matrices are kept in memory for the lifetime of the process and saved
+    to `cache_dir` as npz files keyed by the grid and the content of the
+    regions file. Region codes are the row numbers of the polygons, the same
+    numbering as the country mask of the static inputs.
+    """
+    key = region_weights_key(lat, lon, regions_file)
+    if key in _loaded_weights:
+        return _loaded_weights[key]
+
+    path = os.path.join(cache_dir, f"region_weights_{key}.npz")
+    if os.path.exists(path):
+        with np.load(path) as bundle:
+            fractions = sparse.csr_matrix((bundle['data'], bundle['indices'], bundle['indptr']),
+                                          shape=tuple(bundle['shape']))
+            codes = bundle['codes']
+    else:
+        import geopandas as gpd
+
+        regions = gpd.read_file(regions_file)
+        print(f"Building fractional region weights for {len(regions)} regions on a {len(lat)}x{len(lon)} grid...")
+        fractions = build_region_fractions(regions, lat, lon)
+        codes = regions.index.values.astype('int64')
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez_compressed(tmp_path, data=fractions.data, indices=fractions.indices, indptr=fractions.indptr,
+                            shape=np.array(fractions.shape), codes=codes)
+        os.replace(tmp_path, path)
+        print(f"Region weights cached to {path}")
+
+    _loaded_weights[key] = fractions, codes
+    return fractions, codes
@@ -0,0 +1,278 @@
+import argparse
+import glob
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import numpy as np
+import xarray as xr
+from scipy import sparse
+
+import profiling
+from parallel import default_workers, map_in_order
+from static_inputs import grid_digest
+
+# 目标网格分辨率（度），与原 cdo remapbil 脚本使用的 0.5° 全球网格一致
+TARGET_RESOLUTION = 0.5
+REGRID_METHODS = ['bilinear', 'conservative']
+# Default number of days regridded per chunk when no memory budget is given
+REGRID_CHUNK_DAYS = 8
+# Rough peak bytes per (day, source cell) of one chunk: the decoded values, the
+# NaN-filled copy and the validity mask
+REGRID_BYTES_PER_CELL_DAY = 16
+
+# Weight matrices already built in this process, keyed by method and grid digests
+_weights = {}
+
+
+def global_grid(resolution=TARGET_RESOLUTION):
+    """Cell centres of a global regular lat-lon grid, latitudes south to north like cdo's lonlat grids."""
+    lat = np.arange(-90 + resolution / 2, 90, resolution)
+    lon = np.arange(-180 + resolution / 2, 180, resolution)
+    return np.round(lat, 6), np.round(lon, 6)
+
+
+def grid_template(resolution=TARGET_RESOLUTION):
+    """A (lat, lon) DataArray on the target grid, for aligning static inputs."""
+    lat, lon = global_grid(resolution)
+    template = xr.DataArray(np.zeros((len(lat), len(lon)), dtype='float32'), coords={'lat': lat, 'lon': lon},
+                            dims=('lat', 'lon'))
+    template.lat.attrs.update(standard_name='latitude', units='degrees_north', axis='Y')
+    template.lon.attrs.update(standard_name='longitude', units='degrees_east', axis='X')
+    return template
+
+
+def cell_bounds(centers, lower=None, upper=None):
+    """Lower and upper cell edges halfway between neighbouring centres, clipped to [lower, upper]."""
+    centers = np.asarray(centers, dtype='float64')
+    order = np.argsort(centers)
+    c = centers[order]
+    edges = np.r_[c[0] - (c[1] - c[0]) / 2, (c[1:] + c[:-1]) / 2, c[-1] + (c[-1] - c[-2]) / 2]
+    edges = np.clip(edges, lower if lower is not None else -np.inf, upper if upper is not None else np.inf)
+    bounds = np.empty((len(c), 2))
+    bounds[order, 0] = edges[:-1]
+    bounds[order, 1] = edges[1:]
+    return bounds
+
+
+def linear_weights_1d(src, dst, period=None):
+    """Sparse (dst, src) linear interpolation weights along one axis.
+
+    With `period` the axis wraps around (longitude); otherwise targets beyond
+    the source range take the nearest edge value.
+    """
+    src = np.asarray(src, dtype='float64')
+    dst = np.asarray(dst, dtype='float64')
+    order = np.argsort(src)
+    s = src[order]
+    if period:
+        s = np.r_[s[-1] - period, s, s[0] + period]
+        index = np.r_[order[-1], order, order[0]]
+        x = (dst - s[1]) % period + s[1]
+    else:
+        index = order
+        x = np.clip(dst, s[0], s[-1])
+
+    j = np.clip(np.searchsorted(s, x, side='right') - 1, 0, len(s) - 2)
+    frac = (x - s[j]) / (s[j + 1] - s[j])
+    rows = np.repeat(np.arange(len(dst)), 2)
+    cols = np.c_[index[j], index[j + 1]].ravel()
+    weights = np.c_[1 - frac, frac].ravel()
+    return sparse.csr_matrix((weights, (rows, cols)), shape=(len(dst), len(src)))
+
+
+def overlap_weights_1d(src_bounds, dst_bounds, period=None):
+    """Sparse (dst, src) fraction of each target cell covered by each source cell along one axis."""
+    shifts = [-period, 0.0, period] if period else [0.0]
+    overlap = np.zeros((len(dst_bounds), len(src_bounds)))
+    for shift in shifts:
+        lo = np.maximum(dst_bounds[:, None, 0], src_bounds[None, :, 0] + shift)
+        hi = np.minimum(dst_bounds[:, None, 1], src_bounds[None, :, 1] + shift)
+        overlap += np.clip(hi - lo, 0, None)
+    overlap /= (dst_bounds[:, 1] - dst_bounds[:, 0])[:, None]
+    return sparse.csr_matrix(overlap)
+
+
+def bilinear_weights(src_lat, src_lon, dst_lat, dst_lon):
+    """Sparse (dst cells, src cells) bilinear weights between two rectilinear lat-lon grids.
+
+    Cells are flattened latitude-major, like a C-ordered (lat, lon) array.
+    """
+    return sparse.kron(linear_weights_1d(src_lat, dst_lat),
+                       linear_weights_1d(src_lon, dst_lon, period=360.0), format='csr')
+
+
+def conservative_weights(src_lat, src_lon, dst_lat, dst_lon):
+    """Sparse (dst cells, src cells) first-order conservative weights between two lat-lon grids.
+
+    Each weight is the fraction of the target cell's area covered by the
+    source cell; latitude overlaps are measured in sin(latitude), which is
+    proportional to area on the sphere.
+    """
+    sin_bounds = lambda lat: np.sin(np.deg2rad(cell_bounds(lat, -90.0, 90.0)))
+    lat_weights = overlap_weights_1d(sin_bounds(src_lat), sin_bounds(dst_lat))
+    lon_weights = overlap_weights_1d(cell_bounds(src_lon), cell_bounds(dst_lon), period=360.0)
+    return sparse.kron(lat_weights, lon_weights, format='csr')
+
+
+def regrid_weights(src_lat, src_lon, dst_lat, dst_lon, method='bilinear', cache_dir=None):
+    """Weight matrix for a source->target grid pair, built once.
+
+    Matrices are kept in memory for the lifetime of the process and, with
+    `cache_dir`, saved as sparse npz files keyed by the method and both grids
+    so other files, workers and runs reuse them.
+    """
+    if method not in REGRID_METHODS:
+        raise ValueError(f"Unknown regridding method {method!r}, choose from {REGRID_METHODS}")
+    key = f"{method}_{grid_digest(src_lat, src_lon)[:12]}_{grid_digest(dst_lat, dst_lon)[:12]}"
+    if key in _weights:
+        return _weights[key]
+
+    path = os.path.join(cache_dir, f"regrid_{key}.npz") if cache_dir else None
+    if path and os.path.exists(path):
+        weights = sparse.load_npz(path).tocsr()
+    else:
+        print(f"Building {method} regridding weights {len(src_lat)}x{len(src_lon)} -> {len(dst_lat)}x{len(dst_lon)}...")
+        build = bilinear_weights if method == 'bilinear' else conservative_weights
+        weights = build(src_lat, src_lon, dst_lat, dst_lon)
+        weights.eliminate_zeros()
+        if path:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = f"{path[:-4]}.{os.getpid()}.tmp.npz"
+            sparse.save_npz(tmp_path, weights)
+            os.replace(tmp_path, path)
+    _weights[key] = weights
+    return weights
+
+
+def apply_weights(weights, values):
+    """Regrids a (time, lat, lon) block with a weight matrix from `regrid_weights`.
+
+    Missing source values are left out and the remaining weights are
+    renormalised, so a target cell is missing only when none of its source
+    cells has data. Returns a (time, target cells) float32 array.
+    """
+    flat = np.asarray(values, dtype='float32').reshape(len(values), -1).T
+    valid = ~np.isnan(flat)
+    total = weights @ np.where(valid, flat, 0.0)
+    covered = weights @ valid.astype('float32')
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result = np.where(covered > 0, total / covered, np.nan)
+    return result.T.astype('float32')
+
+
+def chunk_days(n_src_cells, memory_budget_mb=None):
+    """Days per regridding chunk, from the memory budget if one is given."""
+    if not memory_budget_mb:
+        return REGRID_CHUNK_DAYS
+    return max(1, int(memory_budget_mb * 2**20 // (n_src_cells * REGRID_BYTES_PER_CELL_DAY)))
+
+
+def regrid_array(da, resolution=TARGET_RESOLUTION, method='bilinear', cache_dir=None, memory_budget_mb=None,
+                 threads=1):
+    """Regrids a lazily opened (time, lat, lon) DataArray to the global grid of `resolution`.
+
+    The source is read in time chunks, so only `threads` chunks of the
+    native resolution data are in memory at a time; with threads > 1 the
+    chunks are regridded in a thread pool (the sparse products release the
+    GIL) and the memory budget is shared between them. Arrays already on
+    the target grid are returned unchanged.
+    """
+    da = da.transpose('time', 'lat', 'lon')
+    dst_lat, dst_lon = global_grid(resolution)
+    if np.array_equal(da.lat.values, dst_lat) and np.array_equal(da.lon.values, dst_lon):
+        return da
+    weights = regrid_weights(da.lat.values, da.lon.values, dst_lat, dst_lon, method, cache_dir)
+
+    n_time = da.sizes['time']
+    out = np.empty((n_time, len(dst_lat) * len(dst_lon)), dtype='float32')
+    threads = max(1, threads)
+    step = chunk_days(da.sizes['lat'] * da.sizes['lon'], memory_budget_mb and memory_budget_mb / threads)
+    chunks = [slice(start, min(start + step, n_time)) for start in range(0, n_time, step)]
+
+    def regrid_chunk(chunk):
+        # Every chunk fills its own rows of `out`
+        out[chunk] = apply_weights(weights, da.isel(time=chunk).values)
+
+    with profiling.stage('regrid', method=method, threads=threads) as info:
+        if threads == 1 or len(chunks) == 1:
+            for chunk in chunks:
+                regrid_chunk(chunk)
+        else:
+            with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="regrid") as executor:
+                list(executor.map(regrid_chunk, chunks))
+        info['bytes'] = out.nbytes
+
+    regridded = xr.DataArray(out.reshape(n_time, len(dst_lat), len(dst_lon)),
+                             coords={'time': da.time.values, 'lat': dst_lat, 'lon': dst_lon},
+                             dims=('time', 'lat', 'lon'), name=da.name, attrs=da.attrs)
+    return regridded
+
+
+def regrid_file(src_path, dst_path, resolution=TARGET_RESOLUTION, method='bilinear', cache_dir=None,
+                memory_budget_mb=None, threads=1):
+    """Regrids the first variable of a NetCDF file and writes it to `dst_path`, with `threads` chunks at a time."""
+    print(f"  -> 处理 {os.path.basename(src_path)} ...")
+    with xr.open_dataset(src_path) as ds:
+        name = list(ds.data_vars)[0]
+        regridded = regrid_array(ds[name], resolution, method, cache_dir, memory_budget_mb, threads)
+        out = regridded.drop_vars('spatial_ref', errors='ignore').to_dataset(name=name)
+        out['lat'].attrs.update(standard_name='latitude', units='degrees_north', axis='Y')
+        out['lon'].attrs.update(standard_name='longitude', units='degrees_east', axis='X')
+        out.attrs = ds.attrs
+        tmp_path = f"{dst_path}.{os.getpid()}.tmp"
+        out.to_netcdf(tmp_path)
+    os.replace(tmp_path, dst_path)
+    return dst_path
+
+
+def main(indir, outdir=None, pattern="ERA5_MaxTemp_*.nc", resolution=TARGET_RESOLUTION, method='bilinear',
+         workers=1, memory_budget_mb=None):
+    """批量重采样：将 indir 下匹配的文件重采样到全球规则网格，写入 outdir
+
+    权重矩阵对每对源/目标网格只计算一次（缓存于 outdir/regrid_cache），
+    多进程时每个文件一个任务；文件数少于 workers 时，余下的核心在每个文件内按时间块多线程重采样。
+    """
+    suffix = f"_{resolution:g}deg"
+    outdir = outdir or f"{indir.rstrip(os.sep)}{suffix}"
+    files = sorted(glob.glob(os.path.join(indir, pattern)))
+    if not files:
+        raise FileNotFoundError(f"目录中没有匹配到 {pattern} 文件: {indir}")
+    os.makedirs(outdir, exist_ok=True)
+    cache_dir = os.path.join(outdir, "regrid_cache")
+
+    print(f"开始重采样（{method}, {resolution:g}°），输入目录：{indir}")
+    # 先在主进程构建并缓存权重，各进程直接读取
+    with xr.open_dataset(files[0]) as ds:
+        dst_lat, dst_lon = global_grid(resolution)
+        regrid_weights(ds.lat.values, ds.lon.values, dst_lat, dst_lon, method, cache_dir)
+
+    dst_paths = [os.path.join(outdir, os.path.basename(f)[:-len(".nc")] + suffix + ".nc") for f in files]
+    processes = max(1, min(workers, len(files)))
+    task = partial(_regrid_pair, resolution=resolution, method=method, cache_dir=cache_dir,
+                   memory_budget_mb=memory_budget_mb, threads=max(1, workers // processes))
+    map_in_order(task, list(zip(files, dst_paths)), workers)
+    print(f"全部完成！重采样结果已保存到：{outdir}")
+
+
+def _regrid_pair(paths, **kwargs):
+    return regrid_file(*paths, **kwargs)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="将逐日 NetCDF 文件重采样到全球规则网格（替代 cdo remapbil）")
+    parser.add_argument("indir", help="输入目录")
+    parser.add_argument("outdir", nargs="?", default=None, help="输出目录（默认：输入目录加 _0.5deg 后缀）")
+    parser.add_argument("--pattern", default="ERA5_MaxTemp_*.nc", help="输入文件匹配模式（默认: %(default)s）")
+    parser.add_argument("--resolution", type=float, default=TARGET_RESOLUTION, help="目标分辨率（度）")
+    parser.add_argument("--method", choices=REGRID_METHODS, default='bilinear', help="重采样方法")
+    parser.add_argument("--workers", type=int, default=1, help="并行数，每个文件一个进程，文件数较少时每个文件内按时间块多线程（0 表示使用全部核心）")
+    parser.add_argument("--memory-budget", type=float, default=None, metavar="MB",
+                        help="每次读取的时间块大小（MB），默认每次 8 天")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main(args.indir, args.outdir, args.pattern, args.resolution, args.method,
+         args.workers or default_workers(), args.memory_budget)
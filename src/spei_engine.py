@@ -0,0 +1,351 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import warnings
+from functools import partial
+
+import numpy as np
+import xarray as xr
+from scipy import special
+
+from metric_engine import catalog_years, input_stamp, load_year, month_blocks
+from parallel import map_in_order
+from static_inputs import grid_digest
+
+# Bump whenever the monthly climate or the fitted SPEI change for the same inputs.
+SPEI_VERSION = 2
+
+# Accumulation scales in months
+SPEI_SCALES = [1, 3, 6, 12]
+# SPEI is clipped to the normal quantiles of probabilities 0.001 and 0.999; values
+# at or below the fitted location parameter would otherwise be -inf
+SPEI_LIMIT = 3.09
+# Calendar months with fewer valid years in the reference period are left missing
+MIN_FIT_YEARS = 10
+# Grid cells per fitting task: every task fits all months of a latitude band
+BAND_CELLS = 50000
+
+KELVIN_OFFSET = 273.15
+
+
+def monthly_climate(item, cache_dir):
+    """Monthly precipitation totals (mm) and mean temperatures (degC) of one year.
+
+    `item` is (year, {'precip': file, 'temp': file}); daily precipitation is
+    in mm per day and temperature in Kelvin. Each month is read on its own,
+    so a year is never held in memory. The result is cached in `cache_dir`
+    by the size and mtime of both files; returns the path of the .npz file.
+    """
+    year, files = item
+    key = hashlib.sha1(json.dumps([SPEI_VERSION, year, input_stamp(files['precip']),
+                                   input_stamp(files['temp'])]).encode()).hexdigest()[:16]
+    path = os.path.join(cache_dir, f"{year}_{key}.npz")
+    if os.path.exists(path):
+        return path
+
+    precip = load_year(files['precip'], year)
+    temp = load_year(files['temp'], year)
+    if grid_digest(precip.lat, precip.lon) != grid_digest(temp.lat, temp.lon):
+        raise ValueError(f"Precipitation and temperature of {year} are on different grids")
+    month_keys, blocks = month_blocks(precip.time)
+    temp_keys, temp_blocks = month_blocks(temp.time)
+    if not np.array_equal(month_keys, temp_keys):
+        raise ValueError(f"Precipitation and temperature of {year} cover different months")
+
+    shape = (len(month_keys), precip.sizes['lat'], precip.sizes['lon'])
+    precip_total = np.empty(shape, dtype='float32')
+    temp_mean = np.empty(shape, dtype='float32')
+    days = np.empty(len(month_keys), dtype='int16')
+    for i, (block, temp_block) in enumerate(zip(blocks, temp_blocks)):
+        precip_total[i] = precip.isel(time=block).values.sum(axis=0, dtype='float64')
+        temp_mean[i] = temp.isel(time=temp_block).values.mean(axis=0, dtype='float64') - KELVIN_OFFSET
+        days[i] = block.stop - block.start
+
+    for stale in glob.glob(os.path.join(cache_dir, f"{year}_*.npz")):
+        os.remove(stale)
+    tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+    np.savez(tmp_path, month_keys=month_keys, days=days, precip=precip_total, temp=temp_mean,
+             lat=precip.lat.values, lon=precip.lon.values)
+    os.replace(tmp_path, path)
+    return path
+
+
+def daylight_hours(lat, month_keys):
+    """Mean day length in hours at the middle of each month, as a (month, lat) array."""
+    month_starts = (np.asarray(month_keys) - 1970 * 12).astype('datetime64[M]')
+    day_of_year = (month_starts - month_starts.astype('datetime64[Y]')).astype('timedelta64[D]').astype(float) + 15
+    declination = 0.409 * np.sin(2 * np.pi * day_of_year / 365 - 1.39)
+    cos_sunset = -np.tan(np.radians(lat))[None, :] * np.tan(declination)[:, None]
+    return 24 / np.pi * np.arccos(np.clip(cos_sunset, -1, 1))
+
+
+def thornthwaite_pet(temp, lat, month_keys, days):
+    """Monthly potential evapotranspiration (mm) by Thornthwaite (1948).
+
+    `temp` is a (month, cell) array of mean temperatures in degC, `lat` the
+    latitude of each cell and `days` the length of each month. The heat
+    index comes from the mean temperature of each calendar month over the
+    whole record, as in the SPEI package. Cells whose climatology never
+    rises above 0 degC have a heat index of 0 and no PET below 26.5 degC.
+    """
+    calendar_month = np.asarray(month_keys) % 12
+    with warnings.catch_warnings():
+        # Ocean cells have no temperature at all
+        warnings.simplefilter('ignore', RuntimeWarning)
+        climatology = np.stack([np.nanmean(temp[calendar_month == m], axis=0) for m in range(12)])
+    heat_index = np.sum((np.maximum(climatology, 0) / 5) ** 1.514, axis=0)
+    a = 6.75e-7 * heat_index ** 3 - 7.71e-5 * heat_index ** 2 + 1.792e-2 * heat_index + 0.49239
+    # Day length and month length relative to 12 hours and 30 days
+    correction = daylight_hours(lat, month_keys) / 12 * (np.asarray(days, dtype=float) / 30)[:, None]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pet = np.where(heat_index > 0, 16 * correction * (10 * np.maximum(temp, 0) / heat_index) ** a, 0.0)
+        pet = np.where(temp >= 26.5, correction * (-415.85 + 32.24 * temp - 0.43 * temp ** 2), pet)
+    pet = np.where(temp > 0, pet, 0.0)
+    return np.where(np.isnan(temp), np.nan, pet)
+
+
+def accumulate(values, scale):
+    """Sums over the last `scale` months along axis 0; missing for the first scale - 1 months."""
+    missing = np.isnan(values)
+    total = np.cumsum(np.where(missing, 0, values), axis=0)
+    n_missing = np.cumsum(missing, axis=0)
+    result = np.full(values.shape, np.nan)
+    result[scale - 1:] = total[scale - 1:]
+    result[scale:] -= total[:-scale]
+    gaps = n_missing[scale - 1:].copy()
+    gaps[1:] -= n_missing[:-scale]
+    result[scale - 1:][gaps > 0] = np.nan
+    return result
+
+
+def loglogistic_fit(samples):
+    """Log-logistic parameters (alpha, beta, gamma) of every column of `samples`.
+
+    Fitted with unbiased probability-weighted moments (Vicente-Serrano et al.
+    2010); missing values are ignored. Columns with fewer than MIN_FIT_YEARS
+    values or without a valid fit get NaN parameters.
+    """
+    x = np.sort(samples, axis=0)
+    n = np.sum(~np.isnan(samples), axis=0).astype(float)
+    rank = np.arange(1, len(x) + 1)[:, None]
+    x = np.where(rank <= n, x, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w0 = x.sum(axis=0) / n
+        w1 = (x * (n - rank)).sum(axis=0) / (n * (n - 1))
+        w2 = (x * (n - rank) * (n - rank - 1)).sum(axis=0) / (n * (n - 1) * (n - 2))
+        beta = (2 * w1 - w0) / (6 * w1 - w0 - 6 * w2)
+        beta = np.where((beta > 1) & (n >= MIN_FIT_YEARS), beta, np.nan)
+        gammas = special.gamma(1 + 1 / beta) * special.gamma(1 - 1 / beta)
+        alpha = (w0 - 2 * w1) * beta / gammas
+        alpha = np.where(alpha > 0, alpha, np.nan)
+        gamma = w0 - alpha * gammas
+    return alpha, beta, gamma
+
+
+def standardize(values, alpha, beta, gamma):
+    """SPEI of accumulated water balances given the log-logistic parameters of their cells."""
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        probability = 1 / (1 + (alpha / np.maximum(values - gamma, 0)) ** beta)
+        spei = np.clip(special.ndtri(probability), -SPEI_LIMIT, SPEI_LIMIT)
+    return np.where(np.isnan(values) | np.isnan(alpha), np.nan, spei)
+
+
+def spei_from_balance(balance, month_keys, scales, reference):
+    """SPEI at each scale of a (month, cell) climatic water balance (P - PET, mm).
+
+    Every calendar month is fitted on its own, on the years of `reference` =
+    (first, last), all cells at once. Returns {scale: (month, cell) float32}.
+    """
+    calendar_month = np.asarray(month_keys) % 12
+    year = np.asarray(month_keys) // 12
+    in_reference = (year >= reference[0]) & (year <= reference[1])
+    result = {}
+    for scale in scales:
+        accumulated = accumulate(balance, scale)
+        spei = np.full(accumulated.shape, np.nan, dtype='float32')
+        for m in range(12):
+            months = calendar_month == m
+            params = loglogistic_fit(accumulated[months & in_reference])
+            spei[months] = standardize(accumulated[months], *params)
+        result[scale] = spei
+    return result
+
+
+def band_spei(item):
+    """Fits one latitude band and writes its SPEI into the shared output arrays.
+
+    `item` is (rows, climate_paths, output_paths, lat, month_keys, days,
+    reference); the inputs and outputs are .npy files shared by the workers.
+    """
+    rows, climate_paths, output_paths, lat, month_keys, days, reference = item
+    precip = np.load(climate_paths['precip'], mmap_mode='r')[:, rows]
+    temp = np.load(climate_paths['temp'], mmap_mode='r')[:, rows]
+    shape = precip.shape
+    precip = precip.reshape(len(month_keys), -1).astype(float)
+    temp = temp.reshape(len(month_keys), -1).astype(float)
+    cell_lat = np.repeat(np.asarray(lat)[rows], shape[2])
+
+    balance = precip - thornthwaite_pet(temp, cell_lat, month_keys, days)
+    for scale, spei in spei_from_balance(balance, month_keys, list(output_paths), reference).items():
+        output = np.load(output_paths[scale], mmap_mode='r+')
+        output[:, rows] = spei.reshape(shape)
+        output.flush()
+    return rows.stop - rows.start
+
+
+def spei_key(scale, reference, year_sources):
+    """Cache key of the SPEI at one scale: engine version, settings and the size and mtime of every input."""
+    stamps = [[year, input_stamp(files['precip']), input_stamp(files['temp'])]
+              for year, files in year_sources.items()]
+    return hashlib.sha1(json.dumps([SPEI_VERSION, scale, list(reference), stamps]).encode()).hexdigest()[:16]
+
+
+def write_spei(path, values, month_keys, lat, lon, scale, reference):
+    """Writes monthly SPEI in the layout of SPEIbase (variable spei, monthly time steps)."""
+    times = (np.asarray(month_keys) - 1970 * 12).astype('datetime64[M]').astype('datetime64[ns]')
+    da = xr.DataArray(values, coords={'time': times, 'lat': lat, 'lon': lon}, dims=('time', 'lat', 'lon'),
+                      attrs={'long_name': f"Standardized Precipitation-Evapotranspiration Index, {scale} months",
+                             'scale_months': scale, 'pet': 'Thornthwaite',
+                             'distribution': 'log-logistic, unbiased probability-weighted moments',
+                             'reference_period': f"{reference[0]}-{reference[1]}"})
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    da.to_dataset(name='spei').to_netcdf(
+        tmp_path, encoding={'spei': {'zlib': True, 'complevel': 1, 'chunksizes': (1, len(lat), len(lon))}})
+    os.replace(tmp_path, path)
+
+
+def gridded_spei(precip_files, temp_files, cache_dir, scales=SPEI_SCALES, reference=None, workers=1,
+                 catalog_file=None):
+    """Monthly SPEI at each of `scales` months from daily precipitation and mean temperature.
+
+    PET is estimated with Thornthwaite, the climatic water balance P - PET
+    is summed over each scale and every calendar month is fitted with a
+    log-logistic distribution over the years of `reference` = (first, last)
+    (default: all years) and standardised. The daily files are summarised
+    to monthly fields year by year in parallel; the fit runs on all cells
+    of a latitude band at once, one band per task. Results are on the grid
+    of the daily files and cached in `cache_dir` by settings and the size
+    and mtime of the inputs, so only new or changed years are re-read and
+    unchanged scales are not refitted. Months of years without both files
+    are left missing, so no accumulation runs across the gap.
+
+    Returns {scale: path of a NetCDF file usable as the SPEI of the CDHW metrics}.
+    """
+    year_sources = catalog_years({'precip': precip_files, 'temp': temp_files}, catalog_file=catalog_file,
+                                 workers=workers)
+    year_sources = {year: files for year, files in year_sources.items() if len(files) == 2}
+    if not year_sources:
+        raise ValueError("No year has both precipitation and temperature files")
+    reference = tuple(reference) if reference else (min(year_sources), max(year_sources))
+
+    paths = {scale: os.path.join(cache_dir, f"spei{scale:02d}_{spei_key(scale, reference, year_sources)}.nc")
+             for scale in scales}
+    todo = [scale for scale in scales if not os.path.exists(paths[scale])]
+    if not todo:
+        return paths
+
+    print(f"--- Computing SPEI at {todo} months from {len(year_sources)} years of precipitation and temperature ---")
+    monthly_dir = os.path.join(cache_dir, "monthly")
+    os.makedirs(monthly_dir, exist_ok=True)
+    print("Summarising the daily files to monthly fields...")
+    monthly_paths = map_in_order(partial(monthly_climate, cache_dir=monthly_dir), year_sources.items(), workers)
+
+    work_dir = tempfile.mkdtemp(prefix="spei_", dir=cache_dir)
+    try:
+        piece_keys = []
+        for path in monthly_paths:
+            with np.load(path) as piece:
+                piece_keys.append(piece['month_keys'])
+                lat, lon = piece['lat'], piece['lon']
+        # One continuous month axis: months of missing years stay NaN instead of
+        # joining the months on either side of the gap
+        month_keys = np.arange(piece_keys[0][0], piece_keys[-1][-1] + 1)
+        n_missing = len(month_keys) - sum(len(keys) for keys in piece_keys)
+        if n_missing:
+            print(f"Warning: {n_missing} months between {piece_keys[0][0] // 12} and {piece_keys[-1][-1] // 12} "
+                  "have no precipitation or temperature; their SPEI and the windows over them stay missing")
+        month_starts = (month_keys - 1970 * 12).astype('datetime64[M]')
+        days = ((month_starts + 1).astype('datetime64[D]') - month_starts.astype('datetime64[D]')).astype('int16')
+        shape = (len(month_keys), len(lat), len(lon))
+        climate_paths = {}
+        for name in ('precip', 'temp'):
+            climate_paths[name] = os.path.join(work_dir, f"{name}.npy")
+            values = np.lib.format.open_memmap(climate_paths[name], mode='w+', dtype='float32', shape=shape)
+            values[:] = np.nan
+            for path in monthly_paths:
+                with np.load(path) as piece:
+                    positions = piece['month_keys'] - month_keys[0]
+                    values[positions] = piece[name]
+                    # Month lengths as stored, e.g. of noleap calendars
+                    days[positions] = piece['days']
+            values.flush()
+            del values
+        output_paths = {}
+        for scale in todo:
+            output_paths[scale] = os.path.join(work_dir, f"spei{scale:02d}.npy")
+            np.lib.format.open_memmap(output_paths[scale], mode='w+', dtype='float32', shape=shape).flush()
+
+        band_rows = min(max(1, BAND_CELLS // len(lon)), len(lat))
+        items = [(slice(start, min(start + band_rows, len(lat))), climate_paths, output_paths, lat, month_keys, days,
+                  reference) for start in range(0, len(lat), band_rows)]
+        print(f"Fitting {len(items)} latitude bands of up to {band_rows} rows...")
+        map_in_order(band_spei, items, workers)
+
+        for scale in todo:
+            for stale in glob.glob(os.path.join(cache_dir, f"spei{scale:02d}_*.nc")):
+                os.remove(stale)
+            write_spei(paths[scale], np.load(output_paths[scale], mmap_mode='r'), month_keys, lat, lon, scale,
+                       reference)
+            print(f"SPEI-{scale} saved to {paths[scale]}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return paths
+
+
+def parse_args(argv=None, prog=None):
+    import calculate_cdhw
+
+    parser = argparse.ArgumentParser(prog=prog, description="Gridded SPEI from daily precipitation and mean "
+                                                            "temperature, cached for the CDHW calculation.")
+    parser.add_argument("--scales", type=int, nargs="+", default=SPEI_SCALES, metavar="MONTHS",
+                        help="accumulation scales in months (default: %(default)s)")
+    parser.add_argument("--reference", type=int, nargs=2, default=None, metavar=("FIRST", "LAST"),
+                        help="years the distributions are fitted on (default: all years)")
+    parser.add_argument("--precip-pattern", default=calculate_cdhw.PRECIP_FILES_PATTERN,
+                        help="daily precipitation files in mm per day (default: %(default)s)")
+    parser.add_argument("--temp-pattern", default=calculate_cdhw.TEMP_FILES_PATTERN,
+                        help="daily mean temperature files in Kelvin (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes, one year or latitude band per task (0 = all cores)")
+    parser.add_argument("--output-dir", default=None, metavar="DIR",
+                        help="also copy each scale to DIR/speiNN.nc")
+    return parser.parse_args(argv)
+
+
+def run(args):
+    """Computes (or reuses) the SPEI of every scale of `parse_args`."""
+    import calculate_cdhw
+    from input_catalog import CATALOG_FILE
+    from parallel import default_workers
+
+    precip_files = sorted(glob.glob(args.precip_pattern))
+    temp_files = sorted(glob.glob(args.temp_pattern))
+    if not precip_files or not temp_files:
+        raise FileNotFoundError(f"No daily files found: {args.precip_pattern}, {args.temp_pattern}")
+    paths = gridded_spei(precip_files, temp_files, os.path.join(calculate_cdhw.STATIC_CACHE_DIR, "spei"),
+                         args.scales, args.reference, args.workers or default_workers(),
+                         os.path.join(calculate_cdhw.STATIC_CACHE_DIR, CATALOG_FILE))
+    for scale, path in paths.items():
+        if args.output_dir:
+            os.makedirs(args.output_dir, exist_ok=True)
+            shutil.copyfile(path, os.path.join(args.output_dir, f"spei{scale:02d}.nc"))
+        print(f"SPEI-{scale}: {path}")
+
+
+if __name__ == "__main__":
+    run(parse_args())
@@ -0,0 +1,111 @@
+import numpy as np
+
+# Per-cell summary of one year's daily mask, enough to join spells across year boundaries:
+#   lead:   length of the run starting on the first day (0 if that day does not qualify)
+#   trail:  length of the run ending on the last day
+#   full:   every day of the year qualifies
+#   starts: days that begin a run, the first day included if it qualifies
+#   inner:  longest run touching neither the first nor the last day
+#   onset, onset_next: day of year of the first run start, and of the first one after the first day
+SPELL_PARTS = ('lead', 'trail', 'full', 'starts', 'inner', 'onset', 'onset_next')
+
+
+def first_true(mask, doy):
+    """Day of year of the first True day per cell of a (time, ...) mask, NaN where there is none."""
+    return np.where(mask.any(axis=0), doy[mask.argmax(axis=0)], np.nan).astype('float32')
+
+
+def spell_state(blocks):
+    """Run-length summary (see SPELL_PARTS) of a year's daily boolean mask given in time blocks.
+
+    `blocks` yields (mask, day_of_year) pairs in time order, `mask` a
+    (time, ...) boolean block of consecutive days and `day_of_year` the day
+    of year of each of its days. The runs are measured with cumulative
+    maxima along time, vectorised over all cells, and the open run is
+    carried from one block to the next, so runs crossing block (month,
+    chunk or file) boundaries are measured whole and only one block is
+    needed in memory.
+    """
+    run = None
+    day = 0
+    for mask, doy in blocks:
+        n = mask.shape[0]
+        doy = np.asarray(doy)
+        if run is None:
+            shape = mask.shape[1:]
+            run = np.zeros(shape, dtype='int32')
+            lead = np.zeros(shape, dtype='int32')
+            lead_open = np.ones(shape, dtype=bool)
+            starts = np.zeros(shape, dtype='int32')
+            inner = np.zeros(shape, dtype='int32')
+            onset = np.full(shape, np.nan, dtype='float32')
+            onset_next = np.full(shape, np.nan, dtype='float32')
+        if n == 0:
+            continue
+        steps = np.arange(n, dtype='int32').reshape((n,) + (1,) * (mask.ndim - 1))
+
+        # Length of the run ending on each day: days since the last non-qualifying day,
+        # plus the run carried over from the previous block while there is none
+        last_off = np.maximum.accumulate(np.where(mask, -1, steps), axis=0)
+        runs = np.where(last_off >= 0, steps - last_off, run + steps + 1) * mask
+
+        previous = np.concatenate([(run > 0)[None], mask[:-1]])
+        begins = mask & ~previous
+        starts += begins.sum(axis=0, dtype='int32')
+        onset = np.where(np.isnan(onset), first_true(begins, doy), onset)
+        if day == 0:
+            begins[0] = False
+        onset_next = np.where(np.isnan(onset_next), first_true(begins, doy), onset_next)
+
+        # Runs ending inside the block, and the one that ended on the last day of the previous block
+        ends = mask[:-1] & ~mask[1:]
+        from_start = runs[:-1] > steps[:-1] + day
+        inner = np.maximum(inner, np.where(ends & ~from_start, runs[:-1], 0).max(axis=0, initial=0))
+        if day > 0:
+            inner = np.where((run > 0) & ~mask[0] & (run < day), np.maximum(inner, run), inner)
+
+        off = ~mask
+        any_off = off.any(axis=0)
+        lead = np.where(lead_open, lead + np.where(any_off, off.argmax(axis=0), n), lead)
+        lead_open &= ~any_off
+        run = runs[-1]
+        day += n
+
+    if day == 0:
+        raise ValueError("spell_state needs at least one day")
+    return {'lead': lead.astype('int16'), 'trail': run.astype('int16'), 'full': lead_open,
+            'starts': starts.astype('int16'), 'inner': inner.astype('int16'), 'onset': onset,
+            'onset_next': onset_next}
+
+
+def carry_forward(state, carry_in):
+    """Length of the run still open at the end of a year, given the run open at its start."""
+    return np.where(state['full'], carry_in + state['lead'], state['trail']).astype('int32')
+
+
+def carry_backward(next_state, next_carry_out):
+    """Length of the run continuing after the end of a year into the next year(s)."""
+    return np.where(next_state['full'], next_state['lead'] + next_carry_out, next_state['lead']).astype('int32')
+
+
+def spell_statistics(state, carry_in, carry_out):
+    """Events, longest spell and onset of one year, with spells joined across year boundaries.
+
+    `carry_in` is the length of the run open when the year begins and
+    `carry_out` the length by which its last run continues into the next
+    years (0 where there is none, e.g. at the ends of the record). A spell
+    belongs to the year it starts in: a run continuing from the previous
+    year is not a new event of this year, and a run starting this year
+    counts with its full length even where it goes on into the next year.
+
+    Returns the number of events, the longest spell in days (int32) and
+    the day of year of the first event (float32, NaN without events).
+    """
+    lead, trail, full = state['lead'].astype('int32'), state['trail'].astype('int32'), state['full']
+    continued = (carry_in > 0) & (lead > 0)
+    events = state['starts'].astype('int32') - continued
+    lead_run = np.where((lead > 0) & ~continued, lead + np.where(full, carry_out, 0), 0)
+    trail_run = np.where((trail > 0) & ~full, trail + carry_out, 0)
+    longest = np.maximum(state['inner'].astype('int32'), np.maximum(lead_run, trail_run))
+    onset = np.where(continued, state['onset_next'], state['onset'])
+    return events, longest, onset
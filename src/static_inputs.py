@@ -0,0 +1,246 @@
+import hashlib
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+import profiling
+
+# Bump whenever the content or layout of the cached bundle changes.
+STATIC_CACHE_VERSION = 2
+
+# Candidate region code columns in Natural Earth style shapefiles, in order of
+# preference: admin-1 codes for province shapefiles, ISO3 codes for countries.
+ISO_COLUMNS = ['adm1_code', 'ADM0_A3', 'ISO_A3', 'ISO_A3_EH']
+# Candidate region name columns, countries first.
+NAME_COLUMNS = ['ADMIN', 'name', 'NAME']
+
+_SHAPEFILE_SIDECARS = ['.shp', '.shx', '.dbf', '.prj', '.cpg']
+
+# Bundles already loaded in this process, keyed by cache key.
+_loaded_bundles = {}
+# File digests already computed in this process, keyed by (path, size, mtime).
+_file_digests = {}
+
+
+def file_digest(path):
+    """SHA-1 of a file's content. Shapefiles include their sidecar files."""
+    stem, ext = os.path.splitext(path)
+    paths = [stem + e for e in _SHAPEFILE_SIDECARS if os.path.exists(stem + e)] if ext.lower() == '.shp' else [path]
+
+    h = hashlib.sha1()
+    for p in paths:
+        st = os.stat(p)
+        stamp = (os.path.abspath(p), st.st_size, st.st_mtime_ns)
+        if stamp not in _file_digests:
+            fh = hashlib.sha1()
+            with open(p, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    fh.update(block)
+            _file_digests[stamp] = fh.hexdigest()
+        h.update(os.path.basename(p).encode())
+        h.update(_file_digests[stamp].encode())
+    return h.hexdigest()
+
+
+def grid_digest(lat, lon):
+    """SHA-1 of a target grid's latitude and longitude coordinates."""
+    h = hashlib.sha1()
+    for coord in (lat, lon):
+        values = np.ascontiguousarray(np.asarray(coord, dtype='float64'))
+        h.update(str(values.shape).encode())
+        h.update(values.tobytes())
+    return h.hexdigest()
+
+
+def static_inputs_key(template, area_file, growing_season_file, countries_file):
+    """Cache key for the static inputs aligned to the grid of `template`."""
+    h = hashlib.sha1()
+    h.update(f"v{STATIC_CACHE_VERSION}".encode())
+    h.update(grid_digest(template.lat.values, template.lon.values).encode())
+    for path in (area_file, growing_season_file, countries_file):
+        h.update(file_digest(path).encode())
+    return h.hexdigest()[:20]
+
+
+def get_month_from_day_of_year(da):
+    """将年积日转换为月份"""
+    original_shape = da.shape
+    flat_values = da.values.flatten()
+    with np.errstate(invalid='ignore'):
+        flat_months = pd.to_datetime(flat_values, format='%j', errors='coerce').month
+    return np.reshape(flat_months, original_shape)
+
+
+def build_static_inputs(template, area_file, growing_season_file, countries_file):
+    """Aligns maize area, growing season and country mask to the grid of `template`.
+
+    `template` is a 2D (lat, lon) DataArray; without a CRS it is taken as
+    EPSG:4326. rioxarray, geopandas and regionmask are only imported here,
+    so runs that find their bundle in the cache never load them.
+    Returns an xarray Dataset with the area weights, the country mask, the
+    growing-season start/end months and days of year and the region names
+    and ISO3 codes.
+    """
+    import rioxarray
+    import geopandas as gpd
+    import regionmask
+
+    if template.rio.crs is None:
+        template = template.rio.write_crs("EPSG:4326")
+    print(f"Building static inputs for a {template.sizes['lat']}x{template.sizes['lon']} grid...")
+
+    with profiling.stage('reproject_match', file=os.path.basename(area_file)):
+        da_area = rioxarray.open_rasterio(area_file, masked=True).squeeze()
+        da_area_aligned = da_area.rio.reproject_match(template)
+        da_area_aligned = da_area_aligned.rename({'y': 'lat', 'x': 'lon'})
+        area_weights = da_area_aligned.fillna(0).where(da_area_aligned > 0, 0)
+
+    with profiling.stage('growing_season_months', file=os.path.basename(growing_season_file)):
+        df_gs = pd.read_csv(growing_season_file)
+        ds_gs = df_gs.set_index(['Latitude', 'Longitude']).to_xarray()
+        ds_gs = ds_gs.rename({'Latitude': 'lat', 'Longitude': 'lon'})
+        ds_gs_aligned = ds_gs.reindex_like(template, method='nearest')
+        start_month_2d = get_month_from_day_of_year(ds_gs_aligned['plant.start.day'])
+        end_month_2d = get_month_from_day_of_year(ds_gs_aligned['harvest.end.day'])
+
+    with profiling.stage('regionmask', file=os.path.basename(countries_file)):
+        countries = gpd.read_file(countries_file)
+        country_mask = regionmask.mask_geopandas(countries, template.lon, template.lat)
+
+    name_col = next((col for col in NAME_COLUMNS if col in countries.columns), None)
+    if name_col is None:
+        raise ValueError("No region name column found in %s. Tried: %s" % (countries_file, NAME_COLUMNS))
+
+    coords = {'lat': template.lat.values, 'lon': template.lon.values}
+    static = xr.Dataset(
+        {
+            'area_weights': (('lat', 'lon'), area_weights.transpose('lat', 'lon').values),
+            'country_mask': (('lat', 'lon'), country_mask.transpose('lat', 'lon').values.astype('float64')),
+            'gs_start_month': (('lat', 'lon'), np.asarray(start_month_2d, dtype='float64')),
+            'gs_end_month': (('lat', 'lon'), np.asarray(end_month_2d, dtype='float64')),
+            # Planting and harvest days as given, for the exact day-of-year season
+            'gs_start_day': (('lat', 'lon'), np.asarray(ds_gs_aligned['plant.start.day'].values, dtype='float64')),
+            'gs_end_day': (('lat', 'lon'), np.asarray(ds_gs_aligned['harvest.end.day'].values, dtype='float64')),
+            'region_name': ('region', countries[name_col].to_numpy(dtype=str)),
+        },
+        coords={**coords, 'region': countries.index.values.astype('int64')},
+    )
+    for col in ISO_COLUMNS:
+        if col in countries.columns:
+            static[f'region_iso_{col}'] = ('region', countries[col].to_numpy(dtype=str))
+    return static
+
+
+def save_static_inputs(static, path):
+    """Writes a static-input bundle to a compressed npz file."""
+    # Strings are stored as fixed-width unicode so the bundle loads without pickle
+    arrays = {name: static[name].values.astype(str) if static[name].dtype == object else static[name].values
+              for name in static.variables}
+    tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+    np.savez_compressed(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+
+def read_static_inputs(path):
+    """Reads a static-input bundle written by `save_static_inputs`."""
+    with np.load(path) as bundle:
+        coords = {'lat': bundle['lat'], 'lon': bundle['lon'], 'region': bundle['region']}
+        data_vars = {}
+        for name in bundle.files:
+            if name in coords:
+                continue
+            dims = ('region',) if name.startswith('region_') else ('lat', 'lon')
+            data_vars[name] = (dims, bundle[name])
+    return xr.Dataset(data_vars, coords=coords)
+
+
+def load_static_inputs(template, area_file, growing_season_file, countries_file, cache_dir):
+    """Returns the static inputs for the grid of `template`, building them only once.
+
+    Bundles are kept in memory for the lifetime of the process and persisted
+    to `cache_dir` as npz files keyed by the target grid and the content of
+    the input files, so later files, runs and scripts reuse them.
+    """
+    key = static_inputs_key(template, area_file, growing_season_file, countries_file)
+    if key in _loaded_bundles:
+        return _loaded_bundles[key]
+
+    path = os.path.join(cache_dir, f"static_inputs_{key}.npz")
+    if os.path.exists(path):
+        print(f"Using cached static inputs: {path}")
+        static = read_static_inputs(path)
+    else:
+        static = build_static_inputs(template, area_file, growing_season_file, countries_file)
+        os.makedirs(cache_dir, exist_ok=True)
+        save_static_inputs(static, path)
+        print(f"Static inputs cached to {path}")
+
+    static.attrs['cache_key'] = key
+    _loaded_bundles[key] = static
+    return static
+
+
+def export_static_inputs(static, cache_dir):
+    """Writes a loaded bundle as one .npy file per variable for memory-mapped sharing.
+
+    Returns the directory to pass to `attach_static_inputs` in worker processes.
+    """
+    key = static.attrs['cache_key']
+    directory = os.path.join(cache_dir, f"static_inputs_{key}")
+    if not os.path.isdir(directory):
+        tmp_dir = f"{directory}.{os.getpid()}.tmp"
+        os.makedirs(tmp_dir, exist_ok=True)
+        for name in static.variables:
+            values = static[name].values
+            np.save(os.path.join(tmp_dir, f"{name}.npy"), values.astype(str) if values.dtype == object else values)
+        try:
+            os.replace(tmp_dir, directory)
+        except OSError:
+            # Another process exported the same bundle first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    return directory
+
+
+def attach_static_inputs(directory, file_digests=None):
+    """Registers a bundle exported by `export_static_inputs` without copying it.
+
+    The arrays are memory-mapped read-only, so all worker processes share the
+    operating system's page cache instead of holding private copies.
+    `file_digests` primes the digest memo so workers do not rehash the inputs.
+    """
+    if file_digests:
+        _file_digests.update(file_digests)
+    key = os.path.basename(directory)[len("static_inputs_"):]
+    arrays = {os.path.splitext(name)[0]: np.load(os.path.join(directory, name), mmap_mode='r')
+              for name in os.listdir(directory) if name.endswith('.npy')}
+    coords = {name: arrays.pop(name) for name in ('lat', 'lon', 'region')}
+    data_vars = {name: (('region',) if name.startswith('region_') else ('lat', 'lon'), values)
+                 for name, values in arrays.items()}
+    static = xr.Dataset(data_vars, coords=coords, attrs={'cache_key': key})
+    _loaded_bundles[key] = static
+    return static
+
+
+def file_digest_memo():
+    """File digests computed so far in this process, for `attach_static_inputs`."""
+    return dict(_file_digests)
+
+
+def region_labels(static, iso_col=None):
+    """Maps region numbers to country names and ISO3 codes.
+
+    If `iso_col` is None, the first available column of ISO_COLUMNS is used.
+    """
+    available = [col for col in ISO_COLUMNS if f'region_iso_{col}' in static]
+    if iso_col is None:
+        iso_col = available[0] if available else None
+    if iso_col not in available:
+        raise ValueError("No ISO3 or admin-1 code column found in regions shapefile. Available columns: %s" % available)
+
+    numbers = static['region'].values.tolist()
+    name_map = dict(zip(numbers, static['region_name'].values.tolist()))
+    iso_map = dict(zip(numbers, static[f'region_iso_{iso_col}'].values.tolist()))
+    return name_map, iso_map
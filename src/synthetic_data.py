@@ -0,0 +1,308 @@
+import argparse
+import json
+import os
+
+import netCDF4
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from calculate_cdhw import (COUNTRIES_SHP_FILE, GROWING_SEASON_FILE, MAIZE_AREA_FILE, SPEI_FILE,
+                            TMAX_FILES_PATTERN)
+
+# Same layout as the real data/ folder, relative to the output directory, so the
+# calculate_*.py scripts run unchanged from there (config.py is written too)
+TEMP_FILES_DIR = os.path.join("data", "temp")
+PRECIP_FILES_DIR = os.path.join("data", "precip")
+TEMP_FILE_NAME = "AgERA5_Temperature_Air_2m_Mean_{year}.nc"
+PRECIP_FILE_NAME = "AgERA5_Precipitation_Flux_{year}.nc"
+MANIFEST_FILE = "synthetic.json"
+
+# SPAM harvested area is a 5 arcmin raster and SPEIbase a 0.5 degree grid,
+# whatever the resolution of the daily data
+AREA_RESOLUTION = 1 / 12
+SPEI_RESOLUTION = 0.5
+GROWING_SEASON_RESOLUTION = 0.5
+
+# Days generated and written per chunk, to bound memory on 0.1 degree grids
+WRITE_CHUNK_DAYS = 8
+# Day-to-day persistence of the daily weather anomalies (AR(1) coefficient)
+DAILY_PERSISTENCE = 0.7
+# Month-to-month persistence of SPEI
+SPEI_PERSISTENCE = 0.8
+N_REGIONS = 60
+
+# Packed Tmax like the ERA5 files from the CDS: int16 with scale_factor/add_offset
+PACKED_SCALE = 0.01
+PACKED_OFFSET = 273.15
+PACKED_FILL = -32767
+
+
+def synthetic_grid(resolution):
+    """Cell centres of a global grid, latitudes north to south like AgERA5."""
+    lat = np.arange(90 - resolution / 2, -90, -resolution)
+    lon = np.arange(-180 + resolution / 2, 180, resolution)
+    return lat, lon
+
+
+def land_fraction(lat, lon):
+    """Smooth pseudo-continents: a (lat, lon) field, land where it is > 0."""
+    la, lo = np.meshgrid(np.radians(lat), np.radians(lon), indexing='ij')
+    field = np.sin(2 * lo + 1) * np.cos(1.5 * la) + 0.6 * np.sin(3 * la + lo) + 0.3 * np.cos(5 * lo - 2 * la)
+    field = np.where(lat[:, None] < -60, 1.0, field)
+    return field - 0.15
+
+
+def climate_anomaly(lat, lon):
+    """Fixed smooth (lat, lon) field with unit amplitude, for regional climate differences."""
+    la, lo = np.meshgrid(np.radians(lat), np.radians(lon), indexing='ij')
+    return np.sin(4 * lo + 2 * la) * np.cos(3 * la - lo)
+
+
+def tmax_climatology(lat, lon, day_of_year):
+    """Mean daily Tmax (degC) on `day_of_year`, warmest in July in the north and January in the south."""
+    abs_lat = np.abs(lat)[:, None]
+    annual_mean = 33.0 - 0.38 * abs_lat + 3.0 * climate_anomaly(lat, lon)
+    amplitude = 1.5 + 0.3 * abs_lat
+    season = -np.cos(2 * np.pi * (day_of_year - 15) / 365.25) * np.sign(lat)[:, None]
+    return annual_mean + amplitude * season
+
+
+def create_coordinate(ds, name, values, attrs):
+    """Adds a fixed-length coordinate variable to a NetCDF dataset."""
+    ds.createDimension(name, len(values))
+    var = ds.createVariable(name, values.dtype, (name,))
+    var.setncatts(attrs)
+    var[:] = values
+
+
+def create_daily_file(path, year, lat, lon, name, units, packed=False, compress=False):
+    """Creates an empty daily NetCDF file of one year; returns the dataset and its data variable."""
+    ds = netCDF4.Dataset(path, 'w')
+    create_coordinate(ds, 'lat', lat, {'standard_name': 'latitude', 'units': 'degrees_north', 'axis': 'Y'})
+    create_coordinate(ds, 'lon', lon, {'standard_name': 'longitude', 'units': 'degrees_east', 'axis': 'X'})
+    ds.createDimension('time', None)
+    time = ds.createVariable('time', 'i4', ('time',))
+    time.setncatts({'standard_name': 'time', 'units': f"days since {year}-01-01", 'calendar': 'standard'})
+
+    chunks = (1, len(lat), len(lon))
+    if packed:
+        var = ds.createVariable(name, 'i2', ('time', 'lat', 'lon'), zlib=compress, chunksizes=chunks,
+                                fill_value=PACKED_FILL)
+        var.setncatts({'scale_factor': np.float32(PACKED_SCALE), 'add_offset': np.float32(PACKED_OFFSET)})
+    else:
+        var = ds.createVariable(name, 'f4', ('time', 'lat', 'lon'), zlib=compress, chunksizes=chunks,
+                                fill_value=np.float32(np.nan))
+    var.setncattr('units', units)
+    return ds, var
+
+
+def write_daily_year(paths, year, lat, lon, seed, packed=False, compress=False):
+    """Writes one year of daily Tmax, mean temperature and precipitation.
+
+    Tmax follows a latitude-dependent seasonal cycle plus AR(1) anomalies, so
+    hot days come in spells; mean temperature is Tmax minus a diurnal range
+    and precipitation is gamma distributed on wet days. Ocean cells are
+    missing, as in AgERA5. The year is generated and written in chunks of
+    WRITE_CHUNK_DAYS days.
+    """
+    rng = np.random.default_rng([seed, year])
+    ocean = land_fraction(lat, lon) <= 0
+    wet_probability = np.clip(0.35 + 0.25 * climate_anomaly(lat, lon), 0.05, 0.9).astype('float32')
+    anomaly = rng.standard_normal((len(lat), len(lon)), dtype='float32')
+    days = pd.date_range(f"{year}-01-01", f"{year}-12-31", freq='D')
+
+    files = [
+        create_daily_file(paths['tmax'], year, lat, lon, 'Temperature_Air_2m_Max_Day_Time', 'K', packed, compress),
+        create_daily_file(paths['temp'], year, lat, lon, 'Temperature_Air_2m_Mean_24h', 'K', False, compress),
+        create_daily_file(paths['precip'], year, lat, lon, 'Precipitation_Flux', 'mm d-1', False, compress),
+    ]
+    (_, tmax_var), (_, temp_var), (_, precip_var) = files
+    try:
+        for start in range(0, len(days), WRITE_CHUNK_DAYS):
+            stop = min(start + WRITE_CHUNK_DAYS, len(days))
+            tmax = np.empty((stop - start, len(lat), len(lon)), dtype='float32')
+            temp = np.empty_like(tmax)
+            precip = np.empty_like(tmax)
+            for i, day in enumerate(range(start, stop)):
+                eps = rng.standard_normal(anomaly.shape, dtype='float32')
+                anomaly = DAILY_PERSISTENCE * anomaly + np.sqrt(1 - DAILY_PERSISTENCE ** 2) * eps
+                tmax[i] = tmax_climatology(lat, lon, days[day].dayofyear) + 273.15 + 3.5 * anomaly
+                temp[i] = tmax[i] - 8.0 + 0.5 * eps
+                wet = rng.random(anomaly.shape, dtype='float32') < wet_probability
+                precip[i] = np.where(wet, rng.gamma(0.8, 8.0, anomaly.shape), 0.0)
+            for values in (tmax, temp, precip):
+                values[:, ocean] = np.nan
+            for ds, _ in files:
+                ds['time'][start:stop] = np.arange(start, stop, dtype='int32')
+            # Masked cells are written as the fill value, also when packing to int16
+            tmax_var[start:stop] = np.ma.masked_array(np.nan_to_num(tmax), mask=np.isnan(tmax))
+            temp_var[start:stop] = temp
+            precip_var[start:stop] = precip
+    finally:
+        for ds, _ in files:
+            ds.close()
+
+
+def write_spei(path, years, seed):
+    """Monthly SPEI-3 on the SPEIbase 0.5 degree grid from a year before the first year onwards."""
+    rng = np.random.default_rng([seed, 0])
+    lat, lon = synthetic_grid(SPEI_RESOLUTION)
+    lat = lat[::-1]
+    times = pd.date_range(f"{min(years) - 1}-01-01", f"{max(years)}-12-01", freq='MS')
+    values = np.empty((len(times), len(lat), len(lon)), dtype='float32')
+    state = rng.standard_normal((len(lat), len(lon)), dtype='float32')
+    for i in range(len(times)):
+        eps = rng.standard_normal(state.shape, dtype='float32')
+        state = SPEI_PERSISTENCE * state + np.sqrt(1 - SPEI_PERSISTENCE ** 2) * eps
+        values[i] = state
+    values[:, land_fraction(lat, lon) <= 0] = np.nan
+    xr.Dataset({'spei': (('time', 'lat', 'lon'), values)},
+               coords={'time': times, 'lat': lat, 'lon': lon}).to_netcdf(path)
+
+
+def write_maize_area(path, seed):
+    """Harvested maize area (ha per cell) as a 5 arcmin GeoTIFF, missing outside the maize belts."""
+    import rioxarray
+
+    rng = np.random.default_rng([seed, 1])
+    lat, lon = synthetic_grid(AREA_RESOLUTION)
+    area = rng.gamma(0.6, 400.0, (len(lat), len(lon))).astype('float32')
+    cropped = (land_fraction(lat, lon) > 0) & (np.abs(lat)[:, None] < 55) & (rng.random(area.shape) < 0.5)
+    area[~cropped] = np.nan
+    da = xr.DataArray(area, coords={'y': lat, 'x': lon}, dims=('y', 'x'))
+    da.rio.write_crs('EPSG:4326').rio.write_nodata(np.nan).rio.to_raster(path, compress='deflate')
+
+
+def write_growing_season(path, seed):
+    """Planting and harvest day of year at 0.5 degree land points, like the crop calendar CSV."""
+    rng = np.random.default_rng([seed, 2])
+    lat, lon = synthetic_grid(GROWING_SEASON_RESOLUTION)
+    la, lo = np.meshgrid(lat, lon, indexing='ij')
+    keep = (land_fraction(lat, lon) > 0) & (np.abs(la) < 55)
+    la, lo = la[keep], lo[keep]
+
+    plant = np.where(la > 15, rng.integers(100, 160, la.size),
+                     np.where(la < -15, rng.integers(280, 340, la.size), rng.integers(1, 366, la.size)))
+    harvest = (plant + rng.integers(120, 200, la.size) - 1) % 365 + 1
+    pd.DataFrame({'Latitude': la, 'Longitude': lo, 'plant.start.day': plant,
+                  'harvest.end.day': harvest}).to_csv(path, index=False)
+
+
+def write_regions(path, seed, n_regions=N_REGIONS):
+    """Irregular country polygons (Voronoi cells) plus one region smaller than a 0.5 degree cell.
+
+    Columns follow Natural Earth: ADMIN, ISO_A3 (with a few "-99" codes) and ADM0_A3.
+    """
+    import geopandas as gpd
+    import shapely
+
+    rng = np.random.default_rng([seed, 3])
+    points = shapely.multipoints(np.column_stack([rng.uniform(-180, 180, n_regions),
+                                                  rng.uniform(-58, 75, n_regions)]))
+    extent = shapely.box(-180, -60, 180, 80)
+    cells = shapely.get_parts(shapely.voronoi_polygons(points, extend_to=extent))
+    # The small region is cut out of its neighbour so that no two polygons overlap
+    small = shapely.box(10.1, 10.1, 10.3, 10.3)
+    geoms = list(shapely.difference(shapely.intersection(cells, extent), small)) + [small]
+
+    codes = [f"R{i:02d}" if i < 100 else f"{i:03d}" for i in range(len(geoms))]
+    iso = [code if i % 25 else "-99" for i, code in enumerate(codes)]
+    regions = gpd.GeoDataFrame({'ADMIN': [f"Region {i}" for i in range(len(geoms))], 'ISO_A3': iso,
+                                'ADM0_A3': codes}, geometry=geoms, crs='EPSG:4326')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    regions.to_file(path)
+
+
+def write_config(root):
+    """config.py for the scripts that read their paths from it."""
+    data_dir = os.path.join(root, "data")
+    entries = {
+        'MeanTempPath': os.path.join(root, TEMP_FILES_DIR),
+        'PrecipitationPath': os.path.join(root, PRECIP_FILES_DIR),
+        'MaizeAreaPath': os.path.join(root, MAIZE_AREA_FILE),
+        'GrowingSeasonPath': os.path.join(root, GROWING_SEASON_FILE),
+        'COUNTRIES_SHP_FILE': os.path.join(root, COUNTRIES_SHP_FILE),
+        'results_path': os.path.join(data_dir, "results"),
+    }
+    with open(os.path.join(root, "config.py"), 'w') as f:
+        f.write("# Synthetic benchmark data, written by synthetic_data.py\n")
+        for name, value in entries.items():
+            f.write(f"{name} = {value!r}\n")
+
+
+def input_paths(root, years):
+    """Paths of the synthetic inputs under `root`, in the layout the scripts expect."""
+    daily = {
+        'tmax': [os.path.join(root, TMAX_FILES_PATTERN.replace('*', str(year))) for year in years],
+        'temp': [os.path.join(root, TEMP_FILES_DIR, TEMP_FILE_NAME.format(year=year)) for year in years],
+        'precip': [os.path.join(root, PRECIP_FILES_DIR, PRECIP_FILE_NAME.format(year=year)) for year in years],
+    }
+    return {
+        'sources': daily,
+        'spei': os.path.join(root, SPEI_FILE),
+        'static_files': tuple(os.path.join(root, path)
+                              for path in (MAIZE_AREA_FILE, GROWING_SEASON_FILE, COUNTRIES_SHP_FILE)),
+    }
+
+
+def generate_inputs(root, resolution=0.5, years=(2001,), seed=0, packed=False, compress=False):
+    """Writes a complete synthetic input set under `root` and returns its paths (see `input_paths`).
+
+    Daily Tmax, mean temperature and precipitation are on a global grid of
+    `resolution` degrees, one file per year; SPEI, maize area, growing season
+    and regions are at the resolutions of the real products. With `packed`,
+    Tmax is stored as int16 with scale_factor/add_offset. Inputs already
+    generated with the same settings are reused.
+    """
+    years = sorted(years)
+    params = {'resolution': resolution, 'years': years, 'seed': seed, 'packed': packed, 'compress': compress}
+    paths = input_paths(root, years)
+    manifest = os.path.join(root, MANIFEST_FILE)
+    if os.path.exists(manifest):
+        with open(manifest) as f:
+            if json.load(f) == params:
+                print(f"Using synthetic inputs in {root}")
+                return paths
+        os.remove(manifest)
+
+    lat, lon = synthetic_grid(resolution)
+    print(f"Generating synthetic inputs in {root}: {len(lat)}x{len(lon)} grid, {len(years)} years")
+    for files in paths['sources'].values():
+        os.makedirs(os.path.dirname(files[0]), exist_ok=True)
+    for i, year in enumerate(years):
+        print(f"  Daily data for {year}")
+        write_daily_year({variable: files[i] for variable, files in paths['sources'].items()},
+                         year, lat, lon, seed, packed, compress)
+
+    area_file, growing_season_file, regions_file = paths['static_files']
+    write_spei(paths['spei'], years, seed)
+    write_maize_area(area_file, seed)
+    write_growing_season(growing_season_file, seed)
+    write_regions(regions_file, seed)
+    write_config(root)
+
+    with open(manifest, 'w') as f:
+        json.dump(params, f)
+    return paths
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate synthetic Tmax, temperature, precipitation, SPEI, "
+                                                 "maize area, growing season and region inputs.")
+    parser.add_argument("outdir", help="output directory; the inputs are written to OUTDIR/data")
+    parser.add_argument("--resolution", type=float, default=0.5, metavar="DEG",
+                        help="resolution of the daily grids, e.g. 0.5, 0.25 or 0.1 (default: %(default)s)")
+    parser.add_argument("--years", type=int, default=1, help="number of years (default: %(default)s)")
+    parser.add_argument("--start-year", type=int, default=2001, help="first year (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed (default: %(default)s)")
+    parser.add_argument("--packed", action="store_true",
+                        help="store Tmax as packed int16 like the ERA5 files from the CDS")
+    parser.add_argument("--compress", action="store_true", help="zlib-compress the daily files")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    generate_inputs(os.path.abspath(args.outdir), args.resolution,
+                    range(args.start_year, args.start_year + args.years), args.seed, args.packed, args.compress)
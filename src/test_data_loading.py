@@ -5,9 +5,9 @@ import os
 DATA_DIR = "data"
 TMAX_FILES_PATTERN = os.path.join(DATA_DIR, "gfdl-esm4_r1i1p1f1_w5e5_historical_tasmax_global_daily_*.nc")
 
-def test_load_individual_files():
+def test_load_individual_files(pattern=TMAX_FILES_PATTERN):
     print("--- Testing individual TMAX file opening ---")
-    tmax_files = sorted(glob.glob(TMAX_FILES_PATTERN))
+    tmax_files = sorted(glob.glob(pattern))
     if not tmax_files:
         print("No TMAX files found!")
         return
@@ -0,0 +1,48 @@
+import numpy as np
+
+
+def threshold_values(start, stop, step):
+    """Evenly spaced thresholds from `start` to `stop` inclusive."""
+    n = int(round((stop - start) / step))
+    return [round(start + i * step, 6) for i in range(n + 1)]
+
+
+def exceedance_bins(values, thresholds):
+    """Number of thresholds strictly below each value.
+
+    A value in bin k exceeds the k smallest thresholds. NaN values go to bin
+    0 so they never count as an exceedance, like `value > threshold` would.
+    Thresholds are cast to the dtype of `values` so the comparison matches
+    an elementwise `values > threshold` exactly.
+    """
+    values = np.asarray(values)
+    dtype = values.dtype if np.issubdtype(values.dtype, np.floating) else 'float64'
+    thresholds = np.sort(np.asarray(thresholds, dtype=dtype))
+    bins = np.searchsorted(thresholds, values, side='left').astype(np.min_scalar_type(len(thresholds)))
+    bins[np.isnan(values)] = 0
+    return bins
+
+
+def annual_exceedance_counts(bins, qualified, year_index, n_years, n_thresholds):
+    """Per-cell annual counts of qualified days above each threshold.
+
+    `bins` and `qualified` are (time, cells) arrays from `exceedance_bins`
+    and the boolean day filter; `year_index` gives the year position of each
+    time step. The qualified days are histogrammed by (year, bin, cell) with
+    a single bincount, and the counts above every threshold are then read
+    off the histogram with a reverse cumulative sum, so the cost does not
+    grow with the number of thresholds.
+
+    Returns a (n_years, n_thresholds, cells) uint16 array, thresholds in
+    ascending order.
+    """
+    n_bins = n_thresholds + 1
+    n_cells = bins.shape[1]
+
+    t, c = np.nonzero(qualified)
+    flat = (year_index[t].astype('int64') * n_bins + bins[t, c]) * n_cells + c
+    hist = np.bincount(flat, minlength=n_years * n_bins * n_cells).reshape(n_years, n_bins, n_cells)
+
+    # Days above threshold j are the days in bins j+1 .. n_thresholds
+    exceed = np.cumsum(hist[:, :0:-1], axis=1)[:, ::-1]
+    return exceed.astype('uint16')
@@ -0,0 +1,289 @@
+import argparse
+import json
+import os
+import shutil
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from grid_store import open_grid_store
+import profiling
+
+# Bump whenever the layout of the cube changes.
+YEAR_CUBE_VERSION = 1
+CUBE_META_FILE = "cube.json"
+
+YearCube = namedtuple('YearCube', ['path', 'years', 'metrics', 'labels', 'region_columns', 'region_bounds',
+                                   'areas', 'weights', 'cumulative'])
+Query = namedtuple('Query', ['metric', 'first_year', 'last_year', 'regions', 'min_area'])
+Query.__new__.__defaults__ = (None, 0.0)
+
+
+def region_entries(ds):
+    """(region position, cell, weight, cell area) of every cell with weight in a region of a grid store.
+
+    With 'mask' weights every cell of the country mask is one entry; with
+    'overlap' weights a boundary cell has one entry per region it overlaps,
+    weighted by its area fraction. Entries without weight are dropped.
+    """
+    area = np.asarray(ds['area_weights'].transpose('lat', 'lon').values, dtype='float64').ravel()
+    codes = ds.region.values
+    if ds.attrs['region_weights'] == 'overlap':
+        fractions = sparse.csr_matrix((ds['region_fraction_data'].values, ds['region_fraction_indices'].values,
+                                       ds['region_fraction_indptr'].values), shape=(len(codes), len(area))).tocoo()
+        positions, cells, fraction = fractions.row, fractions.col, fractions.data
+    else:
+        mask = np.asarray(ds['country_mask'].transpose('lat', 'lon').values, dtype='float64').ravel()
+        cells = np.flatnonzero(~np.isnan(mask))
+        order = np.argsort(codes)
+        positions = order[np.searchsorted(codes, mask[cells], sorter=order)]
+        fraction = np.ones(len(cells))
+    weights = fraction * np.nan_to_num(area[cells])
+    keep = weights > 0
+    return positions[keep], cells[keep], weights[keep], area[cells][keep]
+
+
+def build_year_cube(store, path):
+    """Precomputes the cumulative-over-years cube of a grid store for `query_cube`.
+
+    The weighted cells of every region are laid out next to each other,
+    largest maize area first, with one extra leading column per region. For
+    every metric the cube holds, at row k, the running sum over the regions'
+    cells of weight x value summed over the first k years (missing values
+    count as 0, like the regional means). Any period is then the difference
+    of two rows, and any area cutoff a prefix of the region's columns, so a
+    query reads two numbers per region whatever the length of the period.
+    Rows are written one year at a time to memory-mapped .npy files. Spell
+    onsets also get a cube of the weights of the cells with a spell, which
+    they are averaged over.
+    """
+    ds = open_grid_store(store)
+    metrics = json.loads(ds.attrs['metrics'])
+    years = np.sort(ds.year.values.astype('int64'))
+    positions, cells, weights, areas = region_entries(ds)
+    n_regions = ds.sizes['region']
+
+    order = np.lexsort((cells, -areas, positions))
+    positions, cells, weights, areas = positions[order], cells[order], weights[order], areas[order]
+    entry_bounds = np.searchsorted(positions, np.arange(n_regions + 1))
+    # Region r owns columns region_columns[r] .. region_columns[r] + its entry count, the first one always 0
+    region_columns = entry_bounds[:-1] + np.arange(n_regions)
+    n_columns = len(cells) + n_regions
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    os.makedirs(tmp_path)
+    names = [m['name'] for m in metrics] + [f"{m['name']}_cells" for m in metrics if m['kind'] == 'onset']
+    cumulative = {}
+    for name in names:
+        cumulative[name] = np.lib.format.open_memmap(os.path.join(tmp_path, f"{name}.npy"), mode='w+',
+                                                     dtype='float64', shape=(len(years) + 1, n_columns))
+        cumulative[name][0] = 0.0
+
+    column_of_entry = np.arange(len(cells)) + positions + 1
+    row = np.zeros(n_columns)
+    for k, year in enumerate(years):
+        with profiling.stage('cube_year', year=int(year)):
+            weighted = {}
+            for metric in metrics:
+                name = metric['name']
+                values = np.asarray(ds[name].sel(year=year).transpose('lat', 'lon').values, dtype='float64').ravel()
+                weighted[name] = weights * np.nan_to_num(values[cells])
+                if metric['kind'] == 'onset':
+                    weighted[f"{name}_cells"] = weights * ~np.isnan(values[cells])
+            for name, entries in weighted.items():
+                # Running sums restart in every region, so small regions keep their precision
+                for r in range(n_regions):
+                    start, stop = entry_bounds[r], entry_bounds[r + 1]
+                    np.cumsum(entries[start:stop], out=entries[start:stop])
+                row[:] = 0.0
+                row[column_of_entry] = entries
+                cumulative[name][k + 1] = cumulative[name][k] + row
+    for values in cumulative.values():
+        values.flush()
+    del cumulative
+
+    weight_row = np.zeros(n_columns)
+    cumulative_weights = weights.copy()
+    for r in range(n_regions):
+        start, stop = entry_bounds[r], entry_bounds[r + 1]
+        np.cumsum(cumulative_weights[start:stop], out=cumulative_weights[start:stop])
+    weight_row[column_of_entry] = cumulative_weights
+    code_col = next(name for name in ds.data_vars if name.startswith('region_iso_'))
+    np.save(os.path.join(tmp_path, "weights.npy"), weight_row)
+    np.save(os.path.join(tmp_path, "areas.npy"), areas)
+    np.save(os.path.join(tmp_path, "region_bounds.npy"), entry_bounds)
+    np.save(os.path.join(tmp_path, "region_columns.npy"), region_columns)
+    with open(os.path.join(tmp_path, CUBE_META_FILE), 'w') as f:
+        json.dump({
+            'version': YEAR_CUBE_VERSION,
+            'store': os.path.abspath(store),
+            'years': years.tolist(),
+            'metrics': metrics,
+            'region_weights': ds.attrs['region_weights'],
+            'country_code': ds.region.values.astype('int64').tolist(),
+            'country_iso': ds[code_col].values.tolist(),
+            'country': ds['region_name'].values.tolist(),
+        }, f)
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+    print(f"Year cube of {len(years)} years, {len(metrics)} metrics and {len(cells)} weighted cells written to {path}")
+
+
+def open_year_cube(path):
+    """Opens a cube written by `build_year_cube`; the metric cubes are memory-mapped, not read."""
+    with open(os.path.join(path, CUBE_META_FILE)) as f:
+        meta = json.load(f)
+    if meta['version'] != YEAR_CUBE_VERSION:
+        raise ValueError(f"{path} was written by another version of year_cube.py, rebuild it")
+    labels = pd.DataFrame({'country_code': meta['country_code'], 'country_iso': meta['country_iso'],
+                           'country': meta['country']})
+    names = [m['name'] for m in meta['metrics']] + [f"{m['name']}_cells" for m in meta['metrics'] if m['kind'] == 'onset']
+    cumulative = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r') for name in names}
+    return YearCube(path, np.asarray(meta['years'], dtype='int64'), meta['metrics'], labels,
+                    np.load(os.path.join(path, "region_columns.npy")),
+                    np.load(os.path.join(path, "region_bounds.npy")),
+                    np.load(os.path.join(path, "areas.npy")),
+                    np.load(os.path.join(path, "weights.npy")), cumulative)
+
+
+def region_positions(cube, regions):
+    """Positions of regions given by ISO code, name or region number; None selects every region."""
+    if regions is None:
+        return np.arange(len(cube.labels))
+    if isinstance(regions, (str, int, np.integer)):
+        regions = [regions]
+    positions = []
+    for region in regions:
+        if isinstance(region, (int, np.integer)):
+            match = cube.labels.index[cube.labels['country_code'] == region]
+        else:
+            match = cube.labels.index[(cube.labels['country_iso'] == region) | (cube.labels['country'] == region)]
+        if len(match) == 0:
+            raise ValueError(f"Unknown region {region!r}")
+        positions.extend(match)
+    return np.unique(positions)
+
+
+def query_cube(cube, queries):
+    """Answers a batch of (metric, period, region set, area cutoff) queries from a year cube.
+
+    Each query is a `Query` (or a tuple/dict with its fields): the metric
+    name, the first and last year (inclusive), the regions (ISO codes, names
+    or region numbers, None for all) and `min_area`, which keeps only cells
+    with more maize area than the cutoff. The regions of a query are pooled
+    into one group weighted by maize area.
+
+    Returns a DataFrame with one row per query: the query fields, the number
+    of years of the cube in the period, the maize area of the group above
+    the cutoff and `value`, the mean over those years of the group's annual
+    area-weighted mean (e.g. mean CDHW days per year); for spell onsets, the
+    mean onset day over the cells and years with a spell. The cost per query is
+    two reads per region, independent of the number of years; the reads of
+    all queries on a metric are gathered in one step.
+    """
+    queries = [Query(**q) if isinstance(q, dict) else Query(*q) for q in queries]
+    n_queries = len(queries)
+    n_years = np.zeros(n_queries, dtype='int64')
+    area = np.zeros(n_queries)
+    query_index, first_rows, last_rows, columns = [], [], [], []
+    kinds = {m['name']: m['kind'] for m in cube.metrics}
+    for i, q in enumerate(queries):
+        if q.metric not in kinds:
+            raise ValueError(f"Unknown metric {q.metric!r}, the cube holds {list(kinds)}")
+        first_row = np.searchsorted(cube.years, q.first_year, side='left')
+        last_row = np.searchsorted(cube.years, q.last_year, side='right')
+        n_years[i] = max(last_row - first_row, 0)
+        for r in region_positions(cube, q.regions):
+            start, stop = cube.region_bounds[r], cube.region_bounds[r + 1]
+            # Cells of a region are sorted by area, largest first
+            n_cells = np.searchsorted(-cube.areas[start:stop], -q.min_area, side='left')
+            column = cube.region_columns[r] + n_cells
+            area[i] += cube.weights[column]
+            query_index.append(i)
+            first_rows.append(first_row)
+            last_rows.append(max(last_row, first_row))
+            columns.append(column)
+
+    query_index = np.asarray(query_index, dtype='int64')
+    first_rows, last_rows, columns = np.asarray(first_rows), np.asarray(last_rows), np.asarray(columns)
+    totals = np.zeros(n_queries)
+    # Onsets are divided by the weight of the cells with a spell instead of area x years
+    denominators = area * n_years
+    onset = np.array([kinds[q.metric] == 'onset' for q in queries], dtype=bool)
+    denominators[onset] = 0.0
+    for name, cumulative in cube.cumulative.items():
+        metric = name[:-len("_cells")] if name.endswith("_cells") and name not in kinds else name
+        selected = np.flatnonzero([queries[i].metric == metric for i in query_index])
+        if len(selected) == 0:
+            continue
+        sums = cumulative[last_rows[selected], columns[selected]] - cumulative[first_rows[selected], columns[selected]]
+        sums = np.bincount(query_index[selected], weights=sums, minlength=n_queries)
+        if metric == name:
+            totals += sums
+        else:
+            denominators += sums
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        value = np.where((denominators > 0) & (n_years > 0), totals / denominators, np.nan)
+    df = pd.DataFrame(queries, columns=Query._fields)
+    df['regions'] = [q.regions if q.regions is None or isinstance(q.regions, (str, int)) else ' '.join(map(str, q.regions))
+                     for q in queries]
+    df['years'] = n_years
+    df['area'] = area
+    df['value'] = value
+    return df
+
+
+def read_queries(path):
+    """Queries from a CSV with columns metric, first_year, last_year, regions (space-separated) and min_area."""
+    table = pd.read_csv(path, dtype={'regions': str})
+    queries = []
+    for row in table.itertuples(index=False):
+        regions = getattr(row, 'regions', None)
+        regions = None if pd.isna(regions) or regions in ('', 'all') else regions.split()
+        min_area = getattr(row, 'min_area', 0.0)
+        queries.append(Query(row.metric, int(row.first_year), int(row.last_year), regions,
+                             0.0 if pd.isna(min_area) else float(min_area)))
+    return queries
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Period, region-group and area-cutoff queries on a grid store.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="precompute the cumulative-over-years cube of a grid store")
+    build.add_argument("store", help="Zarr (.zarr) or NetCDF store written with --grid-output")
+    build.add_argument("cube", help="output directory of the cube")
+    query = commands.add_parser("query", help="answer queries from a cube")
+    query.add_argument("cube", help="directory written by 'build'")
+    query.add_argument("--metric", help="metric column, e.g. CDHW30_days")
+    query.add_argument("--years", type=int, nargs=2, metavar=("FIRST", "LAST"), help="period, inclusive")
+    query.add_argument("--regions", nargs="+", default=None, help="ISO codes or names pooled into one group (default: all)")
+    query.add_argument("--min-area", type=float, default=0.0, help="only cells with more maize area than this")
+    query.add_argument("--batch", default=None, metavar="CSV",
+                       help="answer every query of a CSV (metric, first_year, last_year, regions, min_area) instead")
+    query.add_argument("--output", default=None, help="write the answers to this CSV")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.command == "build":
+        build_year_cube(args.store, args.cube)
+    else:
+        cube = open_year_cube(args.cube)
+        if args.batch:
+            queries = read_queries(args.batch)
+        else:
+            if args.metric is None or args.years is None:
+                raise SystemExit("--metric and --years are required without --batch")
+            queries = [Query(args.metric, args.years[0], args.years[1], args.regions, args.min_area)]
+        answers = query_cube(cube, queries)
+        if args.output:
+            answers.to_csv(args.output, index=False)
+            print(f"Answers saved to {args.output}")
+        else:
+            print(answers.to_string(index=False))